@@ -0,0 +1,32 @@
+"""compares LinkData.for_path called per vpath against the batched LinkData.for_paths
+
+  PYTHONPATH=src python benchmarks/bench_link_data.py [n]
+"""
+import sys
+from pathlib import Path
+from timeit import timeit
+
+from dfi.dotfile import LinkData
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+BASE_DIR = Path('/home/foo/.settings')
+TARGET_DIR = Path('/home/foo/.local/bin')
+
+vpaths = [BASE_DIR.joinpath('bin', f"script-{n:06}") for n in range(N)]
+
+
+def per_path() -> None:
+  for v in vpaths:
+    LinkData.for_path(v, TARGET_DIR)
+
+
+def batched() -> None:
+  for _ in LinkData.for_paths(vpaths, TARGET_DIR):
+    pass
+
+
+assert [LinkData.for_path(v, TARGET_DIR) for v in vpaths] == list(LinkData.for_paths(vpaths, TARGET_DIR))
+
+for fn in [per_path, batched]:
+  t = min(timeit(fn, number=1) for _ in range(5))
+  print(f"{fn.__name__:>10}: {N} links in {t * 1000:8.1f}ms ({t / N * 1e6:6.2f}us/link)")
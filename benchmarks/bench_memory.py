@@ -0,0 +1,85 @@
+"""bytes held per link by a list of LinkData vs a LinkTable, and by a Plan, which is
+what a run applies from, along with the peak while each is built
+
+  PYTHONPATH=src python benchmarks/bench_memory.py [n]
+
+the Plan is built from n real files, made in a temporary directory first.
+"""
+import gc
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+from typing import Any, Callable, Tuple
+
+from dfi.compact import LinkTable
+from dfi.config import FileGroup, Settings
+from dfi.dotfile import LinkData
+from dfi.plan import Plan
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+BASE_DIR = Path('/home/foo/.settings')
+TARGET_DIR = Path('/home/foo/.local/bin')
+
+# a repo of repos, 100 links per source dir. like collect, entries in a dir share its Path
+dirs = [BASE_DIR.joinpath('repos', f"repo-{n:05}", 'bin') for n in range(N // 100 + 1)]
+entries = [(dirs[n // 100], f"script-{n:07}") for n in range(N)]
+for d in dirs:
+  str(d)  # Path caches its str, don't count that against either
+
+
+def link_data_list() -> Any:
+  return list(LinkData.for_paths((p / n for p, n in entries), TARGET_DIR))
+
+
+def link_table() -> Any:
+  table = LinkTable()
+  table.append_vpaths(entries, TARGET_DIR)
+  return table
+
+
+def make_settings(tmp: Path) -> Settings:
+  base_dir = tmp / '.settings'
+  for n in range(N):
+    d = base_dir.joinpath('repos', f"repo-{n // 100:05}", 'bin')
+    if n % 100 == 0:
+      d.mkdir(parents=True)
+    d.joinpath(f"script-{n:07}").touch()
+  fg = FileGroup(
+    base_dir=base_dir,
+    dirs=[],
+    globs=['repos/*/bin/*'],
+    excludes=[],
+    target_dir=tmp / '.local' / 'bin',
+  )
+  return Settings(base_dir=base_dir, groups=[fg])
+
+
+def measure(fn: Callable[[], Any]) -> Tuple[int, int]:
+  """(bytes held by what fn returns, the peak while it ran)"""
+  gc.collect()
+  tracemalloc.start()
+  before = tracemalloc.get_traced_memory()[0]
+  result = fn()
+  gc.collect()
+  after, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  assert len(result if not isinstance(result, Plan) else result.link_table) == N
+  del result
+  return after - before, peak - before
+
+
+def report(name: str, used: int, peak: int) -> None:
+  print(
+    f"{name:>16}: {N} links in {used / 2**20:8.1f}MiB ({used / N:6.1f} bytes/link), "
+    f"peak {peak / 2**20:8.1f}MiB"
+  )
+
+
+for fn in [link_data_list, link_table]:
+  report(fn.__name__, *measure(fn))
+
+with tempfile.TemporaryDirectory() as tmp:
+  settings = make_settings(Path(tmp))
+  report('Plan.build', *measure(lambda: Plan.build(settings, jobs=1)))
+  report('Plan.link_data', *measure(lambda: Plan.build(settings, jobs=1).link_data))
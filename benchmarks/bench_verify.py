@@ -0,0 +1,35 @@
+"""compares the 'readlink' and 'resolve' verify modes on an idempotent re-run, where
+every link is already in place
+
+  PYTHONPATH=src python benchmarks/bench_verify.py [n]
+"""
+import sys
+import tempfile
+from collections import Counter
+from pathlib import Path
+from timeit import timeit
+
+from dfi import fs
+from dfi.dotfile import LinkData
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+
+with tempfile.TemporaryDirectory() as tmp:
+  base_dir = Path(tmp, '.settings', 'bin')
+  target_dir = Path(tmp, '.local', 'bin')
+  base_dir.mkdir(parents=True)
+  vpaths = [base_dir / f"script-{n:06}" for n in range(N)]
+  for v in vpaths:
+    v.touch()
+
+  lds = list(LinkData.for_paths(vpaths, target_dir))
+  stgy = fs.fail_strategy
+  assert fs.apply_link_data(lds, True, stgy, stgy) == {'created': N}
+
+  for verify in fs.VALID_VERIFY_MODES:
+    counter: fs.SyscallCounter = Counter()
+    assert fs.apply_link_data(lds, True, stgy, stgy, counter=counter, verify=verify) == {'unchanged': N}
+    calls = ', '.join(f"{k}={v / N:g}" for k, v in sorted(counter.items()) if v >= N)
+
+    t = min(timeit(lambda: fs.apply_link_data(lds, True, stgy, stgy, verify=verify), number=1) for _ in range(5))
+    print(f"{verify:>8}: {N} links in {t * 1000:8.1f}ms ({t / N * 1e6:6.2f}us/link) {calls} per link")
@@ -4,29 +4,65 @@ from pathlib import Path
 from pprint import pprint
 from typing import List, Optional, TextIO
 import json
+import logging
+import time
 
 import attr
 import cattr
 import click
 from dotenv import find_dotenv, load_dotenv
 
-from .click_ext import PATHSEP_STRING
+from .click_ext import OCTAL_MODE, PATHSEP_STRING
 
 from .config import (
   FileGroup,
   Settings,
   VALID_FILE_STRATEGIES,
+  VALID_SOURCES,
   VALID_SYMLINK_STRATEGIES,
   TFileStrategy,
   TSymlinkStrategy
 )
 
-from . import fs
+from . import fanout, fs, state
+from . import incremental as incremental_
+from .backup import ObjectStore
+from .plan import Plan, PlanFile
+
+log = logging.getLogger(__name__)
 
 # mypy: disallow-untyped-decorators=False
 
 
-@click.command()
+# options shared by main and the apply command
+_verify_option = click.option(
+  '--verify',
+  type=click.Choice(fs.VALID_VERIFY_MODES),
+  help="""how to check that an existing symlink is already correct. 'readlink' accepts
+    one whose contents are exactly what would be written without following it,
+    'resolve' always follows it to see if it ends up at the source""",
+  default=fs.DEFAULT_VERIFY,
+)
+
+_jobs_option = click.option(
+  '-j',
+  '--jobs',
+  type=click.IntRange(min=1),
+  help="""apply links in up to this many directories at once. links within a
+    directory are always applied one after the other, in order""",
+  default=1,
+)
+
+
+_journal_option = click.option(
+  '--journal',
+  type=click.Path(dir_okay=False, resolve_path=True, allow_dash=False),
+  help="""record every change in this file before it's made, so that the run can be
+    undone with 'dfi rollback' or finished with 'dfi resume' if it's interrupted""",
+)
+
+
+@click.group(invoke_without_command=True)
 @click.option(
   '-b',
   '--base-path',
@@ -96,13 +132,89 @@ from . import fs
   help='the directory in which we will create the bin links',
   default=lambda: str(Path.cwd().parent.joinpath(".local", "bin")),
 )
+@click.option(
+  '--source',
+  type=click.Choice(VALID_SOURCES),
+  help="""where to find the files to link. 'git-index' lists only the files tracked
+    in the git checkout the base path is in, straight from its index, without
+    walking any directories""",
+  default='filesystem',
+)
+@click.option(
+  '--create-missing-target-dirs/--no-create-missing-target-dirs',
+  help="make target dirs that don't exist, or stop with an error before making any links",
+  default=True,
+)
+@click.option(
+  '--target-dir-mode',
+  type=OCTAL_MODE,
+  help="the mode to make missing target dirs with, in octal",
+  default='755',
+)
+@click.option(
+  '--backup-dir',
+  type=click.Path(file_okay=False, resolve_path=True, allow_dash=False),
+  help="""with the 'backup' file strategy, move conflicting files into a directory
+    named for the time of the run under here, keeping their paths relative to this
+    directory's parent, and list them in its manifest.jsonl""",
+)
+@click.option(
+  '--backup-store',
+  type=click.Path(file_okay=False, resolve_path=True, allow_dash=False),
+  help="""with the 'backup' file strategy, keep conflicting files in a content
+    addressed store here (i.e. ~/.local/state/dfi), so identical files are only
+    kept once. see 'dfi restore'""",
+)
 @click.option(
   '--output-flag-settings',
   help="""dumps a configuration in json that matches the flags
     given to the path provided (or stdout for -) and exits""",
   type=click.File(mode='w', encoding='utf8'),
 )
+@click.option(
+  '--settings',
+  'settings_file',
+  type=click.File(mode='r', encoding='utf8'),
+  help="""read the whole configuration, including any number of named file groups,
+    from json such as that written by --output-flag-settings. the other
+    configuration flags are ignored""",
+)
+@click.option(
+  '--collision-report',
+  help="""write a json report of link paths claimed by more than one source, and of
+    sources that are the same file, to the path provided (or stdout for -)""",
+  type=click.File(mode='w', encoding='utf8'),
+)
+@click.option(
+  '--stream',
+  is_flag=True,
+  help="""apply each link as soon as it's collected instead of planning them all
+    first. link paths claimed by more than one group are not checked for""",
+)
+@click.option(
+  '--state-file',
+  type=click.Path(dir_okay=False, resolve_path=True, allow_dash=False),
+  help="""save a fingerprint of the configuration, the source dirs and the target
+    dirs here after each run, and skip the next run if none of them have changed""",
+)
+@click.option(
+  '--force',
+  is_flag=True,
+  help="run even if the --state-file fingerprint hasn't changed",
+)
+@click.option(
+  '--incremental',
+  is_flag=True,
+  help="""only apply the links that files changed in base_dir's git checkout since
+    the last run can affect, as the --state-file records. everything is applied when
+    that can't be worked out""",
+)
+@_verify_option
+@_jobs_option
+@_journal_option
+@click.pass_context
 def main(
+  ctx: click.Context,
   base_path: Path,
   file_strategy: TFileStrategy,
   symlink_strategy: TSymlinkStrategy,
@@ -114,7 +226,21 @@ def main(
   binfiles: List[str],
   binfile_excludes: List[str],
   binfile_target_dir: Path,
-  output_flag_settings: Optional[TextIO]
+  source: str,
+  create_missing_target_dirs: bool,
+  target_dir_mode: int,
+  backup_dir: Optional[str],
+  backup_store: Optional[str],
+  output_flag_settings: Optional[TextIO],
+  settings_file: Optional[TextIO],
+  collision_report: Optional[TextIO],
+  stream: bool,
+  verify: fs.TVerify,
+  jobs: int,
+  journal: Optional[str],
+  state_file: Optional[str],
+  force: bool,
+  incremental: bool,
 ):
   """\
     The purpose of this utility is to keep configuration files and directories
@@ -169,7 +295,9 @@ def main(
 
     If a link path already exists and is a file, the following strategies are available:
 
-    * 'backup': move the file to a unique dated backup location and create the symlink
+    * 'backup': move the file to a unique dated backup location and create the symlink.
+      with --backup-dir, every file backed up in a run goes into one dated directory,
+      with --backup-store, into a store that keeps each distinct file once
 
     * 'delete': just delete the file and create the symlink
 
@@ -184,36 +312,358 @@ def main(
     * 'warn': print a warning that the conflict exists and continue
 
     * 'fail': stop processing and report an error
+
+    With no command, links are planned and applied in one go. 'dfi plan' and
+    'dfi apply' split that in two, so that a plan can be made once and then
+    applied on many hosts without collecting again.
   """
 
+  # click hands us str for its Path type
+  base_path = Path(base_path)
+
   settings = Settings(
     base_dir=base_path,
     conflicting_file_strategy=file_strategy,
     conflicting_symlink_strategy=symlink_strategy,
     dotfiles_file_group=FileGroup(
       base_dir=base_path,
-      dirs=dotfile_dirs,
+      dirs=[Path(d) for d in dotfile_dirs],
       globs=dotfiles,
       excludes=dotfile_excludes,
-      target_dir=dotfile_target_dir
+      target_dir=Path(dotfile_target_dir),
+      source=source,
     ),
     binfiles_file_group=FileGroup(
       base_dir=base_path,
-      dirs=binfile_dirs,
+      dirs=[Path(d) for d in binfile_dirs],
       globs=binfiles,
       excludes=binfile_excludes,
-      target_dir=binfile_target_dir
-    )
+      target_dir=Path(binfile_target_dir),
+      source=source,
+    ),
+    backup_dir=None if backup_dir is None else Path(backup_dir),
+    backup_store=None if backup_store is None else Path(backup_store),
+    create_missing_target_dirs=create_missing_target_dirs,
+    target_dir_mode=target_dir_mode,
+    journal=None if journal is None else Path(journal),
+    state_file=None if state_file is None else Path(state_file),
   )
+  if settings_file is not None:
+    settings = cattr.structure(json.load(settings_file), Settings)
+
   if output_flag_settings is not None:
     output_flag_settings.write(json.dumps(cattr.unstructure(settings)))
+    ctx.exit()
+
+  ctx.obj = settings
+  if ctx.invoked_subcommand is None:
+    run(
+      settings,
+      stream=stream,
+      collision_report=collision_report,
+      verify=verify,
+      jobs=jobs,
+      force=force,
+      incremental=incremental,
+    )
+
+
+@main.command('plan')
+@click.option(
+  '--out',
+  help="where to write the plan (or stdout for -)",
+  type=click.File(mode='w', encoding='utf8'),
+  default='-',
+)
+@click.pass_obj
+def plan_command(settings: Settings, out: TextIO) -> None:
+  """\
+    Collect the links for the given configuration and write them, along with what
+    is currently at each link path and what applying them is expected to do, as
+    json that 'dfi apply --plan' can read.
+  """
+  plan = Plan.build(settings)
+  _warn_collisions(plan)
+  fs.plan_file(plan).dump(out)
+
+
+@main.command('apply')
+@click.option(
+  '--plan',
+  'plan_file',
+  help="a plan written by 'dfi plan' (or stdin for -)",
+  type=click.File(mode='r', encoding='utf8'),
+  required=True,
+)
+@_verify_option
+@_jobs_option
+@_journal_option
+def apply_command(
+  plan_file: TextIO, verify: fs.TVerify, jobs: int, journal: Optional[str]
+) -> None:
+  """\
+    Create the links in a plan written by 'dfi plan' without collecting them again.
+    The state of each link path is checked, and conflicts are resolved with the
+    strategies that were in effect when the plan was made.
+  """
+  fs.apply_plan_file(
+    PlanFile.load(plan_file), verify=verify, jobs=jobs, journal=None if journal is None else Path(journal)
+  )
+
+
+@main.command('fanout')
+@click.option(
+  '--homes',
+  'home_globs',
+  help="""a glob matching the home directories to install into, may be given more
+    than once""",
+  multiple=True,
+  required=True,
+)
+@click.option(
+  '--template-home',
+  type=click.Path(file_okay=False, resolve_path=True, allow_dash=False),
+  help="""the home the configuration's target dirs are under, each link path is moved
+    from here to the same place in every home. defaults to the dotfile target dir""",
+)
+@click.option(
+  '-P',
+  '--processes',
+  type=click.IntRange(min=1),
+  help="how many homes to install at once, defaults to the number of cpus",
+)
+@click.option(
+  '--as-owner',
+  is_flag=True,
+  help="install into each home as the user and group that own it, needs root",
+)
+@click.option(
+  '--summary',
+  help="write the per home summary as json to the path provided (or stdout for -)",
+  type=click.File(mode='w', encoding='utf8'),
+)
+@_verify_option
+@click.pass_obj
+def fanout_command(
+  settings: Settings,
+  home_globs: List[str],
+  template_home: Optional[str],
+  processes: Optional[int],
+  as_owner: bool,
+  summary: Optional[TextIO],
+  verify: fs.TVerify,
+) -> None:
+  """\
+    Install the configuration into many home directories. The repo is collected and
+    planned once, then each home is installed on a pool of processes. A line is
+    printed for each home saying what was done, and the exit status is non-zero if
+    any of them failed.
+  """
+  if template_home is None:
+    if settings.dotfiles_file_group is None:
+      raise click.UsageError("--template-home is needed when there's no dotfiles group")
+    template_home = str(settings.dotfiles_file_group.target_dir)
+
+  homes = fanout.expand_homes(home_globs)
+  if not homes:
+    raise click.UsageError(f"no directories matched {', '.join(home_globs)}")
+
+  plan = Plan.build(settings)
+  _warn_collisions(plan)
+  results = fanout.fanout(
+    plan, Path(template_home), homes, processes=processes, as_owner=as_owner, verify=verify
+  )
+
+  for r in results:
+    click.echo(str(r))
+  if summary is not None:
+    summary.write(json.dumps(cattr.unstructure(results), indent=2))
+
+  failed = sum(1 for r in results if not r.ok)
+  if failed:
+    raise click.ClickException(f"{failed} of {len(results)} homes failed")
+
+
+@main.command('restore')
+@click.option(
+  '--store',
+  type=click.Path(exists=True, file_okay=False, resolve_path=True, allow_dash=False),
+  help="the --backup-store the file was backed up to",
+  required=True,
+)
+@click.option(
+  '--at',
+  help="restore the latest backup made at or before this time (YYYYMMDDHHmmss, utc)",
+)
+@click.option(
+  '--to',
+  type=click.Path(resolve_path=True, allow_dash=False),
+  help="where to put the restored file or directory, defaults to where it was",
+)
+@click.option(
+  '--list', 'list_only',
+  is_flag=True,
+  help="list the backups of the path instead of restoring one",
+)
+# not resolved, the path is most likely a symlink to the repo by now
+@click.argument('path', type=click.Path(allow_dash=False))
+def restore_command(
+  store: str, at: Optional[str], to: Optional[str], list_only: bool, path: str
+) -> None:
+  """\
+    Restore a file or directory that was backed up to a --backup-store, over the
+    link that replaced it.
+  """
+  path = os.path.abspath(path)
+  with ObjectStore(Path(store)) as objects:
+    if list_only:
+      for e in objects.under(Path(path)):
+        click.echo(f"{e.time} {e.kind} {e.path} {e.object or e.link or oct(e.mode)}")
+      return
+
+    entries = objects.latest_under(Path(path), at)
+    if not entries:
+      raise click.ClickException(f"no backup of {path} found in {store}")
+    dest = objects.restore(Path(path), entries, None if to is None else Path(to))
+    click.echo(f"restored {path} from {entries[0].time} to {dest}")
+
+
+_required_journal_option = click.option(
+  '--journal',
+  type=click.Path(exists=True, dir_okay=False, resolve_path=True, allow_dash=False),
+  help="the journal the run was recorded in",
+  required=True,
+)
+
+
+@main.command('rollback')
+@_required_journal_option
+def rollback_command(journal: str) -> None:
+  """\
+    Undo the last run recorded in a journal, finished or not. Links it made are
+    removed, and what was in their way is put back, as far as the journal says.
+    Link paths that have changed since are left alone.
+  """
+  outcomes = fs.rollback(Path(journal))
+  click.echo(' '.join(f"{k}={v}" for k, v in sorted(outcomes.items())) or 'nothing to undo')
+
+
+@main.command('resume')
+@_required_journal_option
+@_jobs_option
+def resume_command(journal: str, jobs: int) -> None:
+  """\
+    Finish the last run recorded in a journal, if it was interrupted, with the links
+    and settings it was started with.
+  """
+  outcomes = fs.resume(Path(journal), jobs=jobs)
+  click.echo(' '.join(f"{k}={v}" for k, v in sorted(outcomes.items())))
+
+
+_dry_run_option = click.option(
+  '-n',
+  '--dry-run',
+  is_flag=True,
+  help="list the links that would be removed without removing them",
+)
+
+
+def _prune(settings: Settings, uninstall: bool, dry_run: bool) -> None:
+  removed = fs.prune(settings, uninstall=uninstall, dry_run=dry_run)
+  for p in removed:
+    click.echo(f"{'would remove' if dry_run else 'removed'} {p}")
+  if not removed:
+    click.echo('nothing to remove')
+
+
+@main.command('prune')
+@_dry_run_option
+@click.pass_obj
+def prune_command(settings: Settings, dry_run: bool) -> None:
+  """\
+    Remove links into the base dir that are left over from files that have since
+    been removed from the repo, or are no longer collected. Only the entries
+    directly in each target dir are looked at.
+  """
+  _prune(settings, uninstall=False, dry_run=dry_run)
+
+
+@main.command('uninstall')
+@_dry_run_option
+@click.pass_obj
+def uninstall_command(settings: Settings, dry_run: bool) -> None:
+  """\
+    Remove every link into the base dir from the target dirs, whether the
+    configuration still makes it or not. Files that were backed up aren't put back.
+  """
+  _prune(settings, uninstall=True, dry_run=dry_run)
+
+
+def run(
+  settings: Settings,
+  stream: bool = False,
+  collision_report: Optional[TextIO] = None,
+  verify: fs.TVerify = fs.DEFAULT_VERIFY,
+  jobs: int = 1,
+  force: bool = False,
+  incremental: bool = False,
+) -> None:
+  state_file = settings.state_file
+  if state_file is None:
+    if incremental:
+      raise click.UsageError("--incremental needs a --state-file to keep the commit applied in")
+    _apply(settings, stream, collision_report, verify, jobs)
     return
 
-  run(settings)
+  start = time.monotonic()
+  saved = state.load(state_file)
+  fp = state.Fingerprint.of(settings)
+  if saved == fp and not force:
+    ms = (time.monotonic() - start) * 1000
+    click.echo(f"nothing has changed since the last run, checked in {ms:.1f}ms")
+    return
 
+  if not incremental:
+    _apply(settings, stream, collision_report, verify, jobs)
+  else:
+    # looked at before applying, so a commit made while we run is seen next time
+    checkout = incremental_.Checkout.of(settings.base_dir)
+    changed = incremental_.changes(settings, saved, fp, checkout)
+    if changed is None:
+      _apply(settings, stream, collision_report, verify, jobs)
+    else:
+      incremental_.apply(settings, changed, verify=verify, jobs=jobs)
+    if checkout is not None:
+      fp = attr.evolve(fp, commit=checkout.commit, dirty=checkout.dirty)
 
-def run(settings: Settings) -> None:
-  fs.apply_settings(settings)
+  # the links we made are part of the target dirs' mtimes now
+  state.save(state_file, settings, fp)
+
+
+def _apply(
+  settings: Settings,
+  stream: bool,
+  collision_report: Optional[TextIO],
+  verify: fs.TVerify,
+  jobs: int,
+) -> None:
+  if stream:
+    fs.apply_settings(settings, stream=stream, verify=verify, jobs=jobs)
+    return
+
+  plan = Plan.build(settings)
+  if collision_report is not None:
+    collision_report.write(plan.collisions.to_json())
+  _warn_collisions(plan)
+  fs.apply_plan(plan, verify=verify, jobs=jobs)
+
+
+def _warn_collisions(plan: Plan) -> None:
+  for c in plan.collisions.link_paths:
+    log.warning(
+      f"{len(c.losers) + 1} sources claim link path {str(c.link_path)!r}, "
+      f"using {str(c.winner.link_data.vpath)!r} from {c.winner.group!r}"
+    )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,583 @@
+"""moving conflicting files out of the way, either into a single backup directory
+per run or into a content addressed store
+"""
+import errno
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from stat import S_IFSOCK, S_IMODE, S_ISDIR, S_ISFIFO, S_ISLNK, S_ISREG, S_ISSOCK
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Callable, Dict, List, Optional, Set, Tuple, Union, cast
+
+import arrow
+import attr
+import cattr
+from typing_extensions import Final, Literal
+
+from .exceptions import BackupFailed, RestoreConflict
+
+log = logging.getLogger(__name__)
+
+_DATE_FORMAT_STR = 'YYYYMMDDHHmmss'
+
+# the name of the file in a run's backup root listing what was backed up
+MANIFEST_NAME: Final = 'manifest.jsonl'
+
+# how many roots to try if another run already has this second's
+_MAX_ROOT_TRIES: Final = 100
+
+# the dir in a run's backup root that files from outside its base keep their whole
+# path under, so they can't land on a file from under the base
+OUTSIDE_BASE_DIR: Final = '_abs'
+
+
+def timestamp() -> str:
+  return cast(str, arrow.utcnow().format(_DATE_FORMAT_STR))
+
+
+# the ioctl that makes dst share src's extents on filesystems that support it
+# (btrfs, xfs, ...), from linux/fs.h
+_FICLONE: Final = 0x40049409
+
+# how much copy_file_range and sendfile are asked to copy at a time
+_COPY_CHUNK: Final = 1 << 30
+
+# errors from copy_file_range and sendfile that mean "not here", rather than that
+# something went wrong
+_UNSUPPORTED_ERRNOS: Final = frozenset([
+  errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EBADF
+])
+
+try:
+  import fcntl
+except ImportError:  # pragma: no cover
+  fcntl = None  # type: ignore
+
+
+def _copy_in_kernel(copy: Callable[[int, int, int], int], src: int, dst: int) -> bool:
+  """copy all of src to dst with copy(src, dst, count) -> copied, returns False if
+  copy isn't supported between these two files and nothing was copied
+  """
+  copied = 0
+  while True:
+    try:
+      n = copy(src, dst, _COPY_CHUNK)
+    except OSError as e:
+      if copied == 0 and e.errno in _UNSUPPORTED_ERRNOS:
+        return False
+      raise
+    if n == 0:
+      return True
+    copied += n
+
+
+def copy_file(src: Path, dst: Path) -> None:
+  """copy src's contents, and mode, to dst, a new file, without bringing them into
+  userspace if the kernel can avoid it. tries a reflink, then copy_file_range, then
+  sendfile, and only reads and writes buffers when none of those work.
+  """
+  with open(src, 'rb') as fsrc, open(dst, 'xb') as fdst:
+    i, o = fsrc.fileno(), fdst.fileno()
+    done = False
+    if fcntl is not None:
+      try:
+        fcntl.ioctl(o, _FICLONE, i)
+        done = True
+      except OSError:
+        pass
+    if not done and hasattr(os, 'copy_file_range'):
+      done = _copy_in_kernel(lambda a, b, n: os.copy_file_range(a, b, n), i, o)
+    if not done and hasattr(os, 'sendfile'):
+      done = _copy_in_kernel(lambda a, b, n: os.sendfile(b, a, None, n), i, o)
+    if not done:
+      shutil.copyfileobj(fsrc, fdst)
+  shutil.copymode(src, dst)
+
+
+def _same_contents(a: Path, b: Path) -> bool:
+  return os.stat(a).st_size == os.stat(b).st_size and hash_file(a) == hash_file(b)
+
+
+def _copy_verified(src: Path, dst: Path) -> None:
+  copy_file(src, dst)
+  if not _same_contents(src, dst):
+    raise BackupFailed(src, f"the copy at {dst} doesn't match")
+
+
+def _copy_special(src: Path, dst: Path, st: os.stat_result) -> None:
+  """make dst a new fifo or socket like src, there's nothing in one to copy. a device
+  can't be copied
+  """
+  if S_ISFIFO(st.st_mode):
+    os.mkfifo(dst)
+  elif S_ISSOCK(st.st_mode):
+    os.mknod(dst, S_IFSOCK | 0o600)
+  else:
+    raise BackupFailed(src, "it's a device, which can't be copied to another filesystem")
+  # not through mkfifo and mknod, the umask would apply
+  os.chmod(dst, S_IMODE(st.st_mode))
+
+
+def copy_tree(src: Path, dst: Path, jobs: Optional[int] = None) -> None:
+  """copy the directory tree src to dst, which mustn't exist, checking that every
+  file's copy has the same contents. files are copied on a pool of up to jobs threads
+  (the ThreadPoolExecutor default if None). symlinks are copied as symlinks, and fifos
+  and sockets are made again.
+  """
+  files: List[Tuple[Path, Path]] = []
+  dirs: List[Tuple[Path, Path]] = []
+  for dirpath, dirnames, filenames in os.walk(src):
+    d = Path(dirpath)
+    to = dst / d.relative_to(src)
+    os.mkdir(to)
+    dirs.append((d, to))
+    for name in dirnames + filenames:
+      st = os.lstat(d / name)
+      if S_ISLNK(st.st_mode):
+        os.symlink(os.readlink(d / name), to / name)
+      elif S_ISREG(st.st_mode):
+        files.append((d / name, to / name))
+      elif not S_ISDIR(st.st_mode):
+        _copy_special(d / name, to / name, st)
+
+  if len(files) > 1 and jobs != 1:
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='dfi-copy') as ex:
+      # list() so that the first error is raised here
+      list(ex.map(lambda f: _copy_verified(*f), files))
+  else:
+    for f in files:
+      _copy_verified(*f)
+
+  # after the files, or copying them would change the directories' mtimes again
+  for d, to in reversed(dirs):
+    shutil.copystat(d, to)
+
+
+def move(src: Path, dst: Path, jobs: Optional[int] = None) -> None:
+  """rename src, a file, symlink or directory, to dst. if they're on different
+  filesystems src is copied (see copy_file and copy_tree), and only removed once
+  every copied file has been checked against its original. a copy that fails is
+  cleaned up and src is left where it was. a copy is never made over something
+  that's already at dst, that's left alone.
+  """
+  try:
+    os.rename(src, dst)
+    return
+  except OSError as e:
+    if e.errno != errno.EXDEV:
+      raise
+
+  log.debug(f"{src} and {dst} are on different devices, copying")
+  if os.path.lexists(dst):
+    raise FileExistsError(errno.EEXIST, os.strerror(errno.EEXIST), str(dst))
+  st = os.lstat(src)
+  try:
+    if S_ISLNK(st.st_mode):
+      os.symlink(os.readlink(src), dst)
+    elif S_ISDIR(st.st_mode):
+      copy_tree(src, dst, jobs)
+    elif S_ISREG(st.st_mode):
+      _copy_verified(src, dst)
+    else:
+      _copy_special(src, dst, st)
+  except BaseException as e:
+    # something else made dst after we looked, it isn't ours to remove
+    if isinstance(e, FileExistsError) and e.filename == str(dst):
+      raise
+    if os.path.isdir(dst) and not os.path.islink(dst):
+      shutil.rmtree(dst, ignore_errors=True)
+    elif os.path.lexists(dst):
+      os.unlink(dst)
+    raise
+
+  if S_ISDIR(st.st_mode):
+    shutil.rmtree(src)
+  else:
+    os.unlink(src)
+
+
+class BackupRun:
+  """a backup root, backup_dir/<timestamp>, that every file backed up during one run
+  is moved into
+
+  a file under base keeps its path relative to base inside the root, anything else
+  keeps its whole path under OUTSIDE_BASE_DIR. a backup never replaces another. each
+  backup is one rename, plus a mkdir the first time a directory is needed. the root,
+  and its manifest, are only made when the first file is backed up. the manifest has
+  a json object per line with the 'original' and 'backup' paths, written and synced
+  as soon as each file has been moved.
+
+  safe to use from several threads at once. use it as a context manager, or call
+  close, so the manifest is closed.
+  """
+  __slots__ = ('backup_dir', 'base', 'stamp', '_root', '_made', '_taken', '_manifest', '_lock')
+
+  def __init__(self, backup_dir: Path, base: Optional[Path] = None) -> None:
+    self.backup_dir = backup_dir
+    self.base = backup_dir.parent if base is None else base
+    self.stamp = timestamp()
+    self._root: Optional[Path] = None
+    # directories under the root that we know exist
+    self._made: Set[str] = set()
+    # paths under the root that have been backed up to, or are about to be
+    self._taken: Set[Path] = set()
+    self._manifest: Optional[IO[str]] = None
+    self._lock = threading.Lock()
+
+  def __enter__(self) -> 'BackupRun':
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    self.close()
+
+  @property
+  def root(self) -> Optional[Path]:
+    """the root backups are being made in, or None if nothing's been backed up yet"""
+    return self._root
+
+  def close(self) -> None:
+    with self._lock:
+      if self._manifest is not None:
+        self._manifest.close()
+        self._manifest = None
+
+  def _make_root(self) -> Path:
+    os.makedirs(self.backup_dir, mode=0o700, exist_ok=True)
+    for n in range(_MAX_ROOT_TRIES):
+      root = self.backup_dir / (self.stamp if n == 0 else f"{self.stamp}-{n}")
+      try:
+        os.mkdir(root, mode=0o700)
+      except FileExistsError:
+        continue
+      log.info(f"backing up conflicting files to {root}")
+      self._made.add(str(root))
+      self._manifest = open(root / MANIFEST_NAME, 'x', encoding='utf8')
+      return root
+    raise FileExistsError(f"couldn't make a backup root like {self.backup_dir / self.stamp}")
+
+  def dest(self, root: Path, p: Path) -> Path:
+    """where p is backed up to under root"""
+    try:
+      return root / p.relative_to(self.base)
+    except ValueError:
+      return root / OUTSIDE_BASE_DIR / p.relative_to(p.anchor)
+
+  def backup(self, p: Path) -> Path:
+    """move p into the backup root, returning where it went"""
+    with self._lock:
+      root = self._root
+      if root is None:
+        root = self._root = self._make_root()
+      dest = self.dest(root, p)
+      if dest in self._taken or os.path.lexists(dest):
+        raise BackupFailed(p, f"{dest} is already a backup of something else")
+      self._taken.add(dest)
+      parent = str(dest.parent)
+      if parent not in self._made:
+        os.makedirs(parent, mode=0o700, exist_ok=True)
+        self._made.add(parent)
+
+    move(p, dest)
+    log.debug(f"backed up {p} to {dest}")
+
+    with self._lock:
+      if self._manifest is not None:
+        self._manifest.write(json.dumps({'original': str(p), 'backup': str(dest)}) + '\n')
+        self._manifest.flush()
+        os.fsync(self._manifest.fileno())
+    return dest
+
+  def strategy(self, p: Path) -> Optional[Path]:
+    """a file strategy that backs up the conflicting file p into this run's root"""
+    return self.backup(p)
+
+
+_HASH_CHUNK: Final = 1 << 20
+
+
+def hash_file(p: Path) -> str:
+  """the hex sha256 of p's contents"""
+  h = hashlib.sha256()
+  with open(p, 'rb') as f:
+    for chunk in iter(lambda: f.read(_HASH_CHUNK), b''):
+      h.update(chunk)
+  return h.hexdigest()
+
+
+# what an IndexEntry records
+TEntryKind = Literal['file', 'symlink', 'dir']
+
+# the names in an ObjectStore's directory
+OBJECTS_DIR: Final = 'objects'
+INDEX_NAME: Final = 'index.jsonl'
+
+# errors from os.link that mean an object has to be copied in instead
+_NO_LINK_ERRNOS: Final = frozenset([
+  errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP, errno.ENOTSUP
+])
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class IndexEntry:
+  """one file, symlink or directory that an ObjectStore backed up"""
+  # where it was
+  path: str
+  # the timestamp of the run that backed it up
+  time: str
+  kind: str
+  mode: int
+  # the hash of a file's contents, None for a symlink or directory
+  object: Optional[str] = None
+  # the contents of a symlink
+  link: Optional[str] = None
+  # the id of the run that backed it up, if it was made by one, see journal.RunHeader
+  run: Optional[str] = None
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class StoredBackup:
+  """what ObjectStore.strategy returns, the time its index entries for a file have"""
+  time: str
+
+
+# where a strategy moved a conflicting entry to
+TBackup = Union[Path, StoredBackup]
+
+
+class ObjectStore:
+  """backups kept by the hash of their contents, so a file that's identical to one
+  backed up before, on any run, costs a hash and no more disk
+
+  objects live at store_dir/objects/ab/cdef..., read only. a conflicting file is
+  hard linked into place if its contents are new (or copied, across filesystems),
+  then recorded in the index, and only then removed. the index,
+  store_dir/index.jsonl, maps each original path and run timestamp to its object,
+  and each line is synced before the file it records is removed. a directory is
+  backed up file by file, with an entry for each directory and symlink in it.
+
+  safe to use from several threads at once. use it as a context manager, or call
+  close, so the index is closed.
+  """
+  __slots__ = ('store_dir', 'run', 'stamp', '_made', '_index', '_entries', '_lock')
+
+  def __init__(self, store_dir: Path, run: Optional[str] = None) -> None:
+    self.store_dir = store_dir
+    # recorded in each entry, so a run can be rolled back from the index
+    self.run = run
+    self.stamp = timestamp()
+    self._made: Set[str] = set()
+    # the index, opened to append to the first time something is backed up
+    self._index: Optional[IO[str]] = None
+    self._entries: Optional[Dict[str, List[IndexEntry]]] = None
+    self._lock = threading.Lock()
+
+  def __enter__(self) -> 'ObjectStore':
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    self.close()
+
+  def close(self) -> None:
+    with self._lock:
+      if self._index is not None:
+        self._index.close()
+        self._index = None
+
+  def object_path(self, digest: str) -> Path:
+    return self.store_dir / OBJECTS_DIR / digest[:2] / digest[2:]
+
+  def _makedirs(self, d: Path) -> None:
+    with self._lock:
+      if str(d) not in self._made:
+        os.makedirs(d, mode=0o700, exist_ok=True)
+        self._made.add(str(d))
+
+  def _entry(
+    self, p: Path, kind: TEntryKind, mode: int, object: Optional[str] = None, link: Optional[str] = None
+  ) -> IndexEntry:
+    return IndexEntry(
+      path=str(p), time=self.stamp, kind=kind, mode=mode, object=object, link=link, run=self.run
+    )
+
+  def _record(self, e: IndexEntry) -> None:
+    """append e to the index, and sync it, before returning"""
+    with self._lock:
+      if self._index is None:
+        os.makedirs(self.store_dir, mode=0o700, exist_ok=True)
+        self._index = open(self.store_dir / INDEX_NAME, 'a', encoding='utf8')
+      self._index.write(json.dumps(cattr.unstructure(e)) + '\n')
+      self._index.flush()
+      os.fsync(self._index.fileno())
+      if self._entries is not None:
+        self._entries.setdefault(e.path, []).append(e)
+
+  def _put_object(self, p: Path, obj: Path, link: bool) -> None:
+    """make obj a copy of p, a hard link to it if link is True, unless another file
+    already put it there
+    """
+    if link:
+      try:
+        os.link(p, obj)
+        return
+      except FileExistsError:
+        return
+      except OSError as e:
+        if e.errno not in _NO_LINK_ERRNOS:
+          raise
+
+    tmp = obj.with_name(f"{obj.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    try:
+      _copy_verified(p, tmp)
+      os.chmod(tmp, 0o444)
+      os.rename(tmp, obj)
+    except BaseException:
+      if os.path.lexists(tmp):
+        os.unlink(tmp)
+      raise
+
+  def _store_file(self, p: Path, st: os.stat_result) -> str:
+    digest = hash_file(p)
+    obj = self.object_path(digest)
+    if obj.exists():
+      log.debug(f"{p} is already stored as {digest}")
+    else:
+      self._makedirs(obj.parent)
+      # p's other names would go on changing the object, and the chmod below them
+      self._put_object(p, obj, link=st.st_nlink == 1)
+    mode = S_IMODE(st.st_mode)
+    self._record(self._entry(p, 'file', mode, object=digest))
+    os.unlink(p)
+    # not before p is gone, a hard linked object is still p too until then
+    os.chmod(obj, 0o444)
+    return digest
+
+  def backup(self, p: Path) -> None:
+    """move p, a file or a directory, into the store"""
+    st = os.lstat(p)
+    if S_ISDIR(st.st_mode):
+      for dirpath, dirnames, filenames in os.walk(p):
+        d = Path(dirpath)
+        self._backup_entry(d)
+        for name in filenames + [n for n in dirnames if os.path.islink(d / n)]:
+          self._backup_entry(d / name)
+      shutil.rmtree(p)
+    else:
+      self._backup_entry(p, st)
+
+  def _backup_entry(self, p: Path, st: Optional[os.stat_result] = None) -> None:
+    if st is None:
+      st = os.lstat(p)
+    mode = S_IMODE(st.st_mode)
+    if S_ISLNK(st.st_mode):
+      link = os.readlink(p)
+      self._record(self._entry(p, 'symlink', mode, link=link))
+    elif S_ISDIR(st.st_mode):
+      self._record(self._entry(p, 'dir', mode))
+    elif S_ISREG(st.st_mode):
+      self._store_file(p, st)
+    else:
+      log.warning(f"not backing up {p}, it's not a file, directory or symlink")
+
+  def strategy(self, p: Path) -> StoredBackup:
+    """a file strategy that backs up the conflicting p into this store. see
+    latest_under for getting it back
+    """
+    self.backup(p)
+    return StoredBackup(self.stamp)
+
+  def entries(self) -> Dict[str, List[IndexEntry]]:
+    """every backup in the index, by original path, oldest first"""
+    with self._lock:
+      if self._entries is None:
+        entries: Dict[str, List[IndexEntry]] = {}
+        try:
+          with open(self.store_dir / INDEX_NAME, encoding='utf8') as f:
+            for line in f:
+              e = cattr.structure(json.loads(line), IndexEntry)
+              entries.setdefault(e.path, []).append(e)
+        except FileNotFoundError:
+          pass
+        self._entries = entries
+      return self._entries
+
+  def lookup(self, path: Path, time: Optional[str] = None) -> Optional[IndexEntry]:
+    """the latest backup of path, or the latest made at or before time"""
+    found = None
+    for e in self.entries().get(str(path), []):
+      if time is None or e.time <= time:
+        found = e
+    return found
+
+  def under(self, path: Path) -> List[IndexEntry]:
+    """every backup of path, and of anything under it, by time then path"""
+    p = str(path)
+    under = [
+      e for k, es in self.entries().items() if k == p or k.startswith(p + '/') for e in es
+    ]
+    return sorted(under, key=lambda e: (e.time, Path(e.path).parts))
+
+  def latest_under(
+    self, path: Path, time: Optional[str] = None, run: Optional[str] = None
+  ) -> List[IndexEntry]:
+    """the entries of the latest backup of path, or the latest made at or before
+    time, or by run, if it was a file, or of everything under it, if it was a
+    directory
+    """
+    under = [
+      e for e in self.under(path)
+      if (time is None or e.time <= time) and (run is None or e.run == run)
+    ]
+    if not under:
+      return []
+    latest = under[-1].time
+    return [e for e in under if e.time == latest]
+
+  def restore(self, path: Path, entries: List[IndexEntry], to: Optional[Path] = None) -> Path:
+    """put path back as entries, from one backup of it (see latest_under), had it,
+    or at to. it's built under a temporary name next to where it goes and renamed
+    over whatever's there, which has to be a symlink, or nothing. objects are copied
+    (or reflinked) rather than hard linked, so editing a restored file can't change
+    the store
+    """
+    dest = path if to is None else to
+    if os.path.lexists(dest) and not os.path.islink(dest):
+      raise RestoreConflict(dest)
+    os.makedirs(dest.parent, exist_ok=True)
+
+    tmp_dir = Path(tempfile.mkdtemp(prefix=f".{dest.name}.", dir=dest.parent))
+    try:
+      built = tmp_dir / dest.name
+      dir_modes: List[Tuple[Path, int]] = []
+      for e in sorted(entries, key=lambda e: Path(e.path).parts):
+        to_path = built / Path(e.path).relative_to(path)
+        os.makedirs(to_path.parent, exist_ok=True)
+        if e.kind == 'dir':
+          os.makedirs(to_path, mode=0o700, exist_ok=True)
+          dir_modes.append((to_path, e.mode))
+        elif e.kind == 'symlink':
+          os.symlink(cast(str, e.link), to_path)
+        else:
+          copy_file(self.object_path(cast(str, e.object)), to_path)
+          os.chmod(to_path, e.mode)
+      # deepest first, a read only directory can't be filled in after. built's own
+      # mode waits for the rename, moving a directory needs write access to it
+      top_mode = None
+      for d, mode in reversed(dir_modes):
+        if d == built:
+          top_mode = mode
+        else:
+          os.chmod(d, mode)
+
+      if os.path.isdir(built) and os.path.islink(dest):
+        os.unlink(dest)
+      os.replace(built, dest)
+      if top_mode is not None:
+        os.chmod(dest, top_mode)
+    finally:
+      shutil.rmtree(tmp_dir, ignore_errors=True)
+    return dest
@@ -15,3 +15,24 @@ class SeparatedString(ParamType):
 
 
 PATHSEP_STRING = SeparatedString()
+
+
+class OctalMode(ParamType):
+  name = 'mode'
+
+  def convert(self, value: Any, param: ParamType, ctx: Any) -> int:
+    if isinstance(value, int):
+      return value
+    try:
+      mode = int(value, 8)
+    except ValueError:
+      self.fail(f"{value!r} is not an octal mode", param, ctx)
+    if not 0 <= mode <= 0o7777:
+      self.fail(f"{value!r} is not a valid mode", param, ctx)
+    return mode
+
+  def __repr__(self) -> str:
+    return "OCTAL_MODE"
+
+
+OCTAL_MODE = OctalMode()
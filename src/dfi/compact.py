@@ -0,0 +1,218 @@
+import os
+import sys
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from typing_extensions import Final
+
+from .dotfile import LinkData, RelativeDirs
+
+# values of LinkTable._rdir that aren't indexes into the dir table
+_ABSOLUTE: Final = -1   # the link data is the vpath
+
+
+def _join(d: str, name: str) -> str:
+  """join a dir and a name the same way str(Path(d) / name) would"""
+  if d == '.':
+    return name
+  elif d.endswith('/'):
+    return d + name
+  else:
+    return f"{d}/{name}"
+
+
+class LinkRow(NamedTuple):
+  """a single LinkTable entry as plain strings, suitable for passing to the os module"""
+  vpath: str
+  link_dir: str
+  link_name: str
+  link_data: str
+
+  @property
+  def link_path(self) -> str:
+    return _join(self.link_dir, self.link_name)
+
+  @classmethod
+  def for_link_data(cls, ld: LinkData) -> 'LinkRow':
+    return cls(
+      vpath=str(ld.vpath),
+      link_dir=str(ld.link_path.parent),
+      link_name=ld.link_path.name,
+      link_data=str(ld.link_data),
+    )
+
+  def to_link_data(self) -> LinkData:
+    return LinkData(
+      vpath=Path(self.vpath), link_path=Path(self.link_path), link_data=Path(self.link_data)
+    )
+
+
+class LinkTable:
+  """an append-only, columnar store of LinkData for plans with very many links
+
+  every directory (vpath parents, link dirs and relative link data dirs) is interned
+  once in a table and rows refer to it by index from an array. the vpath and link names
+  are stored as os.fsencode'd bytes back to back in one buffer. no Path objects are
+  held, they're only made when a LinkData is asked for.
+  """
+  __slots__ = ('_dirs', '_dir_ids', '_vdir', '_ldir', '_rdir', '_names', '_offsets')
+
+  def __init__(self) -> None:
+    self._dirs: List[str] = []
+    self._dir_ids: Dict[str, int] = {}
+    self._vdir = array('l')
+    self._ldir = array('l')
+    # an index into _dirs to which the vpath name is appended, or _ABSOLUTE, or for
+    # link data that isn't a dir + the vpath name, -2 - the index of the whole thing
+    self._rdir = array('l')
+    # each row has two names, vpath then link, so row n's are at offsets 2n .. 2n+2
+    self._names = bytearray()
+    self._offsets = array('Q', [0])
+
+  def _intern(self, d: str) -> int:
+    i = self._dir_ids.get(d)
+    if i is None:
+      i = self._dir_ids[d] = len(self._dirs)
+      self._dirs.append(d)
+    return i
+
+  def _add_name(self, name: str) -> None:
+    self._names += os.fsencode(name)
+    self._offsets.append(len(self._names))
+
+  def _name(self, n: int) -> str:
+    return os.fsdecode(bytes(self._names[self._offsets[n]:self._offsets[n + 1]]))
+
+  def append(
+    self, vdir: str, vname: str, link_dir: str, link_name: str, rel_dir: Optional[str]
+  ) -> None:
+    """add a row whose link data is rel_dir / vname, or the vpath if rel_dir is None"""
+    self._vdir.append(self._intern(vdir))
+    self._ldir.append(self._intern(link_dir))
+    self._rdir.append(_ABSOLUTE if rel_dir is None else self._intern(rel_dir))
+    self._add_name(vname)
+    self._add_name(link_name)
+
+  def append_link_data(self, ld: LinkData) -> None:
+    vdir, vname = str(ld.vpath.parent), ld.vpath.name
+    self.append(vdir, vname, str(ld.link_path.parent), ld.link_path.name, None)
+    if ld.link_data != ld.vpath:
+      if ld.link_data.name == vname and ld.link_data.parent != ld.link_data:
+        self._rdir[-1] = self._intern(str(ld.link_data.parent))
+      else:
+        self._rdir[-1] = -2 - self._intern(str(ld.link_data))
+
+  def append_vpaths(
+    self, entries: Iterable[Tuple[Path, str]], target_dir: Path, prefix: str = ''
+  ) -> None:
+    """add a row for each (parent, name) vpath in entries, the same as appending
+    LinkData.for_paths, without making a Path for every vpath
+    """
+    rels = RelativeDirs(target_dir, prefix)
+    link_dir = str(target_dir)
+    rel_strs: Dict[Path, str] = {}
+
+    for parent, vname in entries:
+      ok, rel = rels.get(parent, vname)
+      if not ok:
+        self.append_link_data(LinkData.for_path(parent / vname, target_dir, prefix))
+        continue
+
+      rel_dir = None
+      if rel is not None:
+        rel_dir = rel_strs.get(rel)
+        if rel_dir is None:
+          rel_dir = rel_strs[rel] = str(rel)
+      self.append(str(parent), vname, link_dir, prefix + vname, rel_dir)
+
+  @classmethod
+  def from_link_data(cls, lds: Iterable[LinkData]) -> 'LinkTable':
+    table = cls()
+    for ld in lds:
+      table.append_link_data(ld)
+    return table
+
+  def __len__(self) -> int:
+    return len(self._vdir)
+
+  def row(self, n: int) -> LinkRow:
+    vname = self._name(2 * n)
+    vpath = _join(self._dirs[self._vdir[n]], vname)
+    r = self._rdir[n]
+    if r == _ABSOLUTE:
+      link_data = vpath
+    elif r < 0:
+      link_data = self._dirs[-2 - r]
+    else:
+      link_data = _join(self._dirs[r], vname)
+    return LinkRow(
+      vpath=vpath,
+      link_dir=self._dirs[self._ldir[n]],
+      link_name=self._name(2 * n + 1),
+      link_data=link_data,
+    )
+
+  def vpath(self, n: int) -> str:
+    return _join(self._dirs[self._vdir[n]], self._name(2 * n))
+
+  def link_dir(self, n: int) -> str:
+    return self._dirs[self._ldir[n]]
+
+  def link_name(self, n: int) -> str:
+    return self._name(2 * n + 1)
+
+  def first_by_link_name(self) -> List[int]:
+    """the number of the first row for each link name, sorted by link name. that's
+    the rows FileGroup.link_data keeps, when the rows are in vpath order
+    """
+    first: Dict[str, int] = {}
+    for n in range(len(self)):
+      first.setdefault(self.link_name(n), n)
+    return [n for _, n in sorted(first.items())]
+
+  def select(self, rows: Iterable[int], table: Optional['LinkTable'] = None) -> 'LinkTable':
+    """rows of this table, in the order given, appended to table (or a new one). the
+    names are copied as they're stored and the dirs are shared, nothing is decoded
+    """
+    table = LinkTable() if table is None else table
+    dirs = self._dirs
+    for n in rows:
+      table._vdir.append(table._intern(dirs[self._vdir[n]]))
+      table._ldir.append(table._intern(dirs[self._ldir[n]]))
+      r = self._rdir[n]
+      if r == _ABSOLUTE:
+        table._rdir.append(_ABSOLUTE)
+      elif r < 0:
+        table._rdir.append(-2 - table._intern(dirs[-2 - r]))
+      else:
+        table._rdir.append(table._intern(dirs[r]))
+      for i in (2 * n, 2 * n + 1):
+        table._names += self._names[self._offsets[i]:self._offsets[i + 1]]
+        table._offsets.append(len(table._names))
+    return table
+
+  def link_dirs(self) -> Set[str]:
+    """the distinct directories links are made in"""
+    return {self._dirs[i] for i in set(self._ldir)}
+
+  def rows(self) -> Iterator[LinkRow]:
+    return (self.row(n) for n in range(len(self)))
+
+  def __getitem__(self, n: int) -> LinkData:
+    if n < 0:
+      n += len(self)
+    if not 0 <= n < len(self):
+      raise IndexError(n)
+    return self.row(n).to_link_data()
+
+  def __iter__(self) -> Iterator[LinkData]:
+    return (row.to_link_data() for row in self.rows())
+
+  def sizeof(self) -> int:
+    """approximately how many bytes this table holds on to"""
+    return (
+      sum(sys.getsizeof(x) for x in [self._vdir, self._ldir, self._rdir, self._names, self._offsets])
+      + sys.getsizeof(self._dirs) + sys.getsizeof(self._dir_ids)
+      + sum(sys.getsizeof(d) for d in self._dirs)
+    )
@@ -1,7 +1,9 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from itertools import chain
 from pathlib import Path
-from typing import (Any, Callable, Dict, Iterable, List, Optional, Type, TypeVar, cast)
+from typing import (Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple, Type, TypeVar, cast)
 
 from more_itertools import collapse
 
@@ -9,17 +11,24 @@ import attr
 import cattr
 from typing_extensions import Final, Literal
 
-from . import dotfile
+from . import dotfile, gitindex
 from .backports import cached_property
+from .compact import LinkTable
 from .dotfile import LinkData
+from .gitindex import TrackedTree
 
 TFileStrategy = Literal['backup', 'delete', 'warn', 'fail']
 TSymlinkStrategy = Literal['replace', 'warn', 'fail']
+TSource = Literal['filesystem', 'git-index']
 
 VALID_FILE_STRATEGIES: Final[List[TFileStrategy]] = ['backup', 'delete', 'warn', 'fail']
 VALID_SYMLINK_STRATEGIES: Final[List[TSymlinkStrategy]] = ['replace', 'warn', 'fail']
+VALID_SOURCES: Final[List[TSource]] = ['filesystem', 'git-index']
+
+log = logging.getLogger(__name__)
 
 T = TypeVar('T')
+U = TypeVar('U')
 
 
 def _literal_value_assertion(valid: List[T], obj: Any) -> T:
@@ -37,9 +46,23 @@ def symlink_strategy_validator(any: Any) -> TSymlinkStrategy:
   return _literal_value_assertion(VALID_SYMLINK_STRATEGIES, any)
 
 
+def source_validator(any: Any) -> TSource:
+  return _literal_value_assertion(VALID_SOURCES, any)
+
+
 DEFAULT_EXCLUDES: Final[List[str]] = ['.*']
 
 
+def dedup_link_data(lds: Iterable[LinkData]) -> List[LinkData]:
+  """the first of lds for each link name, sorted by link name"""
+  d: Dict[str, LinkData] = {}
+  for ld in lds:
+    if ld.link_path.name not in d:
+      d[ld.link_path.name] = ld
+
+  return [v for k, v in sorted(d.items())]
+
+
 @attr.s(frozen=True, slots=True, auto_attribs=True)
 class FileGroup:
   # the version-controlled directory that contains the files-to-symlink
@@ -60,6 +83,17 @@ class FileGroup:
   # the prefix to use for the link path (i.e. '.')
   link_prefix: str = attr.ib(default='')
 
+  # identifies this group in Settings.groups and in reports (i.e. 'systemd')
+  name: str = attr.ib(default='')
+
+  # where dirs are listed and globs matched: 'filesystem', or 'git-index' for only
+  # the files tracked in the git checkout base_dir is in, see gitindex
+  source: str = attr.ib(default='filesystem')
+
+  @source.validator
+  def __source_validator(self, _ignored: 'attr.Attribute[str]', value: str) -> None:
+    source_validator(value)
+
   @globs.validator
   def __glob_validator(
     self, _ignored: 'attr.Attribute[FileGroup]', value: Optional[List[str]]
@@ -75,11 +109,26 @@ class FileGroup:
     """return a collection of absolute source paths to be symlinked
     collects from both dirs and globs and applies the excludes before returning
     """
-    return dotfile.collect(self.base_dir, self.dirs, self.globs, self.excludes)
+    return self.collect()
+
+  def collect(self, counter: Optional[dotfile.SyscallCounter] = None) -> List[Path]:
+    """vpaths, tallying the syscalls made in counter if given"""
+    return dotfile.collect(
+      self.base_dir, self.dirs, self.globs, self.excludes, counter, self.tracked(counter)
+    )
+
+  def tracked(self, counter: Optional[dotfile.SyscallCounter] = None) -> Optional[TrackedTree]:
+    """the tracked files to collect from, or None to collect from the filesystem"""
+    if self.source != 'git-index':
+      return None
+    tree = gitindex.tracked(self.base_dir, counter)
+    if tree is None:
+      log.warning(f"collecting from the filesystem under {self.base_dir} instead")
+    return tree
 
   @property
   def _link_data_raw(self) -> List[LinkData]:
-    return [LinkData.for_path(vpath, self.target_dir, self.link_prefix) for vpath in self.vpaths]
+    return list(LinkData.for_paths(self.vpaths, self.target_dir, self.link_prefix))
 
   @property
   def link_data(self) -> List[LinkData]:
@@ -87,12 +136,60 @@ class FileGroup:
 
     The first entry in _link_data_raw wins based on link_path name
     """
-    d: Dict[str, LinkData] = {}
-    for ld in self._link_data_raw:
-      if ld.link_path.name not in d:
-        d[ld.link_path.name] = ld
+    return self.link_data_for(self.vpaths)
+
+  def link_data_for(self, vpaths: Iterable[Path]) -> List[LinkData]:
+    """link_data for an already collected, sorted list of vpaths"""
+    return dedup_link_data(LinkData.for_paths(vpaths, self.target_dir, self.link_prefix))
 
-    return [v for k, v in sorted(d.items())]
+  def link_table(self, table: Optional[LinkTable] = None) -> LinkTable:
+    """the same links as link_data, in the same order, appended to a compact LinkTable
+    (or a new one) without making Path objects for them
+    """
+    raw = self.raw_link_table()
+    return raw.select(raw.first_by_link_name(), table)
+
+  def raw_link_table(
+    self,
+    counter: Optional[dotfile.SyscallCounter] = None,
+    entries: Optional[Iterable[dotfile.Entry]] = None,
+  ) -> LinkTable:
+    """a LinkTable of the link for every vpath, in vpath order, before duplicate link
+    names are dropped. entries are what's collected, if they've been collected already
+    """
+    if entries is None:
+      entries = self.iter_collect_entries(counter)
+    table = LinkTable()
+    table.append_vpaths(
+      ((parent, name) for _, parent, name in entries), self.target_dir, self.link_prefix
+    )
+    return table
+
+  def iter_collect_entries(
+    self, counter: Optional[dotfile.SyscallCounter] = None
+  ) -> Iterator[dotfile.Entry]:
+    return dotfile.iter_collect_entries(
+      self.base_dir, self.dirs, self.globs, self.excludes, counter, self.tracked(counter)
+    )
+
+  def iter_vpaths(self) -> Iterator[Path]:
+    """streaming version of vpaths, yields the source paths in the same order"""
+    return dotfile.iter_collect(
+      self.base_dir, self.dirs, self.globs, self.excludes, tracked=self.tracked()
+    )
+
+  def iter_link_data(self) -> Iterator[LinkData]:
+    """streaming version of link_data
+
+    the same entries win as in link_data (the first by vpath order), but they're
+    yielded in vpath order as they're found rather than sorted by link name. only
+    the link names seen so far are held in memory.
+    """
+    seen: Set[str] = set()
+    for ld in LinkData.for_paths(self.iter_vpaths(), self.target_dir, self.link_prefix):
+      if ld.link_path.name not in seen:
+        seen.add(ld.link_path.name)
+        yield ld
 
   @classmethod
   def _defaults(
@@ -133,6 +230,31 @@ class EmptyFileGroup(FileGroup):
   def vpaths(self) -> List[Path]:
     return []
 
+  def collect(self, counter: Optional[dotfile.SyscallCounter] = None) -> List[Path]:
+    return []
+
+  def iter_vpaths(self) -> Iterator[Path]:
+    return iter([])
+
+  def iter_collect_entries(
+    self, counter: Optional[dotfile.SyscallCounter] = None
+  ) -> Iterator[dotfile.Entry]:
+    return iter([])
+
+
+def map_file_groups(fn: Callable[[U], T], items: List[U], jobs: Optional[int] = None) -> List[T]:
+  """returns [fn(x) for x in items], calling fn for each item concurrently on a thread
+  pool of up to jobs threads (the ThreadPoolExecutor default if None).
+
+  items are file groups (or stand-ins for them). each group scans its own directory
+  trees, so the time is mostly spent waiting on the filesystem rather than holding
+  the GIL.
+  """
+  if len(items) <= 1 or jobs == 1:
+    return [fn(x) for x in items]
+  with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='dfi-plan') as ex:
+    return list(ex.map(fn, items))
+
 
 @attr.s(auto_attribs=True)
 class Settings:
@@ -141,12 +263,35 @@ class Settings:
   base_dir: Path
   """the directory containing all of the files in this collection"""
 
-  dotfiles_file_group: FileGroup
-  binfiles_file_group: FileGroup
+  dotfiles_file_group: Optional[FileGroup] = attr.ib(default=None)
+  binfiles_file_group: Optional[FileGroup] = attr.ib(default=None)
 
   conflicting_file_strategy: str = attr.ib(default='backup')
   conflicting_symlink_strategy: str = attr.ib(default='replace')
   create_missing_target_dirs: bool = attr.ib(default=True)
+  """if False, a target dir that doesn't exist is an error rather than being made"""
+
+  target_dir_mode: int = attr.ib(default=0o755)
+  """the mode missing target dirs, and their missing parents, are made with"""
+
+  groups: List[FileGroup] = attr.ib(factory=list)
+  """any number of additional groups, planned after the binfiles and dotfiles groups"""
+
+  backup_dir: Optional[Path] = attr.ib(default=None)
+  """if set, the 'backup' strategy moves conflicting files into a single directory
+  per run under here, rather than renaming them next to where they were"""
+
+  journal: Optional[Path] = attr.ib(default=None)
+  """if set, every change a run makes is recorded in this file first, so the run can
+  be rolled back or resumed. see journal.Journal"""
+
+  backup_store: Optional[Path] = attr.ib(default=None)
+  """if set, the 'backup' strategy moves conflicting files into a content addressed
+  backup.ObjectStore here, i.e. ~/.local/state/dfi. can't be used with backup_dir"""
+
+  state_file: Optional[Path] = attr.ib(default=None)
+  """if set, a fingerprint of the run is saved here after it succeeds, and the next
+  run stops straight away if the fingerprint hasn't changed. see state.Fingerprint"""
 
   @conflicting_file_strategy.validator
   def __validate_cfs(self, _ignore: 'attr.Attribute[str]', value: str) -> None:
@@ -156,6 +301,18 @@ class Settings:
   def __validate_css(self, _ignore: 'attr.Attribute[str]', value: str) -> None:
     symlink_strategy_validator(value)
 
+  @backup_store.validator
+  def __validate_backup_store(self, _ignore: 'attr.Attribute[Optional[Path]]', value: Optional[Path]) -> None:
+    if value is not None and self.backup_dir is not None:
+      raise ValueError("only one of backup_dir and backup_store can be set")
+
+  @groups.validator
+  def __validate_groups(self, _ignore: 'attr.Attribute[List[FileGroup]]', value: List[FileGroup]) -> None:
+    names = [n for n, _ in self.named_file_groups]
+    dupes = sorted(set(n for n in names if names.count(n) > 1))
+    if dupes:
+      raise ValueError(f"file group names must be unique, found duplicates: {dupes!r}")
+
   @classmethod
   def mk_default(cls, base_dir: Path) -> 'Settings':
     return cls(
@@ -166,15 +323,42 @@ class Settings:
 
   @property
   def vpaths(self) -> List[Path]:
-    return list(chain(self.binfiles_file_group.vpaths, self.dotfiles_file_group.vpaths))
+    return list(chain.from_iterable(map_file_groups(lambda fg: fg.vpaths, self.file_groups)))
 
   @property
   def link_data(self) -> List[LinkData]:
-    return list(collapse((fg.link_data for fg in self.file_groups), base_type=LinkData))
+    lds = map_file_groups(lambda fg: fg.link_data, self.file_groups)
+    return list(collapse(lds, base_type=LinkData))
+
+  def link_table(self) -> LinkTable:
+    """a compact LinkTable of the same links as link_data, in the same order"""
+    raws = map_file_groups(lambda fg: fg.raw_link_table(), self.file_groups)
+    table = LinkTable()
+    for raw in raws:
+      raw.select(raw.first_by_link_name(), table)
+    return table
+
+  def iter_link_data(self) -> Iterator[LinkData]:
+    """streaming version of link_data, each group is collected as it is consumed"""
+    return chain.from_iterable(fg.iter_link_data() for fg in self.file_groups)
 
   @property
   def file_groups(self) -> List[FileGroup]:
-    return [self.binfiles_file_group, self.dotfiles_file_group]
+    """every group in the order they're planned: binfiles, dotfiles, then groups"""
+    return [fg for _, fg in self.named_file_groups]
+
+  @property
+  def named_file_groups(self) -> List[Tuple[str, FileGroup]]:
+    """(name, group) for each of file_groups. groups without a name are named for
+    their position in groups.
+    """
+    named: List[Tuple[str, FileGroup]] = []
+    if self.binfiles_file_group is not None:
+      named.append(('binfiles', self.binfiles_file_group))
+    if self.dotfiles_file_group is not None:
+      named.append(('dotfiles', self.dotfiles_file_group))
+    named.extend((fg.name or f"group{n}", fg) for n, fg in enumerate(self.groups))
+    return named
 
 
 ## register necessary serde with cattr
@@ -1,13 +1,24 @@
+import errno
+import heapq
 import logging
+import os
+import stat
 from functools import partial
 from itertools import chain, filterfalse
-from pathlib import Path
-from typing import Callable, Iterable, List, Optional, TypeVar, cast
+from pathlib import Path, PurePath
+from typing import (
+  TYPE_CHECKING, Callable, Counter, Dict, Iterable, Iterator, List, Optional, Set, Tuple, TypeVar, cast
+)
 from typing_extensions import Final
 
 import attr
 from more_itertools import collapse
 
+from .match import GlobSet, GlobState, PathMatcher, compilable_glob, has_magic
+
+if TYPE_CHECKING:
+  from .gitindex import TrackedTree
+
 log = logging.getLogger(__name__)
 
 
@@ -46,32 +57,413 @@ class LinkData:
       # otherwise, without a common root, we just use the abspath
       return cls(vpath=vpath, link_path=link_path, link_data=vpath)
 
+  @classmethod
+  def for_paths(
+    cls, vpaths: Iterable[Path], target_dir: Path, prefix: str = ''
+  ) -> Iterator['LinkData']:
+    """the same as calling for_path on each of vpaths, but the relative path from
+    target_dir to each distinct parent directory of vpaths is only worked out once.
+    """
+    rels = RelativeDirs(target_dir, prefix)
+    for vpath in vpaths:
+      ok, rel = rels.get(vpath.parent, vpath.name)
+      if not ok:
+        yield cls.for_path(vpath, target_dir, prefix)
+      else:
+        yield cls(
+          vpath=vpath,
+          link_path=target_dir / (prefix + vpath.name),
+          link_data=vpath if rel is None else rel / vpath.name,
+        )
 
 
-# %%
-def collect(
+class RelativeDirs:
+  """caches the relative path from a target dir to each distinct vpath parent dir"""
+  __slots__ = ('target_dir', 'prefix', '_cache')
+
+  def __init__(self, target_dir: Path, prefix: str = '') -> None:
+    _assert_is_absolute(target_dir)
+    self.target_dir = target_dir
+    self.prefix = prefix
+    # parent -> (relative dir, the name of the child of parent that is an ancestor
+    # of target_dir, the name of the child of target_dir that is an ancestor of parent)
+    self._cache: Dict[Path, Tuple[Optional[Path], Optional[str], Optional[str]]] = {}
+
+  def _compute(self, parent: Path) -> Tuple[Optional[Path], Optional[str], Optional[str]]:
+    tparts, pparts = self.target_dir.parts, parent.parts
+    above = under = None
+    if len(pparts) < len(tparts) and tparts[:len(pparts)] == pparts:
+      above = tparts[len(pparts)]
+    elif len(pparts) > len(tparts) and pparts[:len(tparts)] == tparts:
+      under = pparts[len(tparts)]
+    return _relative_dir(parent, self.target_dir), above, under
+
+  def get(self, parent: Path, vname: str) -> Tuple[bool, Optional[Path]]:
+    """returns (True, rel) where rel / vname is the link data for the vpath parent / vname,
+    or rel is None if the absolute vpath should be used.
+
+    returns (False, None) when the vpath is the link itself, or is above or below
+    it. LinkData.for_path gives those a '.'-relative path that can't be cached.
+    """
+    hit = self._cache.get(parent)
+    if hit is None:
+      hit = self._cache[parent] = self._compute(parent)
+    rel, above, under = hit
+    lname = self.prefix + vname
+    if vname == above or lname == under or (lname == vname and parent == self.target_dir):
+      return False, None
+    return True, rel
+
+
+# a tally of filesystem syscalls keyed by name (i.e. 'scandir', 'stat')
+SyscallCounter = Counter[str]
+
+# errnos that Path.exists() treats as "does not exist" rather than raising
+_IGNORED_ERRNOS: Final = frozenset([errno.ENOENT, errno.ENOTDIR, errno.EBADF, errno.ELOOP])
+
+
+def count_syscall(counter: Optional[SyscallCounter], syscall: str, n: int = 1) -> None:
+  if counter is not None:
+    counter[syscall] += n
+
+
+def _scan_dir(
+  d: Path, exclude: PathMatcher, counter: Optional[SyscallCounter] = None
+) -> List[str]:
+  """returns the sorted names of the members of d that exist and aren't excluded,
+  using the DirEntry type info from scandir
+
+  regular files and directories need no further syscalls. symlinks are stat'd once
+  (following the link) so that broken or looping links can be dropped, which is
+  what the previous iterdir() + exists() pair did for every entry.
+  """
+  dparts = d.parts
+  names: List[str] = []
+  count_syscall(counter, 'scandir')
+  with os.scandir(d) as it:
+    for entry in it:
+      if exclude.match_parts(dparts + (entry.name,)):
+        continue
+      if entry.is_symlink():
+        count_syscall(counter, 'stat')
+        try:
+          entry.stat()
+        except OSError as e:
+          if e.errno not in _IGNORED_ERRNOS:
+            raise
+          log.debug(f"skipping broken symlink {entry.path}")
+          continue
+      names.append(entry.name)
+  names.sort()
+  return names
+
+
+# (the parts of the whole path to sort by, the parent dir, the name)
+Entry = Tuple[Tuple[str, ...], Path, str]
+
+
+def _iter_dir(
+  d: Path, exclude: PathMatcher, counter: Optional[SyscallCounter] = None
+) -> Iterator[Entry]:
+  # only the names are held while we wait to be merged
+  dparts = d.parts
+  for name in _scan_dir(d, exclude, counter):
+    yield dparts + (name,), d, name
+
+
+class _Dirent:
+  """a scandir entry that a GlobSet is matched against, stat'd only if it has to be,
+  and at most once
+  """
+  __slots__ = ('entry', 'counter', '_statted', '_is_dir')
+
+  def __init__(self, entry: 'os.DirEntry[str]', counter: Optional[SyscallCounter]) -> None:
+    self.entry = entry
+    self.counter = counter
+    self._statted = False
+    self._is_dir: Optional[bool] = None
+
+  def _target_is_dir(self) -> Optional[bool]:
+    """whether the entry is a dir, following symlinks, or None if it's a broken one"""
+    if not self.entry.is_symlink():
+      return self.entry.is_dir(follow_symlinks=False)
+    if not self._statted:
+      self._statted = True
+      count_syscall(self.counter, 'stat')
+      try:
+        self._is_dir = stat.S_ISDIR(self.entry.stat().st_mode)
+      except OSError as e:
+        if e.errno not in _IGNORED_ERRNOS:
+          raise
+    return self._is_dir
+
+  def is_dir(self) -> bool:
+    return bool(self._target_is_dir())
+
+  def is_real_dir(self) -> bool:
+    return self.entry.is_dir(follow_symlinks=False)
+
+  def exists(self) -> bool:
+    return self._target_is_dir() is not None
+
+
+def _stat_is_dir(p: Path, counter: Optional[SyscallCounter]) -> Optional[bool]:
+  """whether p is a dir, following symlinks, or None if it doesn't exist"""
+  count_syscall(counter, 'stat')
+  try:
+    return stat.S_ISDIR(os.stat(p).st_mode)
+  except OSError as e:
+    if e.errno not in _IGNORED_ERRNOS:
+      raise
+    return None
+
+
+def glob_walk(
+  base_dir: Path,
+  globs: List[str],
+  excludes: Optional[List[str]] = None,
+  counter: Optional[SyscallCounter] = None,
+) -> Iterator[Tuple[int, Path]]:
+  """(i, path) for each path that base_dir.glob(globs[i]) yields that exists and
+  doesn't match excludes, sorted by path, found in a single walk of base_dir. see
+  match.GlobSet
+
+  a dir is only listed if some glob can still match something in it that wouldn't
+  be excluded, and not at all if every glob that gets to it is after a name with no
+  wildcards, which is looked up directly, as Path.glob does. dirs are walked in
+  order, so only the listings of the dirs on the way to the one being walked are
+  held, not every match.
+  """
+  excludes = excludes if excludes is not None else []
+  exclude = PathMatcher.compile(excludes)
+
+  compiled = [i for i, g in enumerate(globs) if compilable_glob(g)]
+  # whatever Path.glob makes of the rest, which may be to raise. they're unusual
+  # enough to just be sorted
+  others = [
+    [(i, x) for x in sorted(base_dir.glob(g), key=lambda x: x.parts)
+     if not exclude.match(x) and _stat_is_dir(x, counter) is not None]
+    for i, g in enumerate(globs) if i not in compiled
+  ]
+  gs = GlobSet.compile([globs[i] for i in compiled], excludes)
+
+  walked: Iterator[Tuple[int, Path]] = iter(())
+  initial = gs.initial()
+  # a missing base_dir is found out when it's listed, unless a glob yields it first
+  if compiled and not (any(map(gs.is_done, initial)) and not _stat_is_dir(base_dir, counter)):
+    walked = _glob_walk_sorted(base_dir, initial, gs, compiled, exclude, counter)
+  if not others:
+    return walked
+  return heapq.merge(walked, *others, key=lambda m: m[1].parts)
+
+
+def _glob_dir(
+  d: Path,
+  states: Set[GlobState],
+  gs: GlobSet,
+  exclude: PathMatcher,
+  counter: Optional[SyscallCounter],
+) -> Tuple[List[int], List[Tuple[str, List[int], Set[GlobState]]]]:
+  """the globs (by GlobSet index) that yield d itself, and for each of d's entries
+  that some glob yields or goes into, sorted by name, the globs that yield it and
+  the states to walk it with
+  """
+  dparts = d.parts
+  done: List[int] = []
+  live = set()
+  for s in states:
+    if gs.is_done(s):
+      # a glob ending in '**' yields every dir it gets to
+      if not exclude.match_parts(dparts):
+        done.append(s[0])
+    elif not gs.covered(s, dparts):
+      live.add(s)
+  entries: List[Tuple[str, List[int], Set[GlobState]]] = []
+  if not live:
+    return done, entries
+
+  names = {gs.literal(s) for s in live}
+  if None not in names:
+    for name in sorted(cast(Set[str], names)):
+      is_dir = _stat_is_dir(d / name, counter)
+      if is_dir is None:
+        continue
+      # a '**' never comes next here, so is_real_dir isn't needed
+      yields, nxt = gs.step(live, name, lambda: bool(is_dir), lambda: False)
+      if yields and exclude.match_parts(dparts + (name,)):
+        yields = []
+      if yields or nxt:
+        entries.append((name, yields, nxt))
+    return done, entries
+
+  count_syscall(counter, 'scandir')
+  try:
+    with os.scandir(d) as it:
+      dirents = sorted((_Dirent(entry, counter) for entry in it), key=lambda e: e.entry.name)
+  except (PermissionError, FileNotFoundError, NotADirectoryError):
+    # Path.glob skips dirs it can't list, and base_dir may not be one
+    return done, entries
+  for e in dirents:
+    name = e.entry.name
+    yields, nxt = gs.step(live, name, e.is_dir, e.is_real_dir)
+    if yields and (exclude.match_parts(dparts + (name,)) or not e.exists()):
+      yields = []
+    if yields or nxt:
+      entries.append((name, yields, nxt))
+  return done, entries
+
+
+def _glob_walk_sorted(
+  base_dir: Path,
+  initial: Set[GlobState],
+  gs: GlobSet,
+  compiled: List[int],
+  exclude: PathMatcher,
+  counter: Optional[SyscallCounter],
+) -> Iterator[Tuple[int, Path]]:
+  # a path's matches come before anything under it, and everything under it before
+  # its next sibling, which is the order of the paths' parts
+  done, entries = _glob_dir(base_dir, initial, gs, exclude, counter)
+  for n in done:
+    yield compiled[n], base_dir
+  stack = [(base_dir, iter(entries))]
+  while stack:
+    d, it = stack[-1]
+    entry = next(it, None)
+    if entry is None:
+      stack.pop()
+      continue
+    name, yields, nxt = entry
+    p = d / name
+    for n in yields:
+      yield compiled[n], p
+    if nxt:
+      done, sub = _glob_dir(p, nxt, gs, exclude, counter)
+      for n in done:
+        yield compiled[n], p
+      if sub:
+        stack.append((p, iter(sub)))
+
+
+def glob_dirs(base_dir: Path, pattern: str) -> List[Path]:
+  """the dirs whose entries base_dir.glob(pattern) depends on, base_dir and every
+  dir the pattern walks through before its last part
+  """
+  parts = PurePath(pattern).parts
+  level = [base_dir]
+  dirs = list(level)
+  for i, part in enumerate(parts):
+    last = i == len(parts) - 1
+    if part == '**':
+      level = [Path(root) for d in level for root, _, _ in os.walk(d)]
+    elif last:
+      break
+    elif has_magic(part):
+      level = [p for d in level for p in d.glob(part) if p.is_dir()]
+    else:
+      level = [d / part for d in level]
+    dirs.extend(level)
+  return list(dict.fromkeys(dirs))
+
+
+def _tracked_exists(p: Path, tracked: 'TrackedTree', counter: Optional[SyscallCounter]) -> bool:
+  """the same as exists for a tracked path, which can only be missing if it's a
+  broken or looping symlink, or on a work tree that isn't clean
+  """
+  if not tracked.is_symlink(p):
+    return True
+  count_syscall(counter, 'stat')
+  return p.exists()
+
+
+def _iter_tracked_dir(
+  d: Path, exclude: PathMatcher, tracked: 'TrackedTree', counter: Optional[SyscallCounter] = None
+) -> Iterator[Entry]:
+  dparts = d.parts
+  for name in tracked.members(d):
+    if not exclude.match_parts(dparts + (name,)) and _tracked_exists(d / name, tracked, counter):
+      yield dparts + (name,), d, name
+
+
+def _iter_tracked_glob(
+  base_dir: Path,
+  glob: str,
+  exclude: PathMatcher,
+  tracked: 'TrackedTree',
+  counter: Optional[SyscallCounter] = None,
+) -> Iterator[Entry]:
+  # already in order, so they're merged as they're found
+  for x in tracked.glob(base_dir, glob):
+    if not exclude.match(x) and _tracked_exists(x, tracked, counter):
+      yield x.parts, x.parent, x.name
+
+
+def iter_collect_entries(
   base_dir: Path,
   dirs: List[Path],
   globs: Optional[List[str]] = None,
-  excludes: Optional[List[str]] = None
-) -> List[Path]:
-  globs = globs if globs is not None else []
-  exc = excludes if excludes is not None else []
+  excludes: Optional[List[str]] = None,
+  counter: Optional[SyscallCounter] = None,
+  tracked: Optional['TrackedTree'] = None,
+) -> Iterator[Entry]:
+  """like iter_collect, but yields (sort key, parent, name) tuples so that callers that
+  don't need a Path for every entry don't have to make one.
+
+  if tracked is given, dirs are listed and globs matched from it rather than from
+  the filesystem, see gitindex.TrackedTree.
+  """
+  exclude = PathMatcher.compile(excludes if excludes is not None else [])
+
+  if tracked is not None:
+    sources = [_iter_tracked_dir(base_dir.joinpath(dfd), exclude, tracked, counter) for dfd in dirs]
+    sources.extend(_iter_tracked_glob(base_dir, g, exclude, tracked, counter) for g in (globs or []))
+    return heapq.merge(*sources)
+
+  # dirents in dotfile_dirs, the entries are known to exist
+  sources = [_iter_dir(base_dir.joinpath(dfd), exclude, counter) for dfd in dirs]
 
-  # collect dirents in dotfile_dirs
-  dirents = chain(x.iterdir() for x in (base_dir.joinpath(dfd) for dfd in dirs))
+  # globs relative to basedir in dotfiles, all matched in one walk of it, as it goes
+  if globs:
+    sources.append((x.parts, x.parent, x.name) for _, x in glob_walk(base_dir, globs, excludes, counter))
 
-  # collect globs relative to basedir in dotfiles
-  globbed = chain(base_dir.glob(g) for g in globs)
+  return heapq.merge(*sources)
+
+
+# %%
+def iter_collect(
+  base_dir: Path,
+  dirs: List[Path],
+  globs: Optional[List[str]] = None,
+  excludes: Optional[List[str]] = None,
+  counter: Optional[SyscallCounter] = None,
+  tracked: Optional['TrackedTree'] = None,
+) -> Iterator[Path]:
+  """yields the existing paths that are members of dirs or match globs, less any
+  that match excludes, in sorted order.
 
-  def any_excludes_match(p: Path) -> bool:
-    return any(p.match(x) for x in exc)
+  each dir and glob is sorted on its own and the results are lazily merged, so
+  only one directory listing's worth of names per source is held at a time rather
+  than the whole collection of Paths.
 
-  paths = collapse(chain(dirents, globbed), base_type=Path)
+  if counter is given, it is incremented with the number of each kind of filesystem
+  syscall made while collecting.
+  """
+  for _, parent, name in iter_collect_entries(base_dir, dirs, globs, excludes, counter, tracked):
+    yield parent / name
 
-  cleaned = [x for x in paths if not any_excludes_match(x) and x.exists()]
 
-  return sorted(cleaned)
+def collect(
+  base_dir: Path,
+  dirs: List[Path],
+  globs: Optional[List[str]] = None,
+  excludes: Optional[List[str]] = None,
+  counter: Optional[SyscallCounter] = None,
+  tracked: Optional['TrackedTree'] = None,
+) -> List[Path]:
+  """returns the sorted existing paths that are members of dirs or match globs,
+  less any that match excludes. see iter_collect.
+  """
+  return list(iter_collect(base_dir, dirs, globs, excludes, counter, tracked))
 
 
 _ROOT = Path('/')
@@ -82,12 +474,21 @@ def _assert_is_absolute(a: Path) -> None:
     raise ValueError(f"argument must be an absolute Path, got {a}")
 
 
+def _relative_dir(vdir: Path, link_dir: Path) -> Optional[Path]:
+  """returns the path to vdir relative to link_dir, or None if they only share '/'"""
+  common = find_common_root(vdir, link_dir)
+  if common is None:
+    return None
+  nup = len(link_dir.parts) - len(common.parts)
+  return Path(*['..' for n in range(0, nup)]) / vdir.relative_to(common)
+
+
 def find_common_root(a: Path, b: Path) -> Optional[Path]:
   _assert_is_absolute(a)
   _assert_is_absolute(b)
 
   while True:
-    log.debug(f"a: {a}, b: {b}")
+    log.debug("a: %s, b: %s", a, b)
     if a == _ROOT or b == _ROOT:
       return None
     elif a == b:
@@ -1,5 +1,5 @@
 import os
-from typing import Optional, Sequence, Any
+from typing import List, Optional, Sequence, Any
 from pathlib import Path
 from .dotfile import LinkData
 
@@ -34,3 +34,60 @@ class FatalConflict(DFIError):
   def __init__(self, path: Path, *a: Sequence[Any]) -> None:
     args = [f"Conflict at path {path} and 'fail' selected as resolution strategy", *a]
     super().__init__(*args)
+
+class InvalidPlanFile(DFIError):
+  """raised when a saved plan can't be read"""
+  def __init__(self, name: str, *a: Sequence[Any]) -> None:
+    args = [f"Could not read plan file {name}", *a]
+    super().__init__(*args)
+
+class ApplyFailed(DFIError):
+  """raised when links in more than one directory failed to apply concurrently"""
+  def __init__(self, errors: List[DFIError], *a: Sequence[Any]) -> None:
+    self.errors = errors
+    lines = '\n'.join(f"  {e}" for e in errors)
+    args = [f"{len(errors)} directories failed to apply:\n{lines}", *a]
+    super().__init__(*args)
+
+class LinkOutsideHome(DFIError):
+  """raised when a plan is fanned out to other homes but one of its link paths isn't
+  under the home it was made for
+  """
+  def __init__(self, link_path: Path, home: Path, *a: Sequence[Any]) -> None:
+    args = [f"Link path {link_path} is not under {home}, it can't be moved to another home", *a]
+    super().__init__(*args)
+
+class MissingTargetDirs(DFIError):
+  """raised when directories that links go in don't exist, and create_missing_target_dirs
+  is off
+  """
+  def __init__(self, dirs: List[str], *a: Sequence[Any]) -> None:
+    self.dirs = dirs
+    args = [
+      f"Target directories don't exist and create_missing_target_dirs is off: {', '.join(dirs)}", *a
+    ]
+    super().__init__(*args)
+
+class JournalError(DFIError):
+  """raised when a journal can't be used to roll back or resume a run"""
+  def __init__(self, path: Path, why: str, *a: Sequence[Any]) -> None:
+    args = [f"Can't use the journal {path}: {why}", *a]
+    super().__init__(*args)
+
+class UnreadableIndex(DFIError):
+  """raised when a git index is in a form that can't be read"""
+  def __init__(self, path: Path, why: str, *a: Sequence[Any]) -> None:
+    args = [f"Can't read the git index {path}: {why}", *a]
+    super().__init__(*args)
+
+class RestoreConflict(DFIError):
+  """raised when a backup would be restored over something that isn't a symlink"""
+  def __init__(self, path: Path, *a: Sequence[Any]) -> None:
+    args = [f"Won't restore over {path}, it's there and isn't a symlink", *a]
+    super().__init__(*args)
+
+class NeedsRoot(DFIError):
+  """raised when something has to be done as root, and we aren't"""
+  def __init__(self, what: str, *a: Sequence[Any]) -> None:
+    args = [f"{what} needs to be run as root", *a]
+    super().__init__(*args)
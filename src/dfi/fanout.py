@@ -0,0 +1,226 @@
+"""installing one plan into many home directories
+
+the repo is collected and planned once in the parent process. each home is then
+applied on a process pool, where the plan's link paths are rebased from the home
+it was made for onto the home being installed.
+"""
+import glob
+import logging
+import os
+import os.path as osp
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import attr
+
+from . import fs
+from .dotfile import LinkData, RelativeDirs
+from .exceptions import DFIError, LinkOutsideHome, NeedsRoot
+from .plan import Plan
+
+try:
+  import pwd
+except ImportError:  # pragma: no cover
+  pwd = None  # type: ignore
+
+log = logging.getLogger(__name__)
+
+
+def expand_homes(patterns: Iterable[str]) -> List[Path]:
+  """the directories matched by any of the glob patterns, sorted, without duplicates"""
+  homes = {
+    Path(osp.abspath(p)) for pattern in patterns for p in glob.iglob(pattern) if osp.isdir(p)
+  }
+  return sorted(homes)
+
+
+def rebase_link_data(
+  lds: Iterable[LinkData], from_home: Path, to_home: Path
+) -> Iterator[LinkData]:
+  """LinkData for the same vpaths as lds, with each link path moved from under
+  from_home to the same place under to_home and the link data worked out again,
+  just as LinkData.for_path would for the new location
+  """
+  rels: Dict[Tuple[Path, str], RelativeDirs] = {}
+  for ld in lds:
+    try:
+      link_path = to_home / ld.link_path.relative_to(from_home)
+    except ValueError:
+      raise LinkOutsideHome(ld.link_path, from_home) from None
+
+    vname = ld.vpath.name
+    # LinkData.for_path names links prefix + vpath.name
+    prefix = link_path.name[:len(link_path.name) - len(vname)]
+    target_dir = link_path.parent
+
+    r = rels.get((target_dir, prefix))
+    if r is None:
+      r = rels[(target_dir, prefix)] = RelativeDirs(target_dir, prefix)
+
+    ok, rel = r.get(ld.vpath.parent, vname)
+    if not ok:
+      yield LinkData.for_path(ld.vpath, target_dir, prefix)
+    else:
+      yield LinkData(vpath=ld.vpath, link_path=link_path, link_data=ld.vpath if rel is None else rel / vname)
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class HomeSummary:
+  """what happened when the plan was applied to one home"""
+  home: Path
+  outcomes: Dict[str, int]
+  # the error that stopped this home, if any
+  error: Optional[str]
+  seconds: float
+
+  @property
+  def ok(self) -> bool:
+    return self.error is None
+
+  def __str__(self) -> str:
+    counts = ' '.join(f"{k}={v}" for k, v in sorted(self.outcomes.items()))
+    status = 'ok' if self.ok else f"failed: {self.error}"
+    return f"{self.home}: {counts or 'nothing to do'} ({self.seconds:.2f}s) {status}"
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class _Job:
+  """everything a worker needs that is the same for every home"""
+  link_data: List[LinkData]
+  from_home: Path
+  conflicting_file_strategy: str
+  conflicting_symlink_strategy: str
+  create_missing_target_dirs: bool
+  target_dir_mode: int
+  verify: fs.TVerify
+  as_owner: bool
+  # under from_home, these are rebased onto each home like the links are
+  backup_dir: Optional[Path] = None
+  backup_store: Optional[Path] = None
+
+
+# set in each worker process by _init_worker, so the plan is only sent once per process
+_job: Optional[_Job] = None
+
+
+def _init_worker(job: _Job) -> None:
+  global _job
+  _job = job
+
+
+def _rebase(p: Optional[Path], from_home: Path, to_home: Path) -> Optional[Path]:
+  """p moved from under from_home to the same place under to_home, if it's there"""
+  if p is None:
+    return None
+  try:
+    return to_home / p.relative_to(from_home)
+  except ValueError:
+    return p
+
+
+def _owner_groups(uid: int, gid: int) -> List[int]:
+  """the groups a process acting as uid should have, uid's supplementary groups if
+  it has a passwd entry, or just gid
+  """
+  try:
+    name = pwd.getpwuid(uid).pw_name
+  except KeyError:
+    return [gid]
+  return os.getgrouplist(name, gid)
+
+
+def _apply_home(home: Path) -> HomeSummary:
+  job = _job
+  assert job is not None, "_init_worker wasn't called"
+
+  start = time.monotonic()
+  outcomes: fs.Outcomes = Counter()
+  error = None
+  uid, gid = os.geteuid(), os.getegid()
+  groups = os.getgroups() if job.as_owner else []
+  # how to go back to who we were, for each of the ids that's been changed
+  undo: List[Callable[[], None]] = []
+  try:
+    if job.as_owner:
+      st = os.stat(home)
+      # root's supplementary groups would still let us in where the owner can't go,
+      # and they and the group have to go first, we can't change them once we're
+      # not root
+      os.setgroups(_owner_groups(st.st_uid, st.st_gid))
+      undo.append(lambda: os.setgroups(groups))
+      os.setegid(st.st_gid)
+      undo.append(lambda: os.setegid(gid))
+      os.seteuid(st.st_uid)
+      undo.append(lambda: os.seteuid(uid))
+
+    strategies = fs._run_strategies(
+      job.conflicting_file_strategy,
+      job.conflicting_symlink_strategy,
+      _rebase(job.backup_dir, job.from_home, home),
+      _rebase(job.backup_store, job.from_home, home),
+    )
+    with strategies as (file_stgy, link_stgy):
+      outcomes = fs.apply_link_data(
+        list(rebase_link_data(job.link_data, job.from_home, home)),
+        job.create_missing_target_dirs,
+        file_stgy,
+        link_stgy,
+        verify=job.verify,
+        dir_mode=job.target_dir_mode,
+      )
+  except (DFIError, OSError) as e:
+    log.error(f"{home}: {e}")
+    error = str(e)
+  finally:
+    # workers are reused for other homes. the uid goes back first, we need to be
+    # root again to change the rest
+    for fn in reversed(undo):
+      fn()
+
+  return HomeSummary(
+    home=home, outcomes=dict(outcomes), error=error, seconds=time.monotonic() - start
+  )
+
+
+def fanout(
+  plan: Plan,
+  from_home: Path,
+  homes: List[Path],
+  processes: Optional[int] = None,
+  as_owner: bool = False,
+  verify: fs.TVerify = fs.DEFAULT_VERIFY,
+) -> List[HomeSummary]:
+  """apply plan, which was made for from_home, to each of homes on a pool of up to
+  processes worker processes (the ProcessPoolExecutor default if None)
+
+  if as_owner is True, each home is applied with the effective uid, gid and
+  supplementary groups of the home's owner, which needs us to be running as root.
+  a backup_dir or backup_store under from_home is used at the same place under
+  each home. a home that fails doesn't stop the others, its summary records the
+  error. summaries are returned in the same order as homes.
+  """
+  if as_owner and os.geteuid() != 0:
+    raise NeedsRoot("applying each home as its owner")
+  s = plan.settings
+  lds = plan.link_data
+  # find out about links that can't be rebased before starting on any home
+  for _ in rebase_link_data(lds, from_home, from_home):
+    pass
+
+  job = _Job(
+    link_data=lds,
+    from_home=from_home,
+    conflicting_file_strategy=s.conflicting_file_strategy,
+    conflicting_symlink_strategy=s.conflicting_symlink_strategy,
+    create_missing_target_dirs=s.create_missing_target_dirs,
+    target_dir_mode=s.target_dir_mode,
+    verify=verify,
+    as_owner=as_owner,
+    backup_dir=s.backup_dir,
+    backup_store=s.backup_store,
+  )
+  with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(job,)) as ex:
+    return list(ex.map(_apply_home, homes))
@@ -1,22 +1,38 @@
-from typing import List, Optional, Union, cast, Dict, Callable
+from typing import Any, Counter, Iterable, Iterator, List, Optional, Set, Tuple, Union, cast, Dict, Callable
 import sys
+import collections
 import os
 import os.path as osp
 from stat import *
 from pathlib import Path
 import json
 import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
 
-import arrow
-from .dotfile import LinkData
+from more_itertools import chunked
+from typing_extensions import Final, Literal
+from .backup import BackupRun, ObjectStore, TBackup, move, timestamp
+from .journal import Journal, RunHeader, last_run
+from .compact import LinkRow, LinkTable
+from .dotfile import LinkData, SyscallCounter, count_syscall
 from .config import Settings, TFileStrategy, TSymlinkStrategy, file_strategy_validator, symlink_strategy_validator
-from .exceptions import (BackupFailed, TooManySymbolicLinks, FatalConflict, FilesystemConflictError)
+from .plan import PLAN_FILE_VERSION, Plan, PlanFile, PlannedLink
+from .exceptions import (
+  ApplyFailed,
+  BackupFailed,
+  DFIError,
+  TooManySymbolicLinks,
+  FatalConflict,
+  FilesystemConflictError,
+  JournalError,
+  MissingTargetDirs,
+)
 
 log = logging.getLogger(__name__)
 
-_DATE_FORMAT_STR = 'YYYYMMDDHHmmss'
-
-
 class _skipConflictingEntry(Exception):
   pass
 
@@ -25,10 +41,6 @@ def skip_it() -> None:
   raise _skipConflictingEntry()
 
 
-def timestamp() -> str:
-  return cast(str, arrow.utcnow().format(_DATE_FORMAT_STR))
-
-
 def backup(p: Path) -> Optional[Path]:
   log.debug(f"handle rename for p: {p}, p.exists: {p.exists()}")
 
@@ -39,7 +51,7 @@ def backup(p: Path) -> Optional[Path]:
         log.debug(f"backup path {newp!s} existed, retrying")
         continue
       else:
-        p.rename(newp)
+        move(p, newp)
         return newp
     else:
       raise BackupFailed(p)
@@ -47,7 +59,7 @@ def backup(p: Path) -> Optional[Path]:
     return None
 
 
-def is_link(p: Path) -> Optional[bool]:
+def is_link(p: Union[str, Path]) -> Optional[bool]:
   try:
     s = os.lstat(p)
     return S_ISLNK(s.st_mode)
@@ -55,30 +67,37 @@ def is_link(p: Path) -> Optional[bool]:
     return None
 
 
-def chase_links(link: Path) -> Path:
+def chase_links(link: Path, counter: Optional[SyscallCounter] = None) -> Path:
   cur = link
   depth = 0
   while depth <= 50:
     depth += 1
+    count_syscall(counter, 'lstat')
     if not is_link(cur):
       return cur
+    count_syscall(counter, 'readlink')
     cur = Path(osp.normpath(osp.join(cur.parent, os.readlink(cur))))
   else:
     raise TooManySymbolicLinks(link, depth)
 
 
-def link_points_to(link: Path, target: Path) -> Optional[bool]:
+def link_points_to(link: Path, target: Path, expected: Optional[str] = None) -> Optional[bool]:
+  """True if link ends up at target. if the link's contents are exactly expected, that's
+  taken as a yes without following it
+  """
   try:
     data = os.readlink(link)
+    if expected is not None and data == expected:
+      return True
     return osp.samefile(chase_links(link), target)
   except FileNotFoundError:
     return None
 
 
-def backup_file_strategy(p: Path) -> None:
+def backup_file_strategy(p: Path) -> Optional[Path]:
   """when a link_path exists and is a file, this method moves it to a unique location"""
   log.debug(f"backup_file_strategy: {p}")
-  backup(p)
+  return backup(p)
 
 
 def delete_strategy(p: Path) -> None:
@@ -87,6 +106,14 @@ def delete_strategy(p: Path) -> None:
   p.unlink()
 
 
+def replace_strategy(p: Path) -> None:
+  """when a link_path exists and is a symlink, this method removes it so it can be
+  made again. _apply_link doesn't call this, it renames a new link over the old one
+  """
+  log.debug(f"replace_strategy: {p}")
+  p.unlink()
+
+
 def warn_strategy(p: Path) -> None:
   log.warning(f"File location {str(p)!r} already exists and 'warn' strategy selected, continuing.")
   skip_it()
@@ -96,7 +123,8 @@ def fail_strategy(p: Path) -> None:
   raise FatalConflict(p)
 
 
-StrategyFn = Callable[[Path], None]
+# a strategy may return where it moved the conflicting entry to
+StrategyFn = Callable[[Path], Optional[TBackup]]
 
 _FILE_STRATEGY_MAP: Dict[TFileStrategy, StrategyFn] = {
   'backup': backup_file_strategy,
@@ -106,65 +134,983 @@ _FILE_STRATEGY_MAP: Dict[TFileStrategy, StrategyFn] = {
 }
 
 _SYMLINK_STRATEGY_MAP: Dict[TSymlinkStrategy, StrategyFn] = {
-  'replace': delete_strategy,
+  'replace': replace_strategy,
   'warn': warn_strategy,
   'fail': fail_strategy,
 }
 
 
-def _apply_link_data(
-  ld: LinkData, create_missing: bool, file_stgy: StrategyFn, link_stgy: StrategyFn
-) -> None:
-  target, link_data, link_path = ld.vpath, ld.link_data, ld.link_path
+# how many temporary names LinkDir.replace_symlink tries before giving up
+_MAX_TMP_TRIES: Final = 100
+
+
+class LinkDir:
+  """operations on the entries of a single directory that link paths live in
+
+  this one works by joining each name onto the directory's path, see FdLinkDir.
+  if a counter is given, each call is tallied in it.
+  """
+  __slots__ = ('path', 'counter')
+
+  def __init__(self, path: str, counter: Optional[SyscallCounter] = None) -> None:
+    self.path = path
+    self.counter = counter
+
+  def __enter__(self) -> 'LinkDir':
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    self.close()
+
+  def close(self) -> None:
+    pass
+
+  def join(self, name: str) -> str:
+    return osp.join(self.path, name)
+
+  def lstat(self, name: str) -> Optional[os.stat_result]:
+    """lstat name, or None if it doesn't exist"""
+    count_syscall(self.counter, 'lstat')
+    try:
+      return os.lstat(self.join(name))
+    except FileNotFoundError:
+      return None
+
+  def readlink(self, name: str) -> str:
+    count_syscall(self.counter, 'readlink')
+    return os.readlink(self.join(name))
+
+  def symlink(self, link_data: str, name: str) -> None:
+    count_syscall(self.counter, 'symlink')
+    os.symlink(link_data, self.join(name))
+
+  def unlink(self, name: str) -> None:
+    count_syscall(self.counter, 'unlink')
+    os.unlink(self.join(name))
+
+  def rename(self, src: str, dst: str) -> None:
+    count_syscall(self.counter, 'rename')
+    os.rename(self.join(src), self.join(dst))
 
-  # TODO: make this a setting
-  if not link_path.parent.exists():
-    link_path.parent.mkdir(mode=0o755, parents=True, exist_ok=True)
+  def replace_symlink(self, link_data: str, name: str) -> None:
+    """atomically swap whatever is at name for a symlink to link_data, by making the
+    link under a temporary name and renaming it over name. there's never a moment
+    when name doesn't exist.
+    """
+    # unique between threads and processes, and hidden from most globs
+    base = f".{name}.dfi-{os.getpid()}-{threading.get_ident()}"
+    for n in range(_MAX_TMP_TRIES):
+      tmp = f"{base}-{n}"
+      try:
+        self.symlink(link_data, tmp)
+        break
+      except FileExistsError:  # left behind by something that died, try another
+        continue
+    else:
+      raise FileExistsError(f"couldn't find a free temporary name like {self.join(base)}")
+
+    try:
+      self.rename(tmp, name)
+    except BaseException:
+      self.unlink(tmp)
+      raise
+
+
+class FdLinkDir(LinkDir):
+  """a LinkDir that opens the directory once and uses the dir_fd= form of each
+  call, so the kernel doesn't resolve the directory's whole path for every link
+  """
+  __slots__ = ('fd',)
+
+  def __init__(self, path: str, counter: Optional[SyscallCounter] = None) -> None:
+    super().__init__(path, counter)
+    count_syscall(counter, 'open')
+    self.fd: Optional[int] = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+
+  def close(self) -> None:
+    if self.fd is not None:
+      count_syscall(self.counter, 'close')
+      os.close(self.fd)
+      self.fd = None
+
+  def lstat(self, name: str) -> Optional[os.stat_result]:
+    count_syscall(self.counter, 'lstat')
+    try:
+      return os.stat(name, dir_fd=self.fd, follow_symlinks=False)
+    except FileNotFoundError:
+      return None
+
+  def readlink(self, name: str) -> str:
+    count_syscall(self.counter, 'readlink')
+    return os.readlink(name, dir_fd=self.fd)
+
+  def symlink(self, link_data: str, name: str) -> None:
+    count_syscall(self.counter, 'symlink')
+    os.symlink(link_data, name, dir_fd=self.fd)
+
+  def unlink(self, name: str) -> None:
+    count_syscall(self.counter, 'unlink')
+    os.unlink(name, dir_fd=self.fd)
 
-  def fn() -> None:
-    # os.path.exists reports false for a broken symlink
-    if not os.path.exists(link_path) or is_link(link_path):
+  def rename(self, src: str, dst: str) -> None:
+    count_syscall(self.counter, 'rename')
+    os.rename(src, dst, src_dir_fd=self.fd, dst_dir_fd=self.fd)
 
-      if not is_link(link_path):
-        link_path.symlink_to(link_data)  # ok, we're clear, do it
-        return
 
-      log.debug(f"{link_path} is symlink")
+HAVE_DIR_FD: Final = (
+  hasattr(os, 'O_DIRECTORY')
+  and {os.stat, os.readlink, os.symlink, os.unlink, os.rename} <= os.supports_dir_fd
+  and os.stat in os.supports_follow_symlinks
+)
 
-      if link_points_to(link_path, target):
-        log.debug(f"{link_path} resolves to {target}")
-        return  # ok, we already did this, so skip it
+
+def _open_link_dir(path: str, dir_fd: bool, counter: Optional[SyscallCounter] = None) -> LinkDir:
+  return FdLinkDir(path, counter) if dir_fd else LinkDir(path, counter)
+
+
+# the mode target dirs are made with unless Settings.target_dir_mode says otherwise
+DEFAULT_DIR_MODE: Final = 0o755
+
+
+class TargetDirs:
+  """works out which of the directories links are made in are missing, and makes
+  them, remembering which directories are known to exist so each is only looked at
+  once. if create_missing is False, a missing directory is a MissingTargetDirs error.
+  """
+  __slots__ = ('create_missing', 'mode', 'counter', 'journal', '_present')
+
+  def __init__(
+    self,
+    create_missing: bool = True,
+    mode: int = DEFAULT_DIR_MODE,
+    counter: Optional[SyscallCounter] = None,
+    journal: Optional[Journal] = None,
+  ) -> None:
+    self.create_missing = create_missing
+    self.mode = mode
+    self.counter = counter
+    # if given, dirs are recorded here before they're made
+    self.journal = journal
+    self._present: Set[str] = set()
+
+  def missing(self, dirs: Iterable[str]) -> List[str]:
+    """the smallest set of directories that have to be made for all of dirs to exist,
+    parents before their children
+    """
+    out: List[str] = []
+    seen: Set[str] = set()
+    for d in sorted(set(dirs)):
+      chain: List[str] = []
+      cur = d
+      # walk up until we get to somewhere that exists, or that's already in out
+      while cur not in self._present and cur not in seen:
+        count_syscall(self.counter, 'stat')
+        if osp.isdir(cur):
+          self._present.add(cur)
+          break
+        chain.append(cur)
+        parent = osp.dirname(cur)
+        if parent == cur:
+          break
+        cur = parent
+      for c in reversed(chain):
+        seen.add(c)
+        out.append(c)
+    return out
+
+  def create(self, dirs: List[str]) -> None:
+    """make dirs, as returned by missing"""
+    if not dirs:
+      return
+    if not self.create_missing:
+      raise MissingTargetDirs(dirs)
+    if self.journal is not None:
+      self.journal.mkdirs(dirs)
+    for d in dirs:
+      count_syscall(self.counter, 'mkdir')
+      try:
+        os.mkdir(d, self.mode)
+      except FileExistsError:
+        if not osp.isdir(d):
+          raise
       else:
-        log.debug(f"{link_path} points to {os.readlink(link_path)}")
-        link_stgy(link_path)
-        return fn()  # recurse
+        # mkdir's mode is masked by the umask, the configured mode shouldn't be
+        os.chmod(d, self.mode)
+      log.debug(f"created target dir {d}")
+      self._present.add(d)
+
+  def ensure(self, dirs: Iterable[str]) -> None:
+    self.create(self.missing(dirs))
+
 
-    elif link_path.is_file() or link_path.is_dir():
-      file_stgy(link_path)
-      return fn()  # and recurse
+# what can be found at a link path
+TLinkState = Literal['missing', 'linked', 'symlink', 'file', 'dir', 'other']
 
-    else:  # what the what?
-      raise FilesystemConflictError(link_path, os.stat(link_path))
+# what _apply_link did about a link path
+TOutcome = Literal['created', 'unchanged', 'replaced', 'skipped']
 
+# a tally of TOutcomes
+Outcomes = Counter[str]
+
+# how to decide whether an existing symlink is the one we want.
+#   'readlink': if its contents are exactly the link data we'd write, it is. otherwise
+#               it is checked as for 'resolve'. this is the common case on a re-run.
+#   'resolve':  it is if following it ends up at the same file as the vpath
+TVerify = Literal['readlink', 'resolve']
+VALID_VERIFY_MODES: Final[List[TVerify]] = ['readlink', 'resolve']
+DEFAULT_VERIFY: Final[TVerify] = 'readlink'
+
+
+def _resolves_to(link_path: str, data: str, target: str, counter: Optional[SyscallCounter]) -> bool:
+  """True if a symlink at link_path whose contents are data ends up at target"""
+  first = Path(osp.normpath(osp.join(osp.dirname(link_path), data)))
   try:
-    fn()
-  except _skipConflictingEntry as e:
-    return None
+    final = chase_links(first, counter)
+    count_syscall(counter, 'stat', 2)
+    return osp.samefile(final, target)
+  except FileNotFoundError:
+    return False
+
+
+def _classify(
+  d: LinkDir, row: LinkRow, verify: TVerify = DEFAULT_VERIFY
+) -> Tuple[TLinkState, Optional[os.stat_result]]:
+  """decide the state of row's link path from a single lstat, plus a readlink if
+  it's a symlink
+  """
+  name = row.link_name
+  st = d.lstat(name)
+  if st is None:
+    return 'missing', None
+
+  mode = st.st_mode
+  if S_ISLNK(mode):
+    data = d.readlink(name)
+    if verify == 'readlink' and data == row.link_data:
+      return 'linked', st
+    if _resolves_to(d.join(name), data, row.vpath, d.counter):
+      log.debug(f"{d.join(name)} resolves to {row.vpath}")
+      return 'linked', st
+    log.debug(f"{d.join(name)} points to {data}")
+    return 'symlink', st
+  elif S_ISREG(mode):
+    return 'file', st
+  elif S_ISDIR(mode):
+    return 'dir', st
+  else:
+    return 'other', st
+
+
+# a strategy that doesn't change what's at the link path would have us go around forever
+_MAX_TRANSITIONS: Final = 4
+
+
+def _apply_link(
+  d: LinkDir,
+  row: LinkRow,
+  file_stgy: StrategyFn,
+  link_stgy: StrategyFn,
+  verify: TVerify = DEFAULT_VERIFY,
+) -> TOutcome:
+  """bring row's link path into line, a state machine driven by _classify.
+
+  the state is only looked at again after a strategy has changed something, so a
+  link path that is already correct costs the lstat and readlink in _classify,
+  plus following the link unless verify is 'readlink' and the contents match.
+
+  a symlink that the 'replace' strategy applies to is swapped for the new one with
+  LinkDir.replace_symlink, rather than deleted and then made again.
+  """
+  resolved = False
+  for _ in range(_MAX_TRANSITIONS):
+    state, st = _classify(d, row, verify)
+
+    if state == 'missing':
+      d.symlink(row.link_data, row.link_name)  # ok, we're clear, do it
+      return 'replaced' if resolved else 'created'
+    elif state == 'linked':
+      return 'replaced' if resolved else 'unchanged'  # ok, we already did this
+
+    if state == 'symlink' and link_stgy is replace_strategy:
+      d.replace_symlink(row.link_data, row.link_name)
+      return 'replaced'
+
+    # Paths are only made when we have a conflict to hand off to a strategy
+    link_path = Path(d.join(row.link_name))
+    try:
+      if state == 'symlink':
+        link_stgy(link_path)
+      elif state == 'file' or state == 'dir':
+        file_stgy(link_path)
+      else:  # what the what?
+        raise FilesystemConflictError(link_path, cast(os.stat_result, st))
+    except _skipConflictingEntry:
+      return 'skipped'
+    resolved = True
+
+  raise FilesystemConflictError(link_path, cast(os.stat_result, st))
+
+
+def apply_link_rows(
+  rows: Iterable[LinkRow],
+  create_missing: bool,
+  fs: StrategyFn,
+  ls: StrategyFn,
+  dir_fd: bool = HAVE_DIR_FD,
+  counter: Optional[SyscallCounter] = None,
+  verify: TVerify = DEFAULT_VERIFY,
+  jobs: Optional[int] = 1,
+  dir_mode: int = DEFAULT_DIR_MODE,
+  link_dirs: Optional[Iterable[str]] = None,
+  journal: Optional[Journal] = None,
+) -> Outcomes:
+  """apply rows, opening each run of rows that share a link dir once. a FileGroup's
+  links all share its target_dir, so that's once per group.
+
+  link dirs that don't exist are made with dir_mode if create_missing is True, or
+  are a MissingTargetDirs error if not. if link_dirs, every row's link dir, is given
+  they're all checked, and made, before any link is applied.
+
+  if dir_fd is True, every operation on a link path is made relative to an open
+  descriptor for its directory. if counter is given, the syscalls made are tallied
+  in it. verify is how existing symlinks are checked, see TVerify. returns a tally
+  of what was done to the links.
+
+  if journal is given, every change is recorded in it before it's made (see
+  _apply_dir), numbering rows in the order they're given. if jobs is anything but
+  1, see _apply_link_rows_concurrently.
+  """
+  target_dirs = TargetDirs(create_missing, dir_mode, counter, journal)
+  if link_dirs is not None:
+    target_dirs.ensure(link_dirs)
+
+  numbered = enumerate(rows)
+  if jobs != 1:
+    return _apply_link_rows_concurrently(
+      numbered, target_dirs, fs, ls, dir_fd, counter, verify, jobs, journal
+    )
+
+  outcomes: Outcomes = collections.Counter()
+  for link_dir, batch in groupby(numbered, key=lambda nr: nr[1].link_dir):
+    target_dirs.ensure([link_dir])
+    with _open_link_dir(link_dir, dir_fd, counter) as d:
+      outcomes.update(_apply_dir(d, batch, fs, ls, verify, journal))
+  return outcomes
+
+
+def _apply_dir(
+  d: LinkDir,
+  rows: Iterable[Tuple[int, LinkRow]],
+  fs: StrategyFn,
+  ls: StrategyFn,
+  verify: TVerify,
+  journal: Optional[Journal],
+  stop: Optional[threading.Event] = None,
+) -> Outcomes:
+  """apply the numbered rows in d, stopping early if stop is set
+
+  with a journal, rows are taken a batch at a time. each is classified, an intend
+  record is written for those that will change, and the journal is synced before
+  any of them are. links that are already right cost nothing more than they would
+  without a journal.
+  """
+  outcomes: Outcomes = collections.Counter()
+  if journal is None:
+    for _, row in rows:
+      if stop is not None and stop.is_set():
+        break
+      outcomes[_apply_link(d, row, fs, ls, verify)] += 1
+    return outcomes
+
+  for chunk in chunked(rows, journal.batch):
+    states = []
+    for n, row in chunk:
+      state, _ = _classify(d, row, verify)
+      if state != 'linked':
+        journal.intend(n, state, d.readlink(row.link_name) if state == 'symlink' else None)
+      states.append(state)
+    if any(state != 'linked' for state in states):
+      journal.sync()
+
+    for (n, row), state in zip(chunk, states):
+      if stop is not None and stop.is_set():
+        return outcomes
+      if state == 'linked':
+        outcomes['unchanged'] += 1
+        continue
+      moved: List[Optional[TBackup]] = []
+
+      def recording_fs(p: Path) -> Optional[TBackup]:
+        moved.append(fs(p))
+        return moved[-1]
+
+      outcome = _apply_link(d, row, recording_fs, ls, verify)
+      journal.done(n, outcome, next((m for m in moved if m is not None), None))
+      outcomes[outcome] += 1
+  return outcomes
+
+
+def _nested_link_dirs(link_dirs: Iterable[str]) -> Dict[str, List[str]]:
+  """link_dirs grouped under the topmost of them that each is in, going by their
+  normalized paths
+  """
+  norm = {d: osp.normpath(d) for d in link_dirs}
+  dirs = set(norm.values())
+  groups: Dict[str, List[str]] = {}
+  for d, nd in norm.items():
+    top = p = nd
+    while True:
+      parent = osp.dirname(p)
+      if parent == p:
+        break
+      if parent in dirs:
+        top = parent
+      p = parent
+    groups.setdefault(top, []).append(d)
+  return groups
+
+
+def _apply_link_rows_concurrently(
+  rows: Iterable[Tuple[int, LinkRow]],
+  target_dirs: TargetDirs,
+  fs: StrategyFn,
+  ls: StrategyFn,
+  dir_fd: bool,
+  counter: Optional[SyscallCounter],
+  verify: TVerify,
+  jobs: Optional[int],
+  journal: Optional[Journal],
+) -> Outcomes:
+  """apply the numbered rows on a pool of up to jobs threads (the ThreadPoolExecutor
+  default if None)
+
+  links in unrelated directories can't affect each other, so rows are partitioned
+  by link dir and each partition is applied in order on one thread. a link dir that
+  is under another goes in the same partition, because a conflict in the one above
+  can move or delete it. a DFIError stops
+  the partition it happened in, the others carry on and every error is raised at the
+  end, as an ApplyFailed if there was more than one. a FatalConflict, which is what
+  the 'fail' strategy raises, stops all of them before their next link.
+  """
+  by_dir: Dict[str, List[Tuple[int, LinkRow]]] = {}
+  for n, row in rows:
+    by_dir.setdefault(row.link_dir, []).append((n, row))
+  # all at once up front, so the workers don't race to make shared parents
+  target_dirs.ensure(by_dir)
+
+  partitions: Dict[str, List[Tuple[int, LinkRow]]] = {}
+  for top, dirs in _nested_link_dirs(by_dir).items():
+    # in the order they were given, as they'd be applied on one thread
+    partitions[top] = sorted((nr for d in dirs for nr in by_dir[d]), key=lambda nr: nr[0])
+
+  stop = threading.Event()
+
+  def apply_dir(batch: List[Tuple[int, LinkRow]]) -> Tuple[Outcomes, SyscallCounter]:
+    # Counters aren't safe to share between threads, each partition gets its own
+    calls: SyscallCounter = collections.Counter()
+    if stop.is_set():
+      return collections.Counter(), calls
+    outcomes: Outcomes = collections.Counter()
+    try:
+      for link_dir, rows in groupby(batch, key=lambda nr: nr[1].link_dir):
+        with _open_link_dir(link_dir, dir_fd, calls) as d:
+          outcomes.update(_apply_dir(d, rows, fs, ls, verify, journal, stop))
+      return outcomes, calls
+    except FatalConflict:
+      stop.set()
+      raise
+
+  outcomes: Outcomes = collections.Counter()
+  errors: List[DFIError] = []
+  with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix='dfi-apply') as ex:
+    futures = [ex.submit(apply_dir, batch) for batch in partitions.values()]
+    # results are gathered in submission order, so errors are reported in a stable order
+    for fut in futures:
+      try:
+        o, calls = fut.result()
+      except DFIError as e:
+        errors.append(e)
+        continue
+      outcomes.update(o)
+      if counter is not None:
+        counter.update(calls)
+
+  if len(errors) == 1:
+    raise errors[0]
+  elif errors:
+    raise ApplyFailed(errors)
+  return outcomes
+
+
+def _apply_link_data(
+  ld: LinkData, create_missing: bool, file_stgy: StrategyFn, link_stgy: StrategyFn
+) -> TOutcome:
+  with LinkDir(str(ld.link_path.parent)) as d:
+    return _apply_link(d, LinkRow.for_link_data(ld), file_stgy, link_stgy)
 
 
 def apply_link_data(
-  link_datas: List[LinkData], create_missing: bool, fs: StrategyFn, ls: StrategyFn
-) -> None:
-  for ld in link_datas:
-    _apply_link_data(ld, create_missing, fs, ls)
-
-
-def apply_settings(settings: Settings) -> None:
-  apply_link_data(
-    settings.link_data,
-    settings.create_missing_target_dirs,
-    # revalidating here is silly, but it appeases mypy, because declaring
-    # these as literal types on the Settings object messes up serialization
+  link_datas: Iterable[LinkData],
+  create_missing: bool,
+  fs: StrategyFn,
+  ls: StrategyFn,
+  dir_fd: bool = HAVE_DIR_FD,
+  counter: Optional[SyscallCounter] = None,
+  verify: TVerify = DEFAULT_VERIFY,
+  jobs: Optional[int] = 1,
+  dir_mode: int = DEFAULT_DIR_MODE,
+) -> Outcomes:
+  link_dirs = None
+  if isinstance(link_datas, list):
+    # everything's here already, so the missing dirs can be worked out up front
+    link_dirs = {str(ld.link_path.parent) for ld in link_datas}
+  rows = (LinkRow.for_link_data(ld) for ld in link_datas)
+  return apply_link_rows(
+    rows, create_missing, fs, ls, dir_fd, counter, verify, jobs, dir_mode, link_dirs
+  )
+
+
+def apply_link_table(
+  table: LinkTable,
+  create_missing: bool,
+  fs: StrategyFn,
+  ls: StrategyFn,
+  dir_fd: bool = HAVE_DIR_FD,
+  counter: Optional[SyscallCounter] = None,
+  verify: TVerify = DEFAULT_VERIFY,
+  jobs: Optional[int] = 1,
+  dir_mode: int = DEFAULT_DIR_MODE,
+) -> Outcomes:
+  return apply_link_rows(
+    table.rows(), create_missing, fs, ls, dir_fd, counter, verify, jobs, dir_mode, table.link_dirs()
+  )
+
+
+def _strategies(settings: Settings) -> Tuple[StrategyFn, StrategyFn]:
+  # revalidating here is silly, but it appeases mypy, because declaring
+  # these as literal types on the Settings object messes up serialization
+  return (
     _FILE_STRATEGY_MAP[file_strategy_validator(settings.conflicting_file_strategy)],
-    _SYMLINK_STRATEGY_MAP[symlink_strategy_validator(settings.conflicting_symlink_strategy)]
+    _SYMLINK_STRATEGY_MAP[symlink_strategy_validator(settings.conflicting_symlink_strategy)],
+  )
+
+
+@contextmanager
+def _run_strategies(
+  file_strategy: str,
+  symlink_strategy: str,
+  backup_dir: Optional[Path] = None,
+  backup_store: Optional[Path] = None,
+  run_id: Optional[str] = None,
+) -> Iterator[Tuple[StrategyFn, StrategyFn]]:
+  """the strategy functions for one run. with a backup_dir or backup_store, 'backup'
+  moves files into a BackupRun or ObjectStore that lasts as long as the context.
+  run_id is recorded with everything put in the store
+  """
+  fs = _FILE_STRATEGY_MAP[file_strategy_validator(file_strategy)]
+  ls = _SYMLINK_STRATEGY_MAP[symlink_strategy_validator(symlink_strategy)]
+  if fs is not backup_file_strategy or (backup_dir is None and backup_store is None):
+    yield fs, ls
+    return
+
+  run: Union[ObjectStore, BackupRun]
+  if backup_store is not None:
+    run = ObjectStore(backup_store, run_id)
+  else:
+    run = BackupRun(cast(Path, backup_dir))
+  with run:
+    yield run.strategy, ls
+
+
+def _settings_header(s: Settings, verify: TVerify) -> RunHeader:
+  return RunHeader(
+    run=RunHeader.new_run_id(),
+    conflicting_file_strategy=s.conflicting_file_strategy,
+    conflicting_symlink_strategy=s.conflicting_symlink_strategy,
+    create_missing_target_dirs=s.create_missing_target_dirs,
+    target_dir_mode=s.target_dir_mode,
+    verify=verify,
+    backup_dir=s.backup_dir,
+    backup_store=s.backup_store,
+  )
+
+
+def _apply_run(
+  header: RunHeader,
+  rows: Iterable[LinkRow],
+  link_dirs: Optional[Iterable[str]],
+  jobs: Optional[int],
+  journal: Optional[Path],
+  resuming: bool = False,
+) -> Outcomes:
+  """apply rows as header says to, journaling them in the file journal if it's given"""
+  strategies = _run_strategies(
+    header.conflicting_file_strategy,
+    header.conflicting_symlink_strategy,
+    header.backup_dir,
+    header.backup_store,
+    header.run,
   )
+  with strategies as (fs, ls):
+    def apply(
+      rows: Iterable[LinkRow], link_dirs: Optional[Iterable[str]], j: Optional[Journal]
+    ) -> Outcomes:
+      return apply_link_rows(
+        rows,
+        header.create_missing_target_dirs,
+        fs,
+        ls,
+        verify=cast(TVerify, header.verify),
+        jobs=jobs,
+        dir_mode=header.target_dir_mode,
+        link_dirs=link_dirs,
+        journal=j,
+      )
+
+    if journal is None:
+      return apply(rows, link_dirs, None)
+
+    rows = list(rows)
+    with Journal(journal) as j:
+      if resuming:
+        j.resume(header)
+      else:
+        j.begin(header, rows)
+      outcomes = apply(rows, {r.link_dir for r in rows}, j)
+      j.end()
+    return outcomes
+
+
+def apply_plan(plan: Plan, verify: TVerify = DEFAULT_VERIFY, jobs: Optional[int] = 1) -> Outcomes:
+  """create the links of an already collected plan"""
+  s = plan.settings
+  table = plan.link_table
+  return _apply_run(_settings_header(s, verify), table.rows(), table.link_dirs(), jobs, s.journal)
+
+
+def link_state(ld: LinkData) -> TLinkState:
+  """what is currently at ld.link_path: 'missing', 'linked' (a symlink to ld.vpath),
+  'symlink' (to anywhere else), 'file', 'dir' or 'other'
+  """
+  try:
+    return _classify(LinkDir(str(ld.link_path.parent)), LinkRow.for_link_data(ld))[0]
+  except NotADirectoryError:
+    return 'missing'
+  except DFIError:
+    return 'symlink'
+
+
+def _expected_action(state: str, settings: Settings) -> str:
+  if state == 'missing':
+    return 'create'
+  elif state == 'linked':
+    return 'none'
+  elif state == 'symlink':
+    return settings.conflicting_symlink_strategy
+  elif state in ('file', 'dir'):
+    return settings.conflicting_file_strategy
+  else:
+    return 'error'
+
+
+def plan_file(plan: Plan) -> PlanFile:
+  """a PlanFile of plan, recording the state of each link path as it is now"""
+  s = plan.settings
+  links = []
+  for ld in plan.link_data:
+    state = link_state(ld)
+    links.append(PlannedLink(link_data=ld, state=state, action=_expected_action(state, s)))
+
+  return PlanFile(
+    version=PLAN_FILE_VERSION,
+    conflicting_file_strategy=s.conflicting_file_strategy,
+    conflicting_symlink_strategy=s.conflicting_symlink_strategy,
+    create_missing_target_dirs=s.create_missing_target_dirs,
+    target_dir_mode=s.target_dir_mode,
+    links=links,
+    collisions=plan.collisions,
+    backup_dir=s.backup_dir,
+    backup_store=s.backup_store,
+  )
+
+
+def apply_plan_file(
+  pf: PlanFile,
+  verify: TVerify = DEFAULT_VERIFY,
+  jobs: Optional[int] = 1,
+  journal: Optional[Path] = None,
+) -> Outcomes:
+  """create the links of a saved plan. nothing is collected, each link path is
+  checked and conflicts are resolved just as they would be by apply_plan.
+  """
+  header = RunHeader(
+    run=RunHeader.new_run_id(),
+    conflicting_file_strategy=pf.conflicting_file_strategy,
+    conflicting_symlink_strategy=pf.conflicting_symlink_strategy,
+    create_missing_target_dirs=pf.create_missing_target_dirs,
+    target_dir_mode=pf.target_dir_mode,
+    verify=verify,
+    backup_dir=pf.backup_dir,
+    backup_store=pf.backup_store,
+  )
+  lds = [pl.link_data for pl in pf.links]
+  return _apply_run(
+    header,
+    (LinkRow.for_link_data(ld) for ld in lds),
+    {str(ld.link_path.parent) for ld in lds},
+    jobs,
+    journal,
+  )
+
+
+def apply_settings(
+  settings: Settings,
+  stream: bool = False,
+  verify: TVerify = DEFAULT_VERIFY,
+  jobs: Optional[int] = 1,
+) -> Outcomes:
+  """create the links described by settings
+
+  if stream is True, links are applied as they're collected rather than after
+  the complete sorted plan has been built.
+  """
+  header = _settings_header(settings, verify)
+  if stream:
+    rows = (LinkRow.for_link_data(ld) for ld in settings.iter_link_data())
+    return _apply_run(header, rows, None, jobs, settings.journal)
+  else:
+    table = settings.link_table()
+    return _apply_run(header, table.rows(), table.link_dirs(), jobs, settings.journal)
+
+
+def _restore_backup(header: RunHeader, link_path: Path, done: Optional[Dict[str, Any]]) -> bool:
+  """put back whatever the run moved out of link_path's way, returns False if it can't"""
+  backup_path = None if done is None else done.get('backup')
+  if backup_path is not None:
+    move(Path(backup_path), link_path)
+    return True
+
+  if header.conflicting_file_strategy == 'backup' and header.backup_store is not None:
+    # only what this run put in the store, which has every run's backups. the done
+    # record says which, unless the run was killed before it could be written
+    store = ObjectStore(header.backup_store)
+    entries = store.latest_under(link_path, None if done is None else done.get('stored'), header.run)
+    if entries:
+      store.restore(link_path, entries)
+    return bool(entries)
+
+  return False
+
+
+def rollback(journal: Path) -> Outcomes:
+  """undo the last run recorded in journal, whether it finished or not, using only
+  what the journal says was there before
+
+  a link is only removed if it's still the one the run made. returns a tally of
+  'removed' links, 'restored' entries that were in their way, and links that were
+  'left' because they'd changed since, or because what was there before can't be
+  brought back.
+  """
+  run = last_run(journal)
+  if run is None:
+    raise JournalError(journal, "there's nothing in it to roll back")
+  if run.rolled_back:
+    raise JournalError(journal, f"run {run.header.run} has already been rolled back")
+
+  h = run.header
+  outcomes: Outcomes = collections.Counter()
+  # newest first, so each link path goes back through the states it went through
+  for n in sorted(run.intents, reverse=True):
+    row = run.rows[n]
+    intent = run.intents[n]
+    before = intent['state']
+    link_path = Path(row.link_path)
+
+    with LinkDir(row.link_dir) as d:
+      st = d.lstat(row.link_name)
+      ours = st is not None and S_ISLNK(st.st_mode) and d.readlink(row.link_name) == row.link_data
+      if st is not None and not ours:
+        log.info(f"leaving {link_path}, it's been changed since run {h.run}")
+        outcomes['left'] += 1
+        continue
+
+      if before == 'symlink':
+        if ours:
+          d.replace_symlink(intent['prev'], row.link_name)
+        else:
+          d.symlink(intent['prev'], row.link_name)
+        outcomes['restored'] += 1
+        continue
+
+      if ours:
+        d.unlink(row.link_name)
+        outcomes['removed'] += 1
+
+    if before in ('file', 'dir'):
+      if _restore_backup(h, link_path, run.done.get(n)):
+        outcomes['restored'] += 1
+      else:
+        log.warning(
+          f"can't restore what was at {link_path} before run {h.run}, "
+          f"the {h.conflicting_file_strategy!r} strategy didn't leave a backup that was recorded"
+        )
+        outcomes['left'] += 1
+
+  for dir_ in reversed(run.dirs):
+    try:
+      os.rmdir(dir_)
+    except OSError:  # it's not empty, or it's already gone
+      pass
+
+  with Journal(journal) as j:
+    j.rolled_back(h)
+  return outcomes
+
+
+def resume(journal: Path, jobs: Optional[int] = 1) -> Outcomes:
+  """finish the last run recorded in journal, if it was interrupted, applying the
+  links it planned with the settings it had. nothing is collected again.
+  """
+  run = last_run(journal)
+  if run is None:
+    raise JournalError(journal, "there's nothing in it to resume")
+  if run.rolled_back:
+    raise JournalError(journal, f"run {run.header.run} has been rolled back")
+  if run.ended:
+    raise JournalError(journal, f"run {run.header.run} finished, there's nothing to resume")
+
+  return _apply_run(
+    run.header, run.rows, {r.link_dir for r in run.rows}, jobs, journal, resuming=True
+  )
+
+
+def _points_under(link_dir: str, data: str, dirs: Tuple[str, ...]) -> bool:
+  """True if a link in link_dir whose contents are data points somewhere under one
+  of dirs. worked out from the path alone, the link may well be dangling
+  """
+  target = osp.normpath(osp.join(link_dir, data))
+  return any(target == d or target.startswith(d + os.sep) for d in dirs)
+
+
+def _base_dirs(settings: Settings) -> Tuple[str, ...]:
+  base = osp.abspath(settings.base_dir)
+  return tuple({base, osp.realpath(base)})
+
+
+def _scan_link_dir(
+  link_dir: str,
+  prefixes: Tuple[str, ...],
+  base_dirs: Tuple[str, ...],
+  keep: Set[str],
+  counter: Optional[SyscallCounter] = None,
+) -> List[str]:
+  """the names of the symlinks directly in link_dir that start with one of prefixes,
+  point under one of base_dirs and aren't in keep, sorted
+  """
+  count_syscall(counter, 'scandir')
+  try:
+    it = os.scandir(link_dir)
+  except (FileNotFoundError, NotADirectoryError):
+    return []
+
+  names = []
+  with it:
+    for entry in it:
+      # is_symlink comes from the dirent's type, it only costs an lstat on the few
+      # filesystems that don't fill it in
+      if entry.name in keep or not entry.name.startswith(prefixes) or not entry.is_symlink():
+        continue
+      count_syscall(counter, 'readlink')
+      try:
+        data = os.readlink(entry.path)
+      except OSError:  # it's gone since the scan
+        continue
+      if _points_under(link_dir, data, base_dirs):
+        names.append(entry.name)
+  return sorted(names)
+
+
+def find_links(
+  settings: Settings, stale_only: bool = True, counter: Optional[SyscallCounter] = None
+) -> Dict[str, List[str]]:
+  """link dir -> names of the symlinks in it that point into settings.base_dir
+
+  only each file group's target dir is scanned, and only its direct entries, as
+  that's the only place a group makes links. with stale_only, links at the link
+  paths settings would make now are left out, leaving the ones whose source has
+  gone from the repo, or is no longer collected.
+  """
+  prefixes: Dict[str, Set[str]] = collections.defaultdict(set)
+  for fg in settings.file_groups:
+    prefixes[str(fg.target_dir)].add(fg.link_prefix)
+
+  keep: Dict[str, Set[str]] = collections.defaultdict(set)
+  if stale_only:
+    for row in settings.link_table().rows():
+      keep[row.link_dir].add(row.link_name)
+
+  base_dirs = _base_dirs(settings)
+  found = {}
+  for link_dir in sorted(prefixes):
+    names = _scan_link_dir(link_dir, tuple(prefixes[link_dir]), base_dirs, keep[link_dir], counter)
+    if names:
+      found[link_dir] = names
+  return found
+
+
+def prune(
+  settings: Settings,
+  uninstall: bool = False,
+  dry_run: bool = False,
+  dir_fd: bool = HAVE_DIR_FD,
+  counter: Optional[SyscallCounter] = None,
+) -> List[Path]:
+  """remove the symlinks into settings.base_dir that settings no longer makes, or
+  with uninstall, every symlink into it, see find_links. returns the paths of the
+  links removed (or that would be, with dry_run)
+  """
+  found = find_links(settings, stale_only=not uninstall, counter=counter)
+  if dry_run:
+    return [Path(link_dir, n) for link_dir, names in found.items() for n in names]
+  return _remove_links(found, dir_fd, counter)
+
+
+def _remove_links(
+  found: Dict[str, List[str]], dir_fd: bool, counter: Optional[SyscallCounter]
+) -> List[Path]:
+  """unlink the names in each link dir in found, a dir at a time"""
+  removed = []
+  for link_dir, names in found.items():
+    with _open_link_dir(link_dir, dir_fd, counter) as d:
+      for name in names:
+        try:
+          d.unlink(name)
+        except FileNotFoundError:
+          continue
+        log.info(f"removed {d.join(name)}")
+        removed.append(Path(link_dir, name))
+  return removed
+
+
+def remove_links_into(
+  settings: Settings,
+  link_paths: Iterable[Path],
+  dir_fd: bool = HAVE_DIR_FD,
+  counter: Optional[SyscallCounter] = None,
+) -> List[Path]:
+  """remove those of link_paths that are symlinks into settings.base_dir, returns
+  the ones that were
+  """
+  base_dirs = _base_dirs(settings)
+  found: Dict[str, List[str]] = {}
+  for link_dir, lps in groupby(sorted(link_paths), key=lambda lp: str(lp.parent)):
+    try:
+      d = _open_link_dir(link_dir, dir_fd, counter)
+    except (FileNotFoundError, NotADirectoryError):
+      continue
+    with d:
+      for lp in lps:
+        st = d.lstat(lp.name)
+        if st is not None and S_ISLNK(st.st_mode) and _points_under(link_dir, d.readlink(lp.name), base_dirs):
+          found.setdefault(link_dir, []).append(lp.name)
+  return _remove_links(found, dir_fd, counter)
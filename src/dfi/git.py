@@ -0,0 +1,63 @@
+"""what has changed in the git checkout a base_dir is in, asked of the local git with
+no network access. anything git can't answer is None, so the caller can fall back
+to looking at everything
+"""
+import logging
+import os
+import subprocess
+from pathlib import Path
+from typing import List, Optional
+
+log = logging.getLogger(__name__)
+
+
+def _git(repo: Path, *args: str) -> Optional[str]:
+  """the output of git args run in repo, or None if it failed"""
+  try:
+    proc = subprocess.run(
+      ['git', '-C', str(repo), *args],
+      stdin=subprocess.DEVNULL,
+      stdout=subprocess.PIPE,
+      stderr=subprocess.PIPE,
+      check=True,
+      # never ask for credentials, nothing here should need the network
+      env={**os.environ, 'GIT_TERMINAL_PROMPT': '0'},
+    )
+  except FileNotFoundError:
+    log.debug("git isn't installed")
+    return None
+  except subprocess.CalledProcessError as e:
+    log.debug(f"git {' '.join(args)} failed in {repo}: {e.stderr.decode(errors='replace').strip()}")
+    return None
+  return os.fsdecode(proc.stdout)
+
+
+def toplevel(path: Path) -> Optional[Path]:
+  """the root of the work tree path is in, or None if it isn't in one"""
+  out = _git(path, 'rev-parse', '--show-toplevel')
+  return None if out is None else Path(out.rstrip('\n'))
+
+
+def head(repo: Path) -> Optional[str]:
+  """the commit checked out in repo, or None if there isn't one"""
+  out = _git(repo, 'rev-parse', '--verify', '--quiet', 'HEAD^{commit}')
+  return None if out is None else out.strip()
+
+
+def _split_z(out: str) -> List[str]:
+  return [p for p in out.split('\0') if p]
+
+
+def changed_paths(repo: Path, since: str) -> Optional[List[Path]]:
+  """the absolute paths of the files that differ between commit since and the work
+  tree of repo, the root of a checkout, along with untracked files that aren't
+  ignored. a rename is both of its paths. None if since can't be found, i.e. it's
+  been garbage collected or is beyond a shallow clone's history
+  """
+  if _git(repo, 'cat-file', '-e', f"{since}^{{commit}}") is None:
+    return None
+  diff = _git(repo, 'diff', '--name-only', '--no-renames', '--no-ext-diff', '-z', since, '--')
+  untracked = _git(repo, 'ls-files', '--others', '--exclude-standard', '-z', '--full-name')
+  if diff is None or untracked is None:
+    return None
+  return [repo / p for p in _split_z(diff) + _split_z(untracked)]
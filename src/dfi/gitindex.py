@@ -0,0 +1,255 @@
+"""listing the files git tracks by reading a checkout's index file directly, so that
+collecting from a repo needs no directory walk and never sees untracked or ignored
+files
+
+the index format is documented in git's Documentation/gitformat-index.txt. versions
+2, 3 and 4 are read. a sparse index, whose entries can be whole directories, isn't.
+
+a tracked symlink is a file as far as the index is concerned, so globs don't go
+into a symlinked dir as they would on the filesystem. the same goes for submodules.
+"""
+import logging
+import os
+import re
+import struct
+import threading
+from pathlib import Path, PurePath
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from typing_extensions import Final
+
+from .dotfile import SyscallCounter, count_syscall
+from .exceptions import UnreadableIndex
+from .match import Glob
+
+log = logging.getLogger(__name__)
+
+_SIGNATURE: Final = b'DIRC'
+_HEADER: Final = struct.Struct('>4sLL')
+# ctime, mtime, dev, ino, mode, uid, gid, size, everything before the object id
+_STAT_SIZE: Final = 40
+_FLAG_EXTENDED: Final = 0x4000
+_FLAG_STAGE: Final = 0x3000
+_FLAG_NAME_MASK: Final = 0x0fff
+_EXT_SKIP_WORKTREE: Final = 0x4000
+_S_IFMT: Final = 0o170000
+_S_IFDIR: Final = 0o040000
+_S_IFLNK: Final = 0o120000
+_OBJECTFORMAT_SHA256: Final = re.compile(rb'^\s*objectformat\s*=\s*sha256\s*$', re.M | re.I)
+
+
+def find_repo(path: Path) -> Optional[Tuple[Path, Path]]:
+  """(the root of the work tree, its git dir) for the checkout path is in, found by
+  looking for .git in it and its parents, or None
+  """
+  for d in [path, *path.parents]:
+    dot_git = d / '.git'
+    if dot_git.is_dir():
+      return d, dot_git
+    if dot_git.is_file():
+      # a linked worktree or a submodule, .git says where its git dir is
+      text = dot_git.read_text(encoding='utf8').strip()
+      if text.startswith('gitdir:'):
+        return d, (d / text[len('gitdir:'):].strip()).resolve()
+  return None
+
+
+def _hash_size(git_dir: Path) -> int:
+  common = git_dir
+  commondir = git_dir / 'commondir'
+  if commondir.is_file():
+    common = (git_dir / commondir.read_text(encoding='utf8').strip()).resolve()
+  try:
+    config = (common / 'config').read_bytes()
+  except FileNotFoundError:
+    return 20
+  return 32 if _OBJECTFORMAT_SHA256.search(config) else 20
+
+
+def _varint(data: bytes, i: int) -> Tuple[int, int]:
+  """git's offset encoding, used for the prefix length in version 4 entries"""
+  b = data[i]
+  i += 1
+  val = b & 0x7f
+  while b & 0x80:
+    b = data[i]
+    i += 1
+    val = ((val + 1) << 7) | (b & 0x7f)
+  return val, i
+
+
+# (a path relative to the work tree root, its mode)
+IndexEntry = Tuple[str, int]
+
+
+def parse_index(data: bytes, hash_size: int = 20, path: Path = Path('index')) -> List[IndexEntry]:
+  """the files in the work tree that an index lists, in index order
+
+  only stage 0 and the first of any conflicting stages are kept, and files left out
+  of the work tree by a sparse checkout are dropped.
+  """
+  if len(data) < _HEADER.size:
+    raise UnreadableIndex(path, "it's too short")
+  sig, version, count = _HEADER.unpack_from(data)
+  if sig != _SIGNATURE:
+    raise UnreadableIndex(path, "it doesn't start with DIRC")
+  if version not in (2, 3, 4):
+    raise UnreadableIndex(path, f"version {version} isn't supported")
+
+  entries: List[IndexEntry] = []
+  prev = b''
+  i = _HEADER.size
+  fixed = _STAT_SIZE + hash_size + 2
+  try:
+    for _ in range(count):
+      start = i
+      mode, = struct.unpack_from('>L', data, i + 24)
+      flags, = struct.unpack_from('>H', data, i + _STAT_SIZE + hash_size)
+      i += fixed
+      ext = 0
+      if flags & _FLAG_EXTENDED:
+        if version < 3:
+          raise UnreadableIndex(path, "a version 2 entry has extended flags")
+        ext, = struct.unpack_from('>H', data, i)
+        i += 2
+
+      if version == 4:
+        strip, i = _varint(data, i)
+        end = data.index(b'\0', i)
+        name = prev[:len(prev) - strip] + data[i:end]
+        i = end + 1
+      else:
+        n = flags & _FLAG_NAME_MASK
+        end = i + n if n < _FLAG_NAME_MASK else data.index(b'\0', i)
+        name = data[i:end]
+        # entries are padded with 1-8 NULs to a multiple of 8 bytes
+        i = start + ((end - start + 8) & ~7)
+      prev = name
+
+      if (mode & _S_IFMT) == _S_IFDIR:
+        raise UnreadableIndex(path, "it's a sparse index")
+      if ext & _EXT_SKIP_WORKTREE:
+        continue
+      p = os.fsdecode(name)
+      if flags & _FLAG_STAGE and entries and entries[-1][0] == p:
+        continue
+      entries.append((p, mode))
+  except (struct.error, IndexError, ValueError) as e:
+    raise UnreadableIndex(path, f"it's truncated or corrupt ({e})") from None
+  return entries
+
+
+class TrackedTree:
+  """the files an index tracks, and the dirs they imply, under the work tree root"""
+  __slots__ = ('root', 'files', 'symlinks', '_children')
+
+  def __init__(self, root: Path, entries: List[IndexEntry]) -> None:
+    self.root = root
+    self.files: Set[Tuple[str, ...]] = set()
+    self.symlinks: Set[Tuple[str, ...]] = set()
+    # dir parts -> {name: True if it's a dir}
+    self._children: Dict[Tuple[str, ...], Dict[str, bool]] = {(): {}}
+    for p, mode in entries:
+      parts = tuple(p.split('/'))
+      self.files.add(parts)
+      if (mode & _S_IFMT) == _S_IFLNK:
+        self.symlinks.add(parts)
+      for n in range(len(parts)):
+        d = parts[:n]
+        children = self._children.get(d)
+        if children is None:
+          children = self._children[d] = {}
+        children.setdefault(parts[n], n < len(parts) - 1)
+
+  def _rel(self, path: Path) -> Optional[Tuple[str, ...]]:
+    try:
+      return path.relative_to(self.root).parts
+    except ValueError:
+      return None
+
+  def __contains__(self, path: Path) -> bool:
+    """True if path is a tracked file, or a dir with tracked files in it"""
+    rel = self._rel(path)
+    return rel is not None and (rel in self.files or rel in self._children)
+
+  def is_symlink(self, path: Path) -> bool:
+    return self._rel(path) in self.symlinks
+
+  def members(self, d: Path) -> List[str]:
+    """the sorted names in d that are tracked files or have tracked files in them"""
+    rel = self._rel(d)
+    children = None if rel is None else self._children.get(rel)
+    return sorted(children or ())
+
+  def _walk(self, d: Tuple[str, ...]) -> Iterator[Tuple[Tuple[str, ...], bool]]:
+    """every path under d, a dir before what's in it, sorted by parts"""
+    children = self._children.get(d, {})
+    for name in sorted(children):
+      is_dir = children[name]
+      parts = d + (name,)
+      yield parts, is_dir
+      if is_dir:
+        yield from self._walk(parts)
+
+  def glob(self, base_dir: Path, pattern: str) -> Iterator[Path]:
+    """what base_dir.glob(pattern) yields, if the work tree only had tracked files,
+    sorted by path
+    """
+    rel = self._rel(base_dir)
+    if rel is None or (rel and rel not in self._children):
+      return
+    g = Glob.compile(pattern)
+    if all(p == '**' for p in PurePath(pattern).parts):
+      # Path.glob yields the dir it starts from for these
+      yield base_dir
+    n = len(rel)
+    for parts, is_dir in self._walk(rel):
+      if g.match_parts(parts[n:], is_dir):
+        yield base_dir.joinpath(*parts[n:])
+
+
+_lock = threading.Lock()
+# index path -> ((dev, ino, mtime, size) of it, the tree read from it)
+_trees: Dict[Path, Tuple[Tuple[int, int, int, int], TrackedTree]] = {}
+
+
+def index_path(path: Path) -> Optional[Path]:
+  """the index of the checkout path is in, or None if it isn't in one"""
+  repo = find_repo(path)
+  return None if repo is None else repo[1] / 'index'
+
+
+def tracked(path: Path, counter: Optional[SyscallCounter] = None) -> Optional[TrackedTree]:
+  """the files tracked in the checkout path is in, or None if it isn't in one that
+  can be read. the index is only parsed again when it changes
+  """
+  repo = find_repo(path)
+  if repo is None:
+    log.warning(f"{path} isn't in a git checkout")
+    return None
+  root, git_dir = repo
+  index = git_dir / 'index'
+
+  count_syscall(counter, 'stat')
+  try:
+    st = os.stat(index)
+  except FileNotFoundError:
+    # a repo nothing has been added to yet
+    return TrackedTree(root, [])
+  key = (st.st_dev, st.st_ino, st.st_mtime_ns, st.st_size)
+
+  with _lock:
+    cached = _trees.get(index)
+    if cached is not None and cached[0] == key:
+      return cached[1]
+
+  count_syscall(counter, 'read')
+  try:
+    entries = parse_index(index.read_bytes(), _hash_size(git_dir), index)
+  except UnreadableIndex as e:
+    log.warning(str(e))
+    return None
+  tree = TrackedTree(root, entries)
+  with _lock:
+    _trees[index] = (key, tree)
+  return tree
@@ -0,0 +1,226 @@
+"""applying only the links that can have changed since the last run, worked out from
+what git says has changed in the checkout base_dir is in
+
+a changed file can only affect the link of a group's dir member it's in, or of a
+glob match that it is or is in. for each such link path, the vpath that collecting
+would have picked for it is found by looking up just that name, and the link is
+made, or removed if nothing claims the path any more. if a target dir has changed
+since the last run (a link removed by hand, say), or a source dir has in a way git
+doesn't account for (an ignored file added, say), everything is applied.
+"""
+import glob
+import logging
+import os.path as osp
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePath
+from typing import Iterable, List, Optional, Set, Tuple
+
+import attr
+
+from . import fs, git, gitindex
+from .compact import LinkRow
+from .config import FileGroup, Settings
+from .dotfile import LinkData
+from .match import Glob, PathMatcher, has_magic
+from .state import Fingerprint, target_dirs
+
+log = logging.getLogger(__name__)
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class Checkout:
+  """the state of the git checkout a base_dir is in"""
+  root: Path
+  commit: str
+  # files that differ from commit in the work tree, relative to root
+  dirty: List[str]
+
+  @classmethod
+  def of(cls, path: Path) -> Optional['Checkout']:
+    """the checkout path is in, or None if it isn't in one git can tell us about"""
+    root = git.toplevel(path)
+    commit = None if root is None else git.head(root)
+    if root is None or commit is None:
+      return None
+    dirty = git.changed_paths(root, commit)
+    if dirty is None:
+      return None
+    return cls(root=root, commit=commit, dirty=[str(p.relative_to(root)) for p in dirty])
+
+  def changed_since(self, saved: Fingerprint) -> Optional[List[Path]]:
+    """every file that may differ from how it was when saved was taken, or None if
+    that can't be worked out
+    """
+    if saved.commit is None:
+      return None
+    if saved.commit == self.commit:
+      changed = [self.root / d for d in self.dirty]
+    else:
+      since = git.changed_paths(self.root, saved.commit)
+      if since is None:
+        return None
+      changed = since
+    # files that were dirty then may have been put back since
+    return changed + [self.root / d for d in saved.dirty]
+
+
+def changes(
+  settings: Settings, saved: Optional[Fingerprint], fp: Fingerprint, checkout: Optional[Checkout]
+) -> Optional[List[Path]]:
+  """the files changed since the run saved was taken after, or None if the next run
+  has to look at everything
+  """
+  if checkout is None:
+    log.info(f"{settings.base_dir} isn't in a git checkout, applying everything")
+    return None
+  if saved is None or saved.settings != fp.settings:
+    log.info("the settings have changed since the last run, applying everything")
+    return None
+  changed = checkout.changed_since(saved)
+  if changed is None:
+    log.info(f"can't find commit {saved.commit} in {checkout.root}, applying everything")
+    return None
+  unexplained = _unexplained_dir(settings, saved, fp, changed)
+  if unexplained is not None:
+    log.info(f"{unexplained} has changed in a way git doesn't account for, applying everything")
+    return None
+  return changed
+
+
+def _unexplained_dir(
+  settings: Settings, saved: Fingerprint, fp: Fingerprint, changed: List[Path]
+) -> Optional[str]:
+  """a target dir that's changed since saved was taken, or a source dir that's
+  changed without any of the changed files being in it, if there is one
+  """
+  targets = {str(d) for d in target_dirs(settings)}
+  # the index changes with the commits and dirty files that changed already covers
+  indexes = {
+    str(gitindex.index_path(fg.base_dir)) for fg in settings.file_groups if fg.source == 'git-index'
+  }
+  real = [osp.realpath(p) for p in changed]
+  for d in sorted(saved.dirs.keys() | fp.dirs.keys()):
+    if saved.dirs.get(d) == fp.dirs.get(d) or d in indexes:
+      continue
+    if d in targets:
+      return d
+    rd = osp.realpath(d)
+    if not any(p == rd or p.startswith(rd + '/') for p in real):
+      return d
+  return None
+
+
+def _relative(path: str, d: str) -> Optional[Tuple[str, ...]]:
+  """the parts of path below d, or None if it's not below it"""
+  if path.startswith(d + '/'):
+    return tuple(path[len(d) + 1:].split('/'))
+  return None
+
+
+def _group_link_paths(fg: FileGroup, changed: List[str]) -> Set[Path]:
+  """the link paths in fg's target dir that changed, real paths, can affect"""
+  dirs = [osp.realpath(fg.base_dir.joinpath(d)) for d in fg.dirs]
+  base = osp.realpath(fg.base_dir)
+  globs = [Glob.compile(g) for g in fg.globs or []]
+
+  names = set()
+  for p in changed:
+    for d in dirs:
+      rel = _relative(p, d)
+      if rel is not None:
+        names.add(rel[0])
+
+    rel = _relative(p, base) if globs else None
+    if rel is None:
+      continue
+    # the file itself, or any of the dirs it's in
+    for n in range(len(rel), 0, -1):
+      parts = rel[:n]
+      if any(g.match_parts(parts, n < len(rel)) for g in globs):
+        names.add(parts[-1])
+
+  return {fg.target_dir / (fg.link_prefix + name) for name in names}
+
+
+def affected_link_paths(settings: Settings, changed: Iterable[Path]) -> Set[Path]:
+  """every link path whose link may be different now that changed paths have been
+  added, removed, modified or renamed
+  """
+  real = [osp.realpath(p) for p in changed]
+  paths: Set[Path] = set()
+  for fg in settings.file_groups:
+    paths |= _group_link_paths(fg, real)
+  return paths
+
+
+def _glob_named(fg: FileGroup, pattern: str, vname: str) -> Iterable[Path]:
+  """the matches of pattern in fg.base_dir named vname, only listing the dirs the
+  pattern's last part is matched in when it's not '**'
+  """
+  parts = PurePath(pattern).parts
+  last = parts[-1]
+  if last == '**':
+    return (x for x in fg.base_dir.glob(pattern) if x.name == vname)
+  if not fnmatchcase(vname, last):
+    return ()
+  name = glob.escape(vname) if has_magic(vname) else vname
+  return fg.base_dir.glob(str(PurePath(*parts[:-1], name)))
+
+
+def _winner(fg: FileGroup, vname: str, exclude: PathMatcher) -> Optional[Path]:
+  """the vpath named vname that collecting fg would link, if any. as in collect,
+  that's the first by path of the dir members and glob matches that exist, are
+  tracked if fg's source is the git index, and aren't excluded
+  """
+  found = [fg.base_dir.joinpath(d) / vname for d in fg.dirs]
+  for g in fg.globs or []:
+    found.extend(_glob_named(fg, g, vname))
+  tracked = fg.tracked()
+  if tracked is not None:
+    found = [v for v in found if v in tracked]
+  found = [v for v in found if not exclude.match(v) and v.exists()]
+  return min(found, key=lambda v: v.parts, default=None)
+
+
+def resolve(settings: Settings, link_paths: Iterable[Path]) -> Tuple[List[LinkData], List[Path]]:
+  """the links to make at link_paths, each claimed by the first group with a vpath
+  for it, and the link paths that nothing claims any more
+  """
+  groups = [(fg, PathMatcher.compile(fg.excludes or [])) for fg in settings.file_groups]
+  lds, gone = [], []
+  for lp in sorted(link_paths):
+    for fg, exclude in groups:
+      prefix = fg.link_prefix
+      if fg.target_dir != lp.parent or not lp.name.startswith(prefix) or lp.name == prefix:
+        continue
+      v = _winner(fg, lp.name[len(prefix):], exclude)
+      if v is not None:
+        lds.append(LinkData.for_path(v, fg.target_dir, prefix))
+        break
+    else:
+      gone.append(lp)
+  return lds, gone
+
+
+def apply(
+  settings: Settings,
+  changed: Iterable[Path],
+  verify: fs.TVerify = fs.DEFAULT_VERIFY,
+  jobs: Optional[int] = 1,
+) -> fs.Outcomes:
+  """make or remove just the links changed files can affect, returns the outcomes
+  of the links made along with how many were 'removed'
+  """
+  lds, gone = resolve(settings, affected_link_paths(settings, changed))
+  log.info(f"{len(lds)} links to check and {len(gone)} that may be stale")
+  outcomes = fs._apply_run(
+    fs._settings_header(settings, verify),
+    (LinkRow.for_link_data(ld) for ld in lds),
+    {str(ld.link_path.parent) for ld in lds},
+    jobs,
+    settings.journal,
+  )
+  removed = fs.remove_links_into(settings, gone)
+  if removed:
+    outcomes['removed'] += len(removed)
+  return outcomes
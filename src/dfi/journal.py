@@ -0,0 +1,214 @@
+"""a write-ahead journal of the changes an apply makes, so that a run that was killed
+part way through can be finished (resumed) or undone (rolled back) without collecting
+or scanning anything again
+
+the journal is a file of json records, one per line, that runs are appended to:
+
+  begin     the run's settings
+  link      a planned link, numbered from 0 in the order they're applied
+  mkdir     a target dir that's about to be made
+  intend    what was at a link path before it's changed, written before the change
+  done      what was done to a link path, and where anything in the way was moved to,
+            or the time of its backup in a backup store
+  resume    the run is being carried on after it was interrupted
+  end       the run finished
+  rollback  the run has been rolled back
+
+intend records are fsync'd in batches, before any of the changes in the batch are
+made. done records are fsync'd with the next batch, except those for a link that
+moved something out of the way, which are fsync'd straight away so a backup can
+always be found again.
+"""
+import json
+import logging
+import os
+import threading
+from pathlib import Path
+from typing import Any, Dict, IO, List, Optional
+
+import attr
+import cattr
+from typing_extensions import Final
+
+from . import config  # noqa: F401 # for its cattr hooks for Path
+from .backup import StoredBackup, TBackup, timestamp
+from .compact import LinkRow
+
+log = logging.getLogger(__name__)
+
+# how many intend records are written between fsyncs
+DEFAULT_BATCH: Final = 512
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class RunHeader:
+  """how a journaled run was applied, so it can be resumed the same way"""
+  run: str
+  conflicting_file_strategy: str
+  conflicting_symlink_strategy: str
+  create_missing_target_dirs: bool
+  target_dir_mode: int
+  verify: str
+  backup_dir: Optional[Path] = None
+  backup_store: Optional[Path] = None
+
+  @classmethod
+  def new_run_id(cls) -> str:
+    return f"{timestamp()}-{os.getpid()}"
+
+
+@attr.s(auto_attribs=True)
+class JournalRun:
+  """everything the journal says about one run"""
+  header: RunHeader
+  rows: List[LinkRow] = attr.ib(factory=list)
+  # target dirs that were going to be made, in the order they were
+  dirs: List[str] = attr.ib(factory=list)
+  # link number -> its intend record
+  intents: Dict[int, Dict[str, Any]] = attr.ib(factory=dict)
+  # link number -> its done record
+  done: Dict[int, Dict[str, Any]] = attr.ib(factory=dict)
+  ended: bool = False
+  rolled_back: bool = False
+
+
+def read_runs(path: Path) -> List[JournalRun]:
+  """every run in the journal at path, oldest first. a last line that was only
+  partly written when we were killed is ignored.
+  """
+  runs: List[JournalRun] = []
+  with open(path, encoding='utf8') as f:
+    lines = f.read().split('\n')
+
+  for i, line in enumerate(lines):
+    if not line:
+      continue
+    try:
+      rec = json.loads(line)
+    except ValueError:
+      if i >= len(lines) - 2:
+        log.warning(f"ignoring a partly written record at the end of {path}")
+        break
+      raise
+
+    op = rec.pop('op')
+    if op == 'begin':
+      runs.append(JournalRun(header=cattr.structure(rec, RunHeader)))
+      continue
+
+    run = runs[-1]
+    if op == 'link':
+      run.rows.append(LinkRow(**rec))
+    elif op == 'mkdir':
+      run.dirs.append(rec['dir'])
+    elif op == 'intend':
+      # a resumed run can record a link again. the first record is what was there
+      # before the run started
+      run.intents.setdefault(rec['n'], rec)
+    elif op == 'done':
+      # and the first backup is the one to restore
+      prev = run.done.get(rec['n'])
+      if prev is None or (prev['backup'] is None and prev.get('stored') is None):
+        run.done[rec['n']] = rec
+    elif op == 'end':
+      run.ended = True
+    elif op == 'rollback':
+      run.rolled_back = True
+  return runs
+
+
+def last_run(path: Path) -> Optional[JournalRun]:
+  runs = read_runs(path)
+  return runs[-1] if runs else None
+
+
+class Journal:
+  """appends the records for one run to a journal file, see the module docstring
+
+  safe to use from several threads at once.
+  """
+  __slots__ = ('path', 'batch', '_f', '_lock', '_unsynced')
+
+  def __init__(self, path: Path, batch: int = DEFAULT_BATCH) -> None:
+    self.path = path
+    self.batch = batch
+    os.makedirs(path.parent, exist_ok=True)
+    self._f: Optional[IO[str]] = open(path, 'a', encoding='utf8')
+    self._lock = threading.Lock()
+    self._unsynced = 0
+
+  def __enter__(self) -> 'Journal':
+    return self
+
+  def __exit__(self, *exc: object) -> None:
+    self.close()
+
+  def close(self) -> None:
+    with self._lock:
+      if self._f is not None:
+        self._sync()
+        self._f.close()
+        self._f = None
+
+  def _write(self, op: str, **rec: Any) -> None:
+    assert self._f is not None, "journal is closed"
+    self._f.write(json.dumps({'op': op, **rec}) + '\n')
+    self._unsynced += 1
+
+  def _sync(self) -> None:
+    if self._f is not None and self._unsynced:
+      self._f.flush()
+      os.fsync(self._f.fileno())
+      self._unsynced = 0
+
+  def sync(self) -> None:
+    with self._lock:
+      self._sync()
+
+  def begin(self, header: RunHeader, rows: List[LinkRow]) -> None:
+    """record the start of a run that will apply rows"""
+    with self._lock:
+      self._write('begin', **cattr.unstructure(header))
+      for row in rows:
+        self._write('link', **row._asdict())
+      self._sync()
+
+  def resume(self, header: RunHeader) -> None:
+    """record that the run is being carried on, after it was interrupted"""
+    with self._lock:
+      self._write('resume', run=header.run)
+      self._sync()
+
+  def mkdirs(self, dirs: List[str]) -> None:
+    with self._lock:
+      for d in dirs:
+        self._write('mkdir', dir=d)
+      self._sync()
+
+  def intend(self, n: int, state: str, prev: Optional[str] = None) -> None:
+    """record what's at link n's path before it's changed. call sync before
+    making the change
+    """
+    with self._lock:
+      self._write('intend', n=n, state=state, prev=prev)
+
+  def done(self, n: int, outcome: str, backup: Optional[TBackup] = None) -> None:
+    """record what was done to link n. backup is where the file strategy moved what
+    was in the way to, a path or the time of its entries in the backup store
+    """
+    moved = str(backup) if isinstance(backup, Path) else None
+    stored = backup.time if isinstance(backup, StoredBackup) else None
+    with self._lock:
+      self._write('done', n=n, outcome=outcome, backup=moved, stored=stored)
+      if backup is not None:
+        self._sync()
+
+  def end(self) -> None:
+    with self._lock:
+      self._write('end')
+      self._sync()
+
+  def rolled_back(self, header: RunHeader) -> None:
+    with self._lock:
+      self._write('rollback', run=header.run)
+      self._sync()
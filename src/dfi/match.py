@@ -0,0 +1,360 @@
+import re
+from fnmatch import translate
+from pathlib import PurePath, PurePosixPath
+from typing import Callable, Dict, FrozenSet, Iterable, List, Optional, Pattern, Sequence, Set, Tuple
+
+import attr
+from typing_extensions import Final
+
+# path parts can never contain a NUL, so it's safe to use it to join them
+_SEP: Final = '\0'
+_ANY_CHAR: Final = '[^\\0]'
+_MAGIC: Final = re.compile(r'[*?[]')
+
+# fnmatch.translate wraps its output in these, we only want the inside
+_TRANSLATE_PREFIX: Final = '(?s:'
+_TRANSLATE_SUFFIX: Final = ')\\Z'
+
+
+def has_magic(s: str) -> bool:
+  """True if s contains any fnmatch wildcards"""
+  return _MAGIC.search(s) is not None
+
+
+def _translate_class(cls: str) -> str:
+  """let fnmatch decide what a [...] class means, so ranges and negation behave
+  exactly as they do for Path.match, then stop it from matching across parts
+  """
+  t = translate(cls)
+  assert t.startswith(_TRANSLATE_PREFIX) and t.endswith(_TRANSLATE_SUFFIX), t
+  inner = t[len(_TRANSLATE_PREFIX):-len(_TRANSLATE_SUFFIX)]
+  if inner == '.':  # '[!]' matches any single character
+    return _ANY_CHAR
+  return f"(?!\\0){inner}"
+
+
+def translate_part(pat: str) -> str:
+  """translate a single path part fnmatch pattern into a regex that will not match
+  across a NUL separated part boundary
+  """
+  i, n = 0, len(pat)
+  res: List[str] = []
+  while i < n:
+    c = pat[i]
+    i += 1
+    if c == '*':
+      # collapse runs of '*', they mean the same thing
+      if not res or res[-1] != _ANY_CHAR + '*':
+        res.append(_ANY_CHAR + '*')
+    elif c == '?':
+      res.append(_ANY_CHAR)
+    elif c == '[':
+      # find the end of the class the same way fnmatch does
+      j = i
+      if j < n and pat[j] == '!':
+        j += 1
+      if j < n and pat[j] == ']':
+        j += 1
+      while j < n and pat[j] != ']':
+        j += 1
+      if j >= n:
+        res.append('\\[')
+      else:
+        res.append(_translate_class(pat[i - 1:j + 1]))
+        i = j + 1
+    else:
+      res.append(re.escape(c))
+  return ''.join(res)
+
+
+def _combine(pats: Iterable[Sequence[str]]) -> Pattern[str]:
+  alts = ('\\0'.join(translate_part(p) for p in parts) for parts in pats)
+  return re.compile('|'.join(f"(?:{a})" for a in alts))
+
+
+# matches any number of whole parts, each followed by the separator
+_ANY_PARTS: Final = '(?:[^\\0]+\\0)*'
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class Glob:
+  """a Path.glob pattern compiled so that a path relative to the dir it's globbed
+  in can be tested against it, without listing anything
+  """
+  pattern: str
+  # matches the path's parts, each followed by a NUL
+  regex: Pattern[str]
+  # a pattern that ends in '**' only yields directories
+  dirs_only: bool
+
+  @classmethod
+  def compile(cls, pattern: str) -> 'Glob':
+    parts = PurePosixPath(pattern).parts
+    if not parts or parts[0] == '/':
+      raise ValueError(f"glob must be a non-empty relative pattern: {pattern!r}")
+    res: List[str] = []
+    for part in parts:
+      if part == '**':
+        if not res or res[-1] != _ANY_PARTS:
+          res.append(_ANY_PARTS)
+      else:
+        res.append(translate_part(part) + '\\0')
+    return cls(pattern=pattern, regex=re.compile(''.join(res)), dirs_only=parts[-1] == '**')
+
+  def match_parts(self, parts: Sequence[str], is_dir: bool) -> bool:
+    """True if the glob yields the path made of parts, which is a dir if is_dir.
+    a trailing '**' yields the dir the '**' starts from, but not an empty path
+    """
+    if not parts or (self.dirs_only and not is_dir):
+      return False
+    return self.regex.fullmatch(_SEP.join(parts) + _SEP) is not None
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class PathMatcher:
+  """a set of Path.match patterns compiled so that a path can be tested against
+  all of them at once
+
+  patterns are grouped by the number of parts they have. relative patterns are
+  anchored on the right so only the last n parts of a path are joined and checked
+  against the single combined regex for n. absolute patterns must match every part.
+  single part patterns without wildcards (the common case) are a set lookup.
+
+  matching is case sensitive, following PurePosixPath.
+  """
+
+  # single part patterns without any wildcards, these are checked against the name
+  literals: FrozenSet[str]
+
+  # part count -> combined regex for relative patterns with that many parts
+  relative: Dict[int, Pattern[str]]
+
+  # part count (excluding the root) -> combined regex for absolute patterns
+  anchored: Dict[int, Pattern[str]]
+
+  @classmethod
+  def compile(cls, patterns: Iterable[str]) -> 'PathMatcher':
+    literals = set()
+    relative: Dict[int, List[Sequence[str]]] = {}
+    anchored: Dict[int, List[Sequence[str]]] = {}
+
+    for pattern in patterns:
+      pp = PurePosixPath(pattern)
+      parts = pp.parts
+      if not parts:
+        raise ValueError(f"empty pattern: {pattern!r}")
+      if pp.root:
+        anchored.setdefault(len(parts) - 1, []).append(parts[1:])
+      elif len(parts) == 1 and not has_magic(parts[0]):
+        literals.add(parts[0])
+      else:
+        relative.setdefault(len(parts), []).append(parts)
+
+    return cls(
+      literals=frozenset(literals),
+      relative={n: _combine(ps) for n, ps in sorted(relative.items())},
+      anchored={n: _combine(ps) for n, ps in sorted(anchored.items())},
+    )
+
+  def match_parts(self, parts: Sequence[str]) -> bool:
+    """like match, but for a path that has already been split into its parts"""
+    if not parts:
+      return False
+
+    if parts[-1] in self.literals:
+      return True
+
+    plen = len(parts)
+    for n, rx in self.relative.items():
+      if n > plen:
+        break
+      if rx.fullmatch(_SEP.join(parts[plen - n:])) is not None:
+        return True
+
+    if self.anchored and parts[0] == '/':
+      anchored_rx = self.anchored.get(plen - 1)
+      if anchored_rx is not None and anchored_rx.fullmatch(_SEP.join(parts[1:])) is not None:
+        return True
+
+    return False
+
+  def match(self, p: PurePath) -> bool:
+    """returns True if any of the patterns would return True from p.match(pattern)"""
+    return self.match_parts(p.parts)
+
+  def __bool__(self) -> bool:
+    return bool(self.literals or self.relative or self.anchored)
+
+
+_RECURSIVE: Final = '**'
+
+# (index of a glob in a GlobSet, index of the next of its parts to match)
+GlobState = Tuple[int, int]
+
+
+def compilable_glob(pattern: str) -> bool:
+  """True if GlobSet can take pattern. anything else has to be left to Path.glob"""
+  pp = PurePosixPath(pattern)
+  return bool(pp.parts) and not pp.root and '..' not in pp.parts
+
+
+def _is_universal(part: str) -> bool:
+  """True if a part pattern matches every name"""
+  return bool(part) and set(part) == {'*'}
+
+
+def _part_covers(q: str, r: str) -> bool:
+  """True if every name glob part r can match is also matched by exclude part q"""
+  return _is_universal(q) or q == r or (
+    not has_magic(r) and re.fullmatch(translate_part(q), r) is not None
+  )
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class GlobSet:
+  """a number of Path.glob patterns, and the Path.match excludes that will be applied
+  to what they yield, compiled so that they can all be matched in one walk of the
+  dir they're globbed in
+
+  the walk keeps a set of GlobStates for each dir it's in. an entry of the dir is
+  tested against the next part of each, which either yields it, or moves the glob on
+  to a state for the entry if it's a dir. a dir with no states left isn't listed.
+  '**' behaves as in Path.glob: it matches the dir it's in and any dir under it, but
+  doesn't go into symlinked dirs.
+  """
+  # each glob's parts, with runs of '**' collapsed into one
+  globs: List[Tuple[str, ...]]
+  # whether each glob only yields dirs, i.e. it ends in '**' or '/'
+  dirs_only: List[bool]
+  # part -> its regex, for parts with wildcards
+  regexes: Dict[str, Pattern[str]]
+  # the parts of each relative exclude
+  excludes: List[Tuple[str, ...]]
+
+  @classmethod
+  def compile(cls, globs: Iterable[str], excludes: Iterable[str] = ()) -> 'GlobSet':
+    """compile globs, each of which must be compilable_glob"""
+    parts_list: List[Tuple[str, ...]] = []
+    dirs_only = []
+    regexes: Dict[str, Pattern[str]] = {}
+    for g in globs:
+      if not compilable_glob(g):
+        raise ValueError(f"can't compile glob {g!r}")
+      parts: List[str] = []
+      for part in PurePosixPath(g).parts:
+        if part == _RECURSIVE:
+          if parts and parts[-1] == _RECURSIVE:
+            continue
+        elif has_magic(part) and part not in regexes:
+          regexes[part] = re.compile(translate_part(part))
+        parts.append(part)
+      parts_list.append(tuple(parts))
+      dirs_only.append(parts[-1] == _RECURSIVE or g.endswith('/'))
+
+    return cls(
+      globs=parts_list,
+      dirs_only=dirs_only,
+      regexes=regexes,
+      excludes=[
+        PurePosixPath(e).parts for e in excludes if e and not PurePosixPath(e).root
+      ],
+    )
+
+  def initial(self) -> Set[GlobState]:
+    return self.closure((i, 0) for i in range(len(self.globs)))
+
+  def closure(self, states: Iterable[GlobState]) -> Set[GlobState]:
+    """states along with the states past any '**' they're at, as '**' can match no
+    dirs at all
+    """
+    out = set()
+    for i, j in states:
+      out.add((i, j))
+      parts = self.globs[i]
+      while j < len(parts) and parts[j] == _RECURSIVE:
+        j += 1
+        out.add((i, j))
+    return out
+
+  def is_done(self, state: GlobState) -> bool:
+    """True if state has matched all of its glob, which yields the dir it's in"""
+    i, j = state
+    return j == len(self.globs[i])
+
+  def literal(self, state: GlobState) -> Optional[str]:
+    """the name state matches next, if it's one without wildcards"""
+    i, j = state
+    part = self.globs[i][j]
+    return None if part == _RECURSIVE or part in self.regexes else part
+
+  def step(
+    self,
+    states: Iterable[GlobState],
+    name: str,
+    is_dir: Callable[[], bool],
+    is_real_dir: Callable[[], bool],
+  ) -> Tuple[List[int], Set[GlobState]]:
+    """match an entry called name against states. is_dir says if it's a dir or a
+    symlink to one, is_real_dir if it's a dir that isn't a symlink. they're only
+    called if they're needed
+
+    returns the globs that yield the entry, and the states for it if it's a dir.
+    states that are done are passed over
+    """
+    yields: List[int] = []
+    nxt: Set[GlobState] = set()
+    for i, j in states:
+      parts = self.globs[i]
+      if j == len(parts):
+        continue
+      part = parts[j]
+      if part == _RECURSIVE:
+        if is_real_dir():
+          nxt.add((i, j))
+        continue
+      rx = self.regexes.get(part)
+      if (name != part) if rx is None else (rx.fullmatch(name) is None):
+        continue
+      if j == len(parts) - 1:
+        if not self.dirs_only[i] or is_dir():
+          yields.append(i)
+      elif is_dir():
+        nxt.add((i, j + 1))
+    return yields, self.closure(nxt)
+
+  def covered(self, state: GlobState, dir_parts: Sequence[str]) -> bool:
+    """True if every path state could yield under the dir with dir_parts would be
+    excluded, so the dir needn't be walked for it
+
+    excludes are matched as Path.match does, against the end of a path, so an
+    excluded dir doesn't exclude what's in it. this only finds the cases that can
+    be told from the patterns alone, i.e. the glob's last parts are the exclude's.
+    """
+    i, j = state
+    rest = self.globs[i][j:]
+    for q in self.excludes:
+      if _RECURSIVE in rest:
+        # only the parts after the last '**' are known
+        fixed = len(rest) - 1 - max(n for n, p in enumerate(rest) if p == _RECURSIVE)
+        if len(q) > fixed:
+          continue
+        if all(_part_covers(a, b) for a, b in zip(q, rest[len(rest) - len(q):])):
+          return True
+        continue
+
+      if len(q) <= len(rest):
+        if all(_part_covers(a, b) for a, b in zip(q, rest[len(rest) - len(q):])):
+          return True
+        continue
+
+      # the exclude reaches up into the dir's own path
+      head = q[:len(q) - len(rest)]
+      if len(head) > len(dir_parts):
+        continue
+      tail = dir_parts[len(dir_parts) - len(head):]
+      if all(re.fullmatch(translate_part(a), b) for a, b in zip(head, tail)) and all(
+        _part_covers(a, b) for a, b in zip(q[len(head):], rest)
+      ):
+        return True
+    return False
+
@@ -0,0 +1,389 @@
+import json
+import logging
+import os
+import os.path as osp
+from array import array
+from collections import Counter
+from itertools import chain
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Set, TextIO, Tuple, cast
+
+import attr
+import cattr
+from typing_extensions import Final
+
+from . import gitindex
+from .compact import LinkTable
+from .config import FileGroup, Settings, map_file_groups
+from .dotfile import Entry, LinkData, SyscallCounter, glob_dirs
+from .exceptions import InvalidPlanFile
+
+log = logging.getLogger(__name__)
+
+# (st_ino, st_mtime_ns) of a directory, or None if it doesn't exist
+Stamp = Optional[Tuple[int, int]]
+
+# (st_dev, st_ino) of a file
+Inode = Tuple[int, int]
+
+# a claim on a link path is (group number << _ROW_BITS) | row number
+_ROW_BITS: Final = 40
+_ROW_MASK: Final = (1 << _ROW_BITS) - 1
+
+
+def _stamp(d: Path, counter: SyscallCounter) -> Stamp:
+  counter['stat'] += 1
+  try:
+    st = os.stat(d)
+    return st.st_ino, st.st_mtime_ns
+  except FileNotFoundError:
+    return None
+
+
+def _inode(p: str, counter: SyscallCounter) -> Optional[Inode]:
+  counter['stat'] += 1
+  try:
+    st = os.stat(p)
+    return st.st_dev, st.st_ino
+  except FileNotFoundError:
+    return None
+
+
+@attr.s(auto_attribs=True)
+class GroupPlan:
+  """the collected links of one FileGroup, along with the state of the directories
+  they were collected from
+  """
+  file_group: FileGroup
+
+  # the link of every collected vpath, in vpath order, before deduplication
+  table: LinkTable
+
+  # the st_dev and st_ino of each vpath, following symlinks. an inode of 0 is one
+  # that doesn't exist
+  devs: 'array[int]'
+  inodes: 'array[int]'
+
+  # every directory that was listed to collect vpaths, and its stamp at the time
+  stamps: Dict[Path, Stamp]
+
+  # the rows of table left when duplicate link names are removed, sorted by link
+  # name, see FileGroup.link_data
+  winners: List[int] = attr.ib(init=False)
+
+  def __attrs_post_init__(self) -> None:
+    self.winners = self.table.first_by_link_name()
+
+  @classmethod
+  def scan(cls, fg: FileGroup, counter: SyscallCounter) -> 'GroupPlan':
+    counter['collect'] += 1
+
+    # stamp before collecting so that a change made while we scan is seen next time
+    watched = [fg.base_dir.joinpath(d) for d in fg.dirs]
+    # every dir a glob walks through, so a new match anywhere along it is seen
+    for g in fg.globs or []:
+      watched.extend(glob_dirs(fg.base_dir, g))
+    if fg.source == 'git-index':
+      # files can be added or removed from the index without touching any dir
+      index = gitindex.index_path(fg.base_dir)
+      if index is not None:
+        watched.append(index)
+    stamps = {d: _stamp(d, counter) for d in watched}
+
+    parents: Set[Path] = set()
+
+    def entries() -> Iterator[Entry]:
+      for e in fg.iter_collect_entries(counter):
+        parents.add(e[1])
+        yield e
+
+    table = fg.raw_link_table(counter, entries())
+    for d in parents - stamps.keys():
+      stamps[d] = _stamp(d, counter)
+
+    devs, inodes = array('Q'), array('Q')
+    for n in range(len(table)):
+      inode = _inode(table.vpath(n), counter)
+      devs.append(0 if inode is None else inode[0])
+      inodes.append(0 if inode is None else inode[1])
+
+    return cls(file_group=fg, table=table, devs=devs, inodes=inodes, stamps=stamps)
+
+  @property
+  def vpaths(self) -> List[Path]:
+    return [Path(self.table.vpath(n)) for n in range(len(self.table))]
+
+  def is_stale(self, counter: SyscallCounter) -> bool:
+    """True if any of the directories we collected from have changed since.
+
+    directories are compared by inode and mtime, so an edit to a file's contents
+    is not a change, but adding, removing or renaming an entry is.
+    """
+    return any(_stamp(d, counter) != st for d, st in self.stamps.items())
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class Claim:
+  """a group's LinkData that lays claim to a link path or a source file"""
+  group: str
+  link_data: LinkData
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class LinkPathCollision:
+  """more than one vpath would be linked at link_path. the winner's link is created,
+  the losers' are dropped from the plan.
+  """
+  link_path: Path
+  winner: Claim
+  losers: List[Claim]
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class SourceAlias:
+  """different vpaths that are the same file (i.e. hard links, or reached through a
+  symlinked directory), so that file will be linked from more than one place
+  """
+  dev: int
+  ino: int
+  claims: List[Claim]
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class CollisionReport:
+  link_paths: List[LinkPathCollision]
+  aliases: List[SourceAlias]
+
+  def __bool__(self) -> bool:
+    return bool(self.link_paths or self.aliases)
+
+  def to_json(self) -> str:
+    return json.dumps(cattr.unstructure(self), indent=2)
+
+
+class Plan:
+  """the vpaths and link data for every FileGroup of a Settings, collected once and
+  then reused until they're invalidated or their source directories change
+
+  counter tallies the work done on our behalf: a 'collect' for every group that is
+  (re)scanned, along with the syscalls made doing so and checking for changes.
+
+  groups are scanned concurrently, see map_file_groups.
+  """
+
+  def __init__(self, settings: Settings, jobs: Optional[int] = None) -> None:
+    self.settings = settings
+    # how many groups to scan at once, see map_file_groups
+    self.jobs = jobs
+    self.counter: SyscallCounter = Counter()
+    self._groups: List[Optional[GroupPlan]] = [None for _ in settings.file_groups]
+    self._link_table: Optional[LinkTable] = None
+    self._collisions: Optional[CollisionReport] = None
+
+  @classmethod
+  def build(cls, settings: Settings, jobs: Optional[int] = None) -> 'Plan':
+    plan = cls(settings, jobs)
+    plan.refresh()
+    return plan
+
+  def invalidate(self, file_group: Optional[FileGroup] = None) -> None:
+    """forget what was collected for file_group (or every group if None), it will be
+    collected again on the next refresh or access
+    """
+    for n, fg in enumerate(self.settings.file_groups):
+      if file_group is None or fg is file_group:
+        self._groups[n] = None
+    self._link_table = None
+    self._collisions = None
+
+  def _scan(self, n: int, fg: FileGroup, check: bool) -> Tuple[Optional[GroupPlan], SyscallCounter]:
+    # runs on a worker thread, so it tallies into its own counter
+    counter: SyscallCounter = Counter()
+    gp = self._groups[n]
+    if gp is None or (check and gp.is_stale(counter)):
+      log.debug(f"collecting file group {n}")
+      return GroupPlan.scan(fg, counter), counter
+    return None, counter
+
+  def _rescan(self, check: bool) -> List[FileGroup]:
+    """scan the missing groups, and the stale ones if check is True, concurrently"""
+    fgs = self.settings.file_groups
+    todo = [n for n, gp in enumerate(self._groups) if check or gp is None]
+    results = map_file_groups(lambda n: self._scan(n, fgs[n], check), todo, self.jobs)
+
+    rescanned = []
+    for n, (gp, counter) in zip(todo, results):
+      self.counter.update(counter)
+      if gp is not None:
+        self._groups[n] = gp
+        rescanned.append(fgs[n])
+    if rescanned:
+      self._link_table = None
+      self._collisions = None
+    return rescanned
+
+  def refresh(self) -> List[FileGroup]:
+    """rescan the groups that were invalidated or whose source directories changed,
+    returns the groups that were rescanned
+    """
+    return self._rescan(check=True)
+
+  @property
+  def groups(self) -> List[GroupPlan]:
+    self._rescan(check=False)
+    return [cast(GroupPlan, gp) for gp in self._groups]
+
+  @property
+  def vpaths(self) -> List[Path]:
+    return list(chain.from_iterable(gp.vpaths for gp in self.groups))
+
+  def _row(self, claim: int) -> Tuple[LinkTable, int]:
+    return self.groups[claim >> _ROW_BITS].table, claim & _ROW_MASK
+
+  def _claim(self, claim: int) -> Claim:
+    t, n = self._row(claim)
+    return Claim(group=self.settings.named_file_groups[claim >> _ROW_BITS][0], link_data=t[n])
+
+  def _index(self) -> None:
+    """index every group's links by absolute link path and by source inode, so that
+    a link path claimed by more than one group goes to the first, and any collision
+    or alias is reported before anything touches the filesystem
+
+    a claim is a group's number and a row of its table packed into an int. only the
+    first claim on each link path and inode is indexed, and Paths are only made for
+    the claims in the report.
+    """
+    groups = self.groups
+    # normalized link dir -> link name -> the first claim on it
+    by_link_path: Dict[str, Dict[str, int]] = {}
+    by_inode: Dict[Inode, int] = {}
+    # the first claim on a link path or inode -> the claims after it
+    losers: Dict[int, List[int]] = {}
+    aliases: Dict[int, List[int]] = {}
+    norm: Dict[str, str] = {}
+
+    def vpath(claim: int) -> str:
+      t, n = self._row(claim)
+      return t.vpath(n)
+
+    for g, gp in enumerate(groups):
+      t = gp.table
+      for n in range(len(t)):
+        claim = (g << _ROW_BITS) | n
+        ldir = t.link_dir(n)
+        key = norm.get(ldir)
+        if key is None:
+          key = norm[ldir] = osp.normpath(ldir)
+        first = by_link_path.setdefault(key, {}).setdefault(t.link_name(n), claim)
+        if first != claim:
+          v = t.vpath(n)
+          if any(vpath(c) == v for c in [first, *losers.get(first, [])]):
+            continue  # the same vpath was collected more than once
+          losers.setdefault(first, []).append(claim)
+
+        if gp.inodes[n]:
+          first = by_inode.setdefault((gp.devs[n], gp.inodes[n]), claim)
+          if first != claim:
+            aliases.setdefault(first, []).append(claim)
+
+    def link_path(claim: int) -> Tuple[str, str]:
+      t, n = self._row(claim)
+      return norm[t.link_dir(n)], t.link_name(n)
+
+    def wins(claim: int) -> bool:
+      key, name = link_path(claim)
+      return by_link_path[key][name] == claim
+
+    table = LinkTable()
+    for g, gp in enumerate(groups):
+      gp.table.select((n for n in gp.winners if wins((g << _ROW_BITS) | n)), table)
+    self._link_table = table
+
+    # claims are numbered in the order they're made, so these are in the order of
+    # the first claim, as they'd be found
+    self._collisions = CollisionReport(
+      link_paths=[
+        LinkPathCollision(
+          link_path=Path(*link_path(first)),
+          winner=self._claim(first),
+          losers=[self._claim(c) for c in cs],
+        )
+        for first, cs in sorted(losers.items())
+      ],
+      aliases=[
+        SourceAlias(
+          dev=groups[first >> _ROW_BITS].devs[first & _ROW_MASK],
+          ino=groups[first >> _ROW_BITS].inodes[first & _ROW_MASK],
+          claims=[self._claim(c) for c in [first, *cs]],
+        )
+        for first, cs in sorted(aliases.items())
+        if len({vpath(c) for c in [first, *cs]}) > 1
+      ],
+    )
+
+  @property
+  def link_table(self) -> LinkTable:
+    """the links of every group, where each link path goes to the first group (and
+    within a group, the first vpath) that claims it, held compactly
+    """
+    if self._link_table is None:
+      self._index()
+    return cast(LinkTable, self._link_table)
+
+  @property
+  def link_data(self) -> List[LinkData]:
+    """link_table as a list of LinkData"""
+    return list(self.link_table)
+
+  @property
+  def collisions(self) -> CollisionReport:
+    if self._collisions is None:
+      self._index()
+    return cast(CollisionReport, self._collisions)
+
+
+PLAN_FILE_VERSION: Final = 1
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class PlannedLink:
+  link_data: LinkData
+
+  # what was at the link path when the plan was made, see fs.link_state
+  state: str
+
+  # what applying the plan was expected to do about it: 'create', 'none', or the
+  # name of the conflict strategy that would be used
+  action: str
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class PlanFile:
+  """everything needed to apply a Plan without collecting, so that a plan can be
+  made once and applied on many hosts that share the same checkout
+  """
+  version: int
+  conflicting_file_strategy: str
+  conflicting_symlink_strategy: str
+  create_missing_target_dirs: bool
+  links: List[PlannedLink]
+  collisions: CollisionReport
+  backup_dir: Optional[Path] = None
+  backup_store: Optional[Path] = None
+  target_dir_mode: int = 0o755
+
+  def dump(self, fp: TextIO) -> None:
+    json.dump(cattr.unstructure(self), fp, indent=2)
+
+  @classmethod
+  def load(cls, fp: TextIO) -> 'PlanFile':
+    try:
+      obj: Any = json.load(fp)
+    except ValueError as e:
+      raise InvalidPlanFile(fp.name, str(e)) from e
+    if not isinstance(obj, dict) or obj.get('version') != PLAN_FILE_VERSION:
+      raise InvalidPlanFile(fp.name, f"expected a version {PLAN_FILE_VERSION} plan")
+    try:
+      return cast(PlanFile, cattr.structure(obj, cls))
+    except Exception as e:
+      raise InvalidPlanFile(fp.name, str(e)) from e
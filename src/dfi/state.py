@@ -0,0 +1,116 @@
+"""a fingerprint of everything a run's outcome depends on, saved after each run that
+succeeds, so that the next run can tell nothing has changed without collecting or
+checking any links
+
+the fingerprint is a hash of the settings and the identity and mtime of each dir
+that collecting lists (the source dirs, and the dirs globs walk through) and of
+each target dir. adding, removing or renaming an entry in any of them changes the
+dir's mtime. what it can't see is a change that doesn't touch a dir's entries,
+i.e. a symlink in a source dir whose target comes or goes. use --force for those.
+"""
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional
+
+import attr
+import cattr
+from typing_extensions import Final
+
+from . import gitindex
+from .config import Settings
+from .dotfile import glob_dirs
+
+log = logging.getLogger(__name__)
+
+# bumped whenever what goes into a fingerprint changes, so old state files don't match
+STATE_VERSION: Final = 1
+
+
+def source_dirs(settings: Settings) -> List[Path]:
+  """every dir whose entries collecting settings' file groups depends on"""
+  dirs: List[Path] = []
+  for fg in settings.file_groups:
+    dirs.extend(fg.base_dir.joinpath(d) for d in fg.dirs)
+    for g in fg.globs or []:
+      dirs.extend(glob_dirs(fg.base_dir, g))
+    if fg.source == 'git-index':
+      # what's tracked can change without touching any dir. it's a file, but it's
+      # stat'd the same way
+      index = gitindex.index_path(fg.base_dir)
+      if index is not None:
+        dirs.append(index)
+  return list(dict.fromkeys(dirs))
+
+
+def target_dirs(settings: Settings) -> List[Path]:
+  return list(dict.fromkeys(fg.target_dir for fg in settings.file_groups))
+
+
+def _stat_dirs(dirs: Iterable[Path]) -> Dict[str, Optional[List[int]]]:
+  stats: Dict[str, Optional[List[int]]] = {}
+  for d in dirs:
+    try:
+      st = os.stat(d)
+    except (FileNotFoundError, NotADirectoryError):
+      stats[str(d)] = None
+    else:
+      stats[str(d)] = [st.st_dev, st.st_ino, st.st_mtime_ns]
+  return stats
+
+
+@attr.s(frozen=True, slots=True, auto_attribs=True)
+class Fingerprint:
+  version: int
+  # sha256 of the settings as json
+  settings: str
+  # dir -> [dev, inode, mtime in ns], or None if it didn't exist
+  dirs: Dict[str, Optional[List[int]]]
+
+  # for --incremental, the commit base_dir's checkout was at and the files that
+  # differed from it, relative to the checkout's root. these don't take part in
+  # comparing fingerprints
+  commit: Optional[str] = attr.ib(default=None, eq=False)
+  dirty: List[str] = attr.ib(factory=list, eq=False)
+
+  @classmethod
+  def of(cls, settings: Settings) -> 'Fingerprint':
+    s = json.dumps(cattr.unstructure(settings), sort_keys=True)
+    return cls(
+      version=STATE_VERSION,
+      settings=hashlib.sha256(s.encode('utf8')).hexdigest(),
+      dirs=_stat_dirs(source_dirs(settings) + target_dirs(settings)),
+    )
+
+  def after_run(self, settings: Settings) -> 'Fingerprint':
+    """this fingerprint, taken before a run, with the target dirs as the run left
+    them. a source dir that changes while the run is collecting still won't match
+    """
+    return attr.evolve(self, dirs={**self.dirs, **_stat_dirs(target_dirs(settings))})
+
+
+def load(path: Path) -> Optional[Fingerprint]:
+  """the fingerprint saved at path, or None if there isn't one that can be read"""
+  try:
+    with open(path, encoding='utf8') as f:
+      return cattr.structure(json.load(f), Fingerprint)
+  except FileNotFoundError:
+    return None
+  except (ValueError, TypeError, KeyError) as e:
+    log.warning(f"ignoring unreadable state file {path}: {e}")
+    return None
+
+
+def save(path: Path, settings: Settings, before: Fingerprint) -> Fingerprint:
+  """save before.after_run(settings) at path, and return it"""
+  # make the file first, it may well be in one of the target dirs itself. writing to
+  # it after that doesn't touch the dir. a write that's cut short can't be loaded,
+  # which only means the next run isn't skipped
+  os.makedirs(path.parent, exist_ok=True)
+  open(path, 'a').close()
+  fp = before.after_run(settings)
+  with open(path, 'w', encoding='utf8') as f:
+    json.dump(cattr.unstructure(fp), f)
+  return fp
@@ -1,12 +1,15 @@
 import json
 import os
+from pathlib import Path
 
 import cattr
 import pytest
 from click.testing import Result
 
 from dfi import app
+from dfi.backup import ObjectStore
 from dfi.config import Settings, FileGroup
+from dfi.exceptions import InvalidPlanFile
 
 from .conftest import chdir
 
@@ -60,3 +63,136 @@ def test_app_flag_parsing_dotfiles(df_paths, cli_runner):
       excludes=None,
       target_dir=df_paths.home_dir / '.local' / 'bin'
     )
+
+
+def test_app_settings_file(df_paths, cli_runner):
+  settings = Settings(
+    base_dir=df_paths.base_dir,
+    groups=[
+      FileGroup(
+        base_dir=df_paths.base_dir,
+        dirs=[df_paths.bin_dir],
+        globs=None,
+        excludes=['.*'],
+        target_dir=df_paths.home_dir / 'bin',
+        name='bin',
+      )
+    ]
+  )
+  settings_path = df_paths.tmp / 'settings.json'
+  settings_path.write_text(json.dumps(cattr.unstructure(settings)))
+
+  with chdir(df_paths.base_dir):
+    result: Result = cli_runner.invoke(app.main, args=['--settings', str(settings_path)])
+    if result.exit_code != 0:
+      raise result.exception from None
+
+  for b in ['ctags', 'pants', 'pip']:
+    assert (df_paths.home_dir / 'bin' / b).is_symlink()
+
+
+def test_app_plan_then_apply(df_paths, cli_runner):
+  bashrc = df_paths.home_dir / 'bashrc'
+  bashrc.write_text('export EXISTING=1')
+  plan_path = df_paths.tmp / 'plan.json'
+
+  with chdir(df_paths.base_dir):
+    result: Result = cli_runner.invoke(
+      app.main,
+      args=[
+        f'--dotfile-dir={df_paths.dotfiles_dir}',
+        '--dotfile-excludes', '.*',
+        'plan', '--out', str(plan_path),
+      ]
+    )
+    if result.exit_code != 0:
+      raise result.exception from None
+
+  # planning doesn't touch anything
+  assert not bashrc.is_symlink()
+
+  saved = json.loads(plan_path.read_text())
+  actions = {Path(pl['link_data']['link_path']).name: pl['action'] for pl in saved['links']}
+  assert actions == {
+    'bash_profile': 'create', 'bashrc': 'backup', 'inputrc': 'create', 'vimrc': 'create'
+  }
+
+  # applying doesn't need the repo's layout, only the plan
+  with chdir(df_paths.tmp):
+    result = cli_runner.invoke(app.main, args=['apply', '--plan', str(plan_path)])
+    if result.exit_code != 0:
+      raise result.exception from None
+
+  for name in actions:
+    assert (df_paths.home_dir / name).is_symlink()
+  assert len(list(df_paths.home_dir.glob('bashrc.dfi_*'))) == 1
+
+
+def test_app_apply_rejects_bad_plan(df_paths, cli_runner):
+  plan_path = df_paths.tmp / 'plan.json'
+  plan_path.write_text(json.dumps({'version': 0}))
+
+  result: Result = cli_runner.invoke(app.main, args=['apply', '--plan', str(plan_path)])
+  assert isinstance(result.exception, InvalidPlanFile)
+
+
+def test_app_backup_store_and_restore(df_paths, cli_runner):
+  bashrc = df_paths.home_dir / 'bashrc'
+  bashrc.write_text('export EXISTING=1')
+  store = df_paths.tmp / 'state'
+
+  with chdir(df_paths.base_dir):
+    result: Result = cli_runner.invoke(
+      app.main,
+      args=[
+        f'--dotfile-dir={df_paths.dotfiles_dir}',
+        '--dotfile-excludes', '.*',
+        '--backup-store', str(store),
+      ]
+    )
+    if result.exit_code != 0:
+      raise result.exception from None
+
+  assert bashrc.is_symlink()
+
+  # restored over the link
+  result = cli_runner.invoke(app.main, args=['restore', '--store', str(store), str(bashrc)])
+  if result.exit_code != 0:
+    raise result.exception from None
+  assert not bashrc.is_symlink()
+  assert bashrc.read_text() == 'export EXISTING=1'
+
+
+def test_app_restore_directory(df_paths, cli_runner):
+  vim = df_paths.home_dir / '.vim'
+  vim.joinpath('plugin').mkdir(parents=True)
+  vim.joinpath('plugin', 'a.vim').write_text('a')
+  vim.joinpath('after').mkdir()
+  store = df_paths.tmp / 'state'
+  with ObjectStore(store) as objects:
+    objects.backup(vim)
+  vim.symlink_to(df_paths.dotfiles_dir)
+
+  result: Result = cli_runner.invoke(app.main, args=['restore', '--store', str(store), str(vim)])
+  if result.exit_code != 0:
+    raise result.exception from None
+  assert not vim.is_symlink()
+  assert vim.joinpath('plugin', 'a.vim').read_text() == 'a'
+  assert vim.joinpath('after').is_dir()
+
+
+def test_app_prune(df_paths, cli_runner):
+  args = [f'--dotfile-dir={df_paths.dotfiles_dir}', '--dotfile-excludes', '.*']
+  with chdir(df_paths.base_dir):
+    result: Result = cli_runner.invoke(app.main, args=args)
+    if result.exit_code != 0:
+      raise result.exception from None
+
+    df_paths.dotfiles_dir.joinpath('inputrc').unlink()
+    result = cli_runner.invoke(app.main, args=args + ['prune'])
+    if result.exit_code != 0:
+      raise result.exception from None
+
+  assert result.output == f"removed {df_paths.home_dir / 'inputrc'}\n"
+  assert not os.path.lexists(df_paths.home_dir / 'inputrc')
+  assert (df_paths.home_dir / 'bashrc').is_symlink()
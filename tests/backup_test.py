@@ -0,0 +1,364 @@
+import errno
+import json
+import os
+import shutil
+import socket
+import stat
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# mypy: ignore-missing-imports
+from dfi import backup  # type: ignore
+from dfi.backup import BackupRun, ObjectStore  # type: ignore
+from dfi.exceptions import BackupFailed, RestoreConflict  # type: ignore
+
+from .conftest import FixturePaths
+
+
+def test_backup_run(df_paths: FixturePaths, monkeypatch):
+  monkeypatch.setattr(backup, 'timestamp', lambda: '20200101000000')
+  home = df_paths.home_dir
+  bashrc = home / '.bashrc'
+  bashrc.write_text('mine')
+  tool = home / '.config' / 'tool' / 'rc'
+  tool.parent.mkdir(parents=True)
+  tool.write_text('also mine')
+
+  with BackupRun(home / '.dfi-backups') as run:
+    assert run.root is None
+    assert run.backup(bashrc) == home / '.dfi-backups' / '20200101000000' / '.bashrc'
+    run.strategy(tool)
+
+  root = home / '.dfi-backups' / '20200101000000'
+  assert run.root == root
+  assert not bashrc.exists() and not tool.exists()
+  assert (root / '.bashrc').read_text() == 'mine'
+  assert (root / '.config' / 'tool' / 'rc').read_text() == 'also mine'
+
+  manifest = [json.loads(l) for l in (root / backup.MANIFEST_NAME).read_text().splitlines()]
+  assert manifest == [
+    {'original': str(bashrc), 'backup': str(root / '.bashrc')},
+    {'original': str(tool), 'backup': str(root / '.config' / 'tool' / 'rc')},
+  ]
+
+
+def test_backup_run_outside_base_and_second_run(df_paths: FixturePaths, monkeypatch):
+  monkeypatch.setattr(backup, 'timestamp', lambda: '20200101000000')
+  backup_dir = df_paths.home_dir / '.dfi-backups'
+  elsewhere = df_paths.tmp / 'elsewhere'
+  elsewhere.write_text('')
+
+  with BackupRun(backup_dir) as run:
+    dest = run.backup(elsewhere)
+  assert dest == backup_dir / '20200101000000' / backup.OUTSIDE_BASE_DIR / elsewhere.relative_to('/')
+
+  # a second run in the same second gets its own root
+  other = df_paths.home_dir / 'other'
+  other.write_text('')
+  with BackupRun(backup_dir) as run:
+    assert run.backup(other) == backup_dir / '20200101000000-1' / 'other'
+
+
+def test_backup_run_never_replaces_a_backup(df_paths: FixturePaths, monkeypatch):
+  monkeypatch.setattr(backup, 'timestamp', lambda: '20200101000000')
+  base = df_paths.tmp / 'base'
+  inside = base / 'etc' / 'x'
+  outside = df_paths.tmp / 'etc' / 'x'
+  for p, text in [(inside, 'inside'), (outside, 'outside')]:
+    p.parent.mkdir(parents=True)
+    p.write_text(text)
+  clash = base / backup.OUTSIDE_BASE_DIR / outside.relative_to('/')
+  clash.parent.mkdir(parents=True)
+  clash.write_text('clash')
+
+  with BackupRun(df_paths.tmp / 'backups', base) as run:
+    a = run.backup(inside)
+    b = run.backup(outside)
+    # the manifest is on disk as soon as each file has been moved
+    manifest = (run.root / backup.MANIFEST_NAME).read_text().splitlines()
+    assert [json.loads(l)['backup'] for l in manifest] == [str(a), str(b)]
+
+    with pytest.raises(BackupFailed):
+      run.backup(clash)
+
+  assert a != b
+  assert (a.read_text(), b.read_text()) == ('inside', 'outside')
+  assert clash.read_text() == 'clash'
+
+
+def test_backup_run_makes_nothing_until_needed(df_paths: FixturePaths):
+  with BackupRun(df_paths.home_dir / '.dfi-backups'):
+    pass
+  assert not (df_paths.home_dir / '.dfi-backups').exists()
+
+
+def test_object_store_dedups(df_paths: FixturePaths, monkeypatch):
+  store_dir = df_paths.tmp / 'state'
+  home = df_paths.home_dir
+  stamps = iter(['20200101000000', '20200102000000', '20200103000000'])
+  monkeypatch.setattr(backup, 'timestamp', lambda: next(stamps))
+
+  for text in ['stock', 'stock']:
+    home.joinpath('.bashrc').write_text(text)
+    home.joinpath('.profile').write_text('stock')
+    with ObjectStore(store_dir) as store:
+      store.backup(home / '.bashrc')
+      store.strategy(home / '.profile')
+    assert not home.joinpath('.bashrc').exists()
+
+  objects = [p for p in store_dir.joinpath(backup.OBJECTS_DIR).rglob('*') if p.is_file()]
+  assert len(objects) == 1
+  assert objects[0].read_text() == 'stock'
+
+  entries = ObjectStore(store_dir).entries()
+  assert [e.time for e in entries[str(home / '.bashrc')]] == ['20200101000000', '20200102000000']
+
+
+def test_object_store_restore(df_paths: FixturePaths, monkeypatch):
+  store_dir = df_paths.tmp / 'state'
+  bashrc = df_paths.home_dir / '.bashrc'
+  stamps = iter(['20200101000000', '20200102000000', '20200103000000'])
+  monkeypatch.setattr(backup, 'timestamp', lambda: next(stamps))
+
+  for text in ['first', 'second']:
+    bashrc.write_text(text)
+    bashrc.chmod(0o640)
+    with ObjectStore(store_dir) as store:
+      store.backup(bashrc)
+
+  # the link that took its place is still there
+  bashrc.symlink_to(df_paths.dotfiles_dir / 'bashrc')
+
+  store = ObjectStore(store_dir)
+  first = store.lookup(bashrc, '20200101120000')
+  assert first is not None and first.time == '20200101000000'
+  assert store.latest_under(bashrc, '20200101120000') == [first]
+  store.restore(bashrc, [first])
+  assert not bashrc.is_symlink()
+  assert bashrc.read_text() == 'first'
+  assert bashrc.stat().st_mode & 0o777 == 0o640
+  assert [p.name for p in bashrc.parent.iterdir() if p.name.startswith('.bashrc.')] == []
+
+  # the restored file is a copy, changing it doesn't change the store
+  bashrc.write_text('changed')
+  assert store.object_path(first.object).read_text() == 'first'
+
+  # and it isn't a link any more, so it's left alone
+  with pytest.raises(RestoreConflict):
+    store.restore(bashrc, store.latest_under(bashrc))
+  assert bashrc.read_text() == 'changed'
+
+  latest = store.latest_under(bashrc)
+  assert store.restore(bashrc, latest, df_paths.tmp / 'latest').read_text() == 'second'
+  assert store.lookup(df_paths.tmp / 'nope') is None
+  assert store.latest_under(df_paths.tmp / 'nope') == []
+
+
+def test_object_store_indexes_before_removing(df_paths: FixturePaths):
+  bashrc = df_paths.home_dir / '.bashrc'
+  bashrc.write_text('stock')
+  store_dir = df_paths.tmp / 'state'
+
+  store = ObjectStore(store_dir)
+  store.backup(bashrc)
+  # not closed, but the index already has it
+  entry = ObjectStore(store_dir).lookup(bashrc)
+  assert entry is not None
+  assert store.object_path(entry.object).read_text() == 'stock'
+  assert store.object_path(entry.object).stat().st_mode & 0o777 == 0o444
+  store.close()
+
+
+def test_object_store_copies_a_file_with_other_links(df_paths: FixturePaths):
+  bashrc = df_paths.home_dir / '.bashrc'
+  bashrc.write_text('stock')
+  bashrc.chmod(0o644)
+  other = df_paths.home_dir / 'bashrc.orig'
+  os.link(bashrc, other)
+
+  with ObjectStore(df_paths.tmp / 'state') as store:
+    store.backup(bashrc)
+
+  obj = store.object_path(store.lookup(bashrc).object)
+  assert not os.path.samefile(obj, other)
+  assert other.stat().st_mode & 0o777 == 0o644
+  other.write_text('edited')
+  assert obj.read_text() == 'stock'
+
+
+def test_object_store_directory(df_paths: FixturePaths):
+  d = df_paths.home_dir / '.vim'
+  d.joinpath('plugin').mkdir(parents=True)
+  d.joinpath('plugin', 'a.vim').write_text('a')
+  d.joinpath('vimrc').symlink_to('plugin/a.vim')
+
+  d.joinpath('empty').mkdir()
+  d.joinpath('plugin').chmod(0o750)
+
+  with ObjectStore(df_paths.tmp / 'state') as store:
+    store.backup(d)
+
+  assert not d.exists()
+  d.symlink_to(df_paths.dotfiles_dir)
+  store = ObjectStore(df_paths.tmp / 'state')
+  entries = store.latest_under(d)
+  assert [(e.kind, Path(e.path).relative_to(d)) for e in entries] == [
+    ('dir', Path('.')),
+    ('dir', Path('empty')),
+    ('dir', Path('plugin')),
+    ('file', Path('plugin/a.vim')),
+    ('symlink', Path('vimrc')),
+  ]
+  store.restore(d, entries)
+  assert not d.is_symlink()
+  assert d.joinpath('vimrc').read_text() == 'a'
+  assert d.joinpath('empty').is_dir()
+  assert d.joinpath('plugin').stat().st_mode & 0o777 == 0o750
+
+
+def _exdev(monkeypatch):
+  """make every rename fail as though it crossed filesystems"""
+  def rename(src, dst, *a, **kw):
+    raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), str(src))
+  monkeypatch.setattr(os, 'rename', rename)
+
+
+def _tree_contents(root: Path):
+  return {
+    p.relative_to(root): os.readlink(p) if p.is_symlink() else p.is_file() and p.read_bytes()
+    for p in root.rglob('*')
+  }
+
+
+def _tree(root: Path):
+  root.joinpath('sub', 'deeper').mkdir(parents=True)
+  for n in range(20):
+    root.joinpath('sub', f"f{n}").write_text(f"file {n}" * n)
+  root.joinpath('top').write_bytes(os.urandom(1 << 20))
+  root.joinpath('top').chmod(0o600)
+  root.joinpath('link').symlink_to('sub/f1')
+  return _tree_contents(root)
+
+
+def test_move_across_devices(df_paths: FixturePaths, monkeypatch):
+  src = df_paths.tmp / 'config'
+  expected = _tree(src)
+  single = df_paths.tmp / 'single'
+  single.write_text('single')
+  _exdev(monkeypatch)
+
+  backup.move(src, df_paths.tmp / 'moved', jobs=4)
+  backup.move(single, df_paths.tmp / 'single-moved')
+
+  moved = df_paths.tmp / 'moved'
+  assert not src.exists() and not single.exists()
+  assert _tree_contents(moved) == expected
+  assert moved.joinpath('top').stat().st_mode & 0o777 == 0o600
+  assert (df_paths.tmp / 'single-moved').read_text() == 'single'
+
+
+def test_move_across_devices_special_files(df_paths: FixturePaths, monkeypatch):
+  src = df_paths.tmp / 'run'
+  src.mkdir()
+  src.joinpath('rc').write_text('rc')
+  os.mkfifo(src / 'fifo')
+  os.chmod(src / 'fifo', 0o620)
+  with socket.socket(socket.AF_UNIX) as sock:
+    sock.bind(str(src / 'sock'))
+  single = df_paths.tmp / 'single-fifo'
+  os.mkfifo(single)
+  _exdev(monkeypatch)
+
+  moved = df_paths.tmp / 'moved'
+  backup.move(src, moved)
+  backup.move(single, df_paths.tmp / 'single-moved')
+
+  assert not src.exists() and not single.exists()
+  assert moved.joinpath('rc').read_text() == 'rc'
+  assert stat.S_ISFIFO(moved.joinpath('fifo').lstat().st_mode)
+  assert moved.joinpath('fifo').lstat().st_mode & 0o777 == 0o620
+  assert stat.S_ISSOCK(moved.joinpath('sock').lstat().st_mode)
+  assert stat.S_ISFIFO((df_paths.tmp / 'single-moved').lstat().st_mode)
+
+
+@pytest.mark.parametrize('kind', ['file', 'dir'])
+def test_move_across_devices_leaves_an_existing_dst(df_paths: FixturePaths, monkeypatch, kind):
+  src = df_paths.tmp / 'config'
+  expected = _tree(src) if kind == 'dir' else src.write_text('src')
+  dst = df_paths.tmp / 'there'
+  dst.mkdir()
+  dst.joinpath('mine').write_text('mine')
+  _exdev(monkeypatch)
+
+  with pytest.raises(FileExistsError):
+    backup.move(src, dst)
+
+  assert dst.joinpath('mine').read_text() == 'mine'
+  if kind == 'dir':
+    assert _tree_contents(src) == expected
+  else:
+    assert src.read_text() == 'src'
+
+  # and when it turns up after the check
+  real_lexists = os.path.lexists
+  monkeypatch.setattr(os.path, 'lexists', lambda p: False if p == dst else real_lexists(p))
+  with pytest.raises(FileExistsError):
+    backup.move(src, dst)
+  assert dst.joinpath('mine').read_text() == 'mine'
+
+
+def test_move_keeps_the_original_if_the_copy_is_bad(df_paths: FixturePaths, monkeypatch):
+  src = df_paths.tmp / 'config'
+  expected = _tree(src)
+  _exdev(monkeypatch)
+  monkeypatch.setattr(backup, '_same_contents', lambda a, b: False)
+
+  with pytest.raises(BackupFailed):
+    backup.move(src, df_paths.tmp / 'moved')
+
+  assert _tree_contents(src) == expected
+  assert not (df_paths.tmp / 'moved').exists()
+
+
+@pytest.mark.parametrize('without', [[], ['copy_file_range'], ['copy_file_range', 'sendfile']])
+def test_copy_file_fallbacks(df_paths: FixturePaths, monkeypatch, without):
+  monkeypatch.setattr(backup, 'fcntl', None)
+  for name in without:
+    monkeypatch.delattr(os, name, raising=False)
+  src = df_paths.tmp / 'src'
+  src.write_bytes(os.urandom(3 << 20))
+
+  backup.copy_file(src, df_paths.tmp / 'dst')
+
+  assert (df_paths.tmp / 'dst').read_bytes() == src.read_bytes()
+
+
+def test_copy_file_unsupported_copy_file_range(df_paths: FixturePaths, monkeypatch):
+  def copy_file_range(*a):
+    raise OSError(errno.EXDEV, 'nope')
+  monkeypatch.setattr(os, 'copy_file_range', copy_file_range, raising=False)
+  src = df_paths.tmp / 'src'
+  src.write_text('contents')
+
+  backup.copy_file(src, df_paths.tmp / 'dst')
+
+  assert (df_paths.tmp / 'dst').read_text() == 'contents'
+
+
+def test_backup_run_to_another_filesystem(df_paths: FixturePaths):
+  shm = Path('/dev/shm')
+  if not shm.is_dir() or shm.stat().st_dev == df_paths.tmp.stat().st_dev:
+    pytest.skip("no second filesystem to back up to")
+  backup_dir = Path(tempfile.mkdtemp(dir=shm))
+  src = df_paths.home_dir / '.config'
+  expected = _tree(src)
+
+  try:
+    with BackupRun(backup_dir / 'backups', base=df_paths.home_dir) as run:
+      dest = run.backup(src)
+    assert not src.exists()
+    assert _tree_contents(dest) == expected
+  finally:
+    shutil.rmtree(backup_dir)
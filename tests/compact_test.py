@@ -0,0 +1,58 @@
+from pathlib import Path
+
+# mypy: ignore-missing-imports
+from dfi.compact import LinkRow, LinkTable  # type: ignore
+from dfi.config import Settings  # type: ignore
+from dfi.dotfile import LinkData  # type: ignore
+
+from .conftest import FixturePaths
+
+
+def test_LinkTable_round_trips_LinkData():
+  target_dir = Path("/Users/foo")
+  lds = [
+    LinkData.for_path(Path("/Users/foo/.settings/dotfiles/bar"), target_dir, '.'),
+    LinkData.for_path(Path("/Volumes/blah/bin/baz"), target_dir),
+    LinkData.for_path(Path("/Users/foo/bar"), target_dir),
+    LinkData.for_path(Path("/Users"), target_dir),
+    LinkData(vpath=Path("/a/b"), link_path=Path("/c/d"), link_data=Path("../a/elsewhere")),
+  ]
+
+  table = LinkTable.from_link_data(lds)
+
+  assert len(table) == len(lds)
+  assert list(table) == lds
+  assert table[-1] == lds[-1]
+  assert table.row(0) == LinkRow(
+    vpath="/Users/foo/.settings/dotfiles/bar",
+    link_dir="/Users/foo",
+    link_name=".bar",
+    link_data=".settings/dotfiles/bar",
+  )
+  assert table.row(0).link_path == "/Users/foo/.bar"
+
+
+def test_LinkTable_select_first_by_link_name():
+  target_dir = Path("/Users/foo")
+  lds = [
+    LinkData.for_path(Path("/Users/foo/.settings/b/zed"), target_dir),
+    LinkData.for_path(Path("/Volumes/blah/bin/abc"), target_dir),
+    LinkData.for_path(Path("/Users/foo/.settings/a/zed"), target_dir),
+    LinkData(vpath=Path("/a/b"), link_path=Path("/Users/foo/b"), link_data=Path("../a/elsewhere")),
+  ]
+  table = LinkTable.from_link_data(lds)
+
+  assert table.first_by_link_name() == [1, 3, 0]
+  assert table.link_name(2) == 'zed' and table.link_dir(2) == '/Users/foo'
+  assert table.vpath(2) == '/Users/foo/.settings/a/zed'
+
+  picked = table.select([3, 0])
+  assert list(picked) == [lds[3], lds[0]]
+  assert list(table.select([1], picked)) == [lds[3], lds[0], lds[1]]
+
+
+def test_Settings_link_table_same_as_link_data(df_paths: FixturePaths, settings: Settings):
+  assert list(settings.link_table()) == settings.link_data
+
+  s = Settings.mk_default(df_paths.base_dir)
+  assert list(s.link_table()) == s.link_data
@@ -133,28 +133,6 @@ def test_Settings_with_globs_has_correct_precedence(df_paths: FixturePaths):
   assert expect_vpaths == [str(v) for v in link_datas]
 
 
-@pytest.fixture()
-def settings(df_paths: FixturePaths):
-  return Settings(
-    base_dir=df_paths.base_dir,
-    dotfiles_file_group=FileGroup(
-      base_dir=df_paths.base_dir,
-      target_dir=df_paths.home_dir,
-      dirs=[df_paths.dotfiles_dir],
-      globs=[str(g.relative_to(df_paths.base_dir)) for g in df_paths.dotfile_extras],
-      excludes=['.*', 'gnome'],
-      link_prefix='.',
-    ),
-    binfiles_file_group=FileGroup(
-      base_dir=df_paths.base_dir,
-      target_dir=df_paths.home_dir.joinpath('.local', 'bin'),
-      dirs=[Path('bin')],
-      globs=None,
-      excludes=['.*'],
-    ),
-  )
-
-
 def test_Settings_install(df_paths: FixturePaths, settings: Settings):
   s = settings
   apply_settings(s)
@@ -301,3 +279,63 @@ def test_backup_failed(df_paths: FixturePaths, settings: Settings, monkeypatch):
 
   with pytest.raises(BackupFailed):
     apply_settings(settings)
+
+
+def test_Settings_iter_link_data_same_links_as_link_data(df_paths: FixturePaths, settings: Settings):
+  streamed = list(settings.iter_link_data())
+  assert sorted(streamed) == sorted(settings.link_data)
+
+  # bash_profile from dotfile_linux sorts first, so it wins in both modes
+  bp = next(ld for ld in streamed if ld.link_path.name == '.bash_profile')
+  assert bp.vpath == df_paths.dotfile_extras_dir / 'bash_profile'
+
+
+def test_Settings_install_streaming(df_paths: FixturePaths, settings: Settings):
+  apply_settings(settings, stream=True)
+
+  for ld in settings.link_data:
+    assert ld.link_path.is_symlink()
+    assert ld.link_path.samefile(ld.vpath)
+
+
+def _named_group(df_paths: FixturePaths, name: str, d: Path, prefix: str = '') -> FileGroup:
+  return FileGroup(
+    base_dir=df_paths.base_dir,
+    target_dir=df_paths.home_dir.joinpath(name),
+    dirs=[d],
+    globs=None,
+    excludes=['.*'],
+    link_prefix=prefix,
+    name=name,
+  )
+
+
+def test_Settings_any_number_of_groups(df_paths: FixturePaths):
+  s = Settings(
+    base_dir=df_paths.base_dir,
+    groups=[
+      _named_group(df_paths, 'config', df_paths.dotfiles_dir),
+      _named_group(df_paths, 'bin', df_paths.bin_dir),
+      _named_group(df_paths, 'darwin', df_paths.binfile_extras_dir),
+    ],
+  )
+
+  assert s == do_roundtrip(s, Settings)
+  assert [n for n, _ in s.named_file_groups] == ['config', 'bin', 'darwin']
+
+  names = [ld.link_path.relative_to(df_paths.home_dir) for ld in s.link_data]
+  assert [str(n) for n in names] == [
+    'config/bash_profile', 'config/bashrc', 'config/inputrc', 'config/vimrc',
+    'bin/ctags', 'bin/pants', 'bin/pip',
+    'darwin/launched', 'darwin/pbcopy',
+  ]
+  assert list(s.link_table()) == s.link_data
+
+
+def test_Settings_group_names_must_be_unique(df_paths: FixturePaths):
+  with pytest.raises(ValueError):
+    Settings(
+      base_dir=df_paths.base_dir,
+      binfiles_file_group=FileGroup.binfile(df_paths.base_dir),
+      groups=[_named_group(df_paths, 'binfiles', df_paths.bin_dir)],
+    )
@@ -10,6 +10,9 @@ import cattr
 import pytest
 from click.testing import CliRunner, Result
 
+# mypy: ignore-missing-imports
+from dfi.config import FileGroup, Settings  # type: ignore # noqa
+
 
 def ignore(*a, **kw):
   pass
@@ -103,3 +106,25 @@ def df_paths(cli_runner):
     bin_extras=bin_extras,
     binfile_extras_dir=binfile_extras_dir,
   )
+
+
+@pytest.fixture()
+def settings(df_paths: FixturePaths):
+  return Settings(
+    base_dir=df_paths.base_dir,
+    dotfiles_file_group=FileGroup(
+      base_dir=df_paths.base_dir,
+      target_dir=df_paths.home_dir,
+      dirs=[df_paths.dotfiles_dir],
+      globs=[str(g.relative_to(df_paths.base_dir)) for g in df_paths.dotfile_extras],
+      excludes=['.*', 'gnome'],
+      link_prefix='.',
+    ),
+    binfiles_file_group=FileGroup(
+      base_dir=df_paths.base_dir,
+      target_dir=df_paths.home_dir.joinpath('.local', 'bin'),
+      dirs=[Path('bin')],
+      globs=None,
+      excludes=['.*'],
+    ),
+  )
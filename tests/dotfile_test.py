@@ -1,9 +1,15 @@
+from collections import Counter
 from pathlib import Path
+from typing import List, Set, Tuple
 
 import pytest
 
 # mypy: ignore-missing-imports
-from dfi.dotfile import LinkData, find_common_root  # type: ignore
+from dfi.dotfile import LinkData, collect, find_common_root, glob_dirs, glob_walk  # type: ignore
+
+from dfi.match import PathMatcher  # type: ignore
+
+from .conftest import FixturePaths
 
 
 def test_find_common_root():
@@ -48,3 +54,142 @@ def test_LinkData_with_prefix():
 
   assert bld.link_path == Path("/Users/foo/.bar")
   assert bld.link_data == Path(".settings/dotfiles/bar")
+
+
+def test_collect_skips_broken_symlinks(df_paths: FixturePaths):
+  df_paths.dotfiles_dir.joinpath('dangling').symlink_to('nonexistent')
+  df_paths.dotfiles_dir.joinpath('loop').symlink_to('loop')
+  df_paths.dotfiles_dir.joinpath('good').symlink_to('bashrc')
+
+  paths = collect(df_paths.base_dir, [Path('dotfiles')], excludes=['.*'])
+
+  assert [p.name for p in paths] == ['bash_profile', 'bashrc', 'good', 'inputrc', 'vimrc']
+
+
+def test_collect_counts_syscalls(df_paths: FixturePaths):
+  df_paths.dotfiles_dir.joinpath('good').symlink_to('bashrc')
+  counter: Counter = Counter()
+
+  collect(
+    df_paths.base_dir,
+    [Path('dotfiles'), Path('bin')],
+    globs=['dotfile_linux/tux'],
+    excludes=['.*'],
+    counter=counter,
+  )
+
+  # one scandir per dir, one stat for the symlink, and one stat for each part of the
+  # glob, which has no wildcards so nothing is listed for it
+  assert counter == Counter(scandir=2, stat=3)
+
+
+def test_glob_dirs(df_paths: FixturePaths):
+  base = df_paths.base_dir
+  base.joinpath('deep', 'a', 'b').mkdir(parents=True)
+
+  assert glob_dirs(base, 'dotfile_linux/tux') == [base, base / 'dotfile_linux']
+  assert glob_dirs(base, 'dotfile_*/tux') == [base, base / 'dotfile_linux']
+  assert sorted(glob_dirs(base, 'deep/**/x')) == [
+    base, base / 'deep', base / 'deep' / 'a', base / 'deep' / 'a' / 'b'
+  ]
+
+
+WALK_TREE = [
+  'a/b/c.txt', 'a/b/d.py', 'a/.hidden/e.txt', 'a/x.txt', 'b/c.txt', 'b/a/b/c.txt', 'top.txt',
+  '.dot', 'c++/[x]', 'deep/1/2/3/four.txt',
+]
+
+WALK_GLOBS = [
+  '*', '*.txt', 'a/*', 'a/*/*.txt', '**', '**/*.txt', 'a/**', 'a/**/c.txt', '**/b/*', '*/b/c.txt',
+  '.*', 'c++/*', 'c++/[[]x]', 'deep/**/*.txt', '[ab]/*.txt', '?/b', 'missing/*', 'a/b/c.txt',
+  'a/b', 'lnk/*', 'lnk/**', '**/lnk', '*/*', 'broken', '*/', 'a/**/', 'top.txt/x', 'a/../b/*',
+]
+
+WALK_EXCLUDES = ['.*', '*.py', 'b/c.txt', 'deep']
+
+
+@pytest.fixture
+def walk_tree(tmp_path: Path) -> Path:
+  for f in WALK_TREE:
+    tmp_path.joinpath(f).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path.joinpath(f).write_text('')
+  # '**' doesn't go into a symlinked dir, but the other parts of a glob do
+  tmp_path.joinpath('lnk').symlink_to('a')
+  tmp_path.joinpath('a', 'up').symlink_to('..')
+  tmp_path.joinpath('broken').symlink_to('nowhere')
+  return tmp_path
+
+
+def _path_glob(base_dir: Path, pattern: str, excludes: List[str]) -> Set[Path]:
+  exclude = PathMatcher.compile(excludes)
+  return {p for p in base_dir.glob(pattern) if not exclude.match(p) and p.exists()}
+
+
+def _glob_walk_sets(base_dir: Path, globs: List[str], excludes=None, counter=None) -> List[Set[Path]]:
+  """what glob_walk finds for each glob, checking that it comes in order"""
+  found: List[Set[Path]] = [set() for _ in globs]
+  last: Tuple[str, ...] = ()
+  for i, p in glob_walk(base_dir, globs, excludes, counter):
+    assert p.parts >= last
+    last = p.parts
+    found[i].add(p)
+  return found
+
+
+@pytest.mark.parametrize('excludes', [[], WALK_EXCLUDES])
+@pytest.mark.parametrize('pattern', WALK_GLOBS)
+def test_glob_walk_same_as_Path_glob(walk_tree: Path, pattern: str, excludes: List[str]):
+  assert _glob_walk_sets(walk_tree, [pattern], excludes) == [_path_glob(walk_tree, pattern, excludes)]
+
+
+@pytest.mark.parametrize('excludes', [[], WALK_EXCLUDES])
+def test_glob_walk_many_same_as_Path_glob(walk_tree: Path, excludes: List[str]):
+  expected = [_path_glob(walk_tree, g, excludes) for g in WALK_GLOBS]
+  assert _glob_walk_sets(walk_tree, WALK_GLOBS, excludes) == expected
+  assert _glob_walk_sets(walk_tree / 'missing', WALK_GLOBS, excludes) == [set() for _ in WALK_GLOBS]
+
+
+def test_glob_walk_is_lazy(walk_tree: Path):
+  counter: Counter = Counter()
+  walk = glob_walk(walk_tree, ['*/*.txt'], counter=counter)
+  assert next(walk) == (0, walk_tree / 'a' / 'x.txt')
+  # base_dir and a, but not b or anything after it yet
+  assert counter['scandir'] == 2
+
+
+def test_glob_walk_lists_each_dir_once(walk_tree: Path):
+  counter: Counter = Counter()
+  _glob_walk_sets(walk_tree, ['a/*.txt', 'a/*/*.txt', 'a/b/*', '[ab]/*'], counter=counter)
+  # base_dir, a, b, and a's dirs b, .hidden and up, once each for all the globs. b/a,
+  # deep and the rest aren't listed
+  assert counter['scandir'] == 6
+
+
+def test_glob_walk_prunes_covered_dirs(walk_tree: Path):
+  counter: Counter = Counter()
+  assert _glob_walk_sets(walk_tree, ['deep/**/*.txt', 'a/b/*.py'], ['*.txt', '*.py'], counter) == [set(), set()]
+  assert counter == Counter()
+
+  with pytest.raises(ValueError):
+    glob_walk(walk_tree, [''])
+
+
+def test_LinkData_for_paths_same_as_for_path():
+  target_dir = Path("/Users/foo")
+  vpaths = [
+    Path("/Users/foo/.settings/dotfiles/bar"),
+    Path("/Users/foo/.settings/dotfiles/baz"),
+    Path("/Users/foo/.settings/bin/qux"),
+    Path("/Volumes/blah/dotfiles/quux"),
+    Path("/Users/foo/bar"),
+    Path("/Users/foo/.bar/x/bar"),
+    Path("/Users"),
+    Path("/bar"),
+  ]
+
+  for prefix in ['', '.']:
+    expect = [LinkData.for_path(v, target_dir, prefix) for v in vpaths]
+    assert list(LinkData.for_paths(vpaths, target_dir, prefix)) == expect
+
+  with pytest.raises(ValueError):
+    list(LinkData.for_paths([Path("a/b")], target_dir))
@@ -0,0 +1,161 @@
+import errno
+import json
+import os
+from pathlib import Path
+
+import attr
+import pytest
+from click.testing import Result
+
+# mypy: ignore-missing-imports
+from dfi import app, fanout  # type: ignore
+from dfi.config import Settings  # type: ignore
+from dfi.dotfile import LinkData  # type: ignore
+from dfi.exceptions import LinkOutsideHome, NeedsRoot  # type: ignore
+from dfi.plan import Plan  # type: ignore
+
+from .conftest import FixturePaths, chdir
+
+
+def _make_homes(df_paths: FixturePaths, *names: str):
+  homes = [df_paths.tmp / 'users' / n for n in names]
+  for h in homes:
+    h.mkdir(parents=True)
+  return homes
+
+
+def test_rebase_link_data_matches_for_path(df_paths: FixturePaths, settings: Settings):
+  to_home = df_paths.tmp / 'users' / 'alice'
+  lds = settings.link_data
+
+  rebased = list(fanout.rebase_link_data(lds, df_paths.home_dir, to_home))
+
+  for ld, r in zip(lds, rebased):
+    target_dir = to_home / ld.link_path.parent.relative_to(df_paths.home_dir)
+    prefix = ld.link_path.name[:-len(ld.vpath.name)]
+    assert r == LinkData.for_path(ld.vpath, target_dir, prefix)
+
+
+def test_rebase_link_data_outside_home(df_paths: FixturePaths, settings: Settings):
+  with pytest.raises(LinkOutsideHome):
+    list(fanout.rebase_link_data(settings.link_data, df_paths.home_dir / 'settings', df_paths.tmp))
+
+
+def test_fanout(df_paths: FixturePaths, settings: Settings):
+  alice, bob = _make_homes(df_paths, 'alice', 'bob')
+  bob.joinpath('.bashrc').write_text('conflict')
+
+  results = fanout.fanout(Plan.build(settings), df_paths.home_dir, [alice, bob], processes=2)
+
+  n = len(settings.link_data)
+  assert [r.home for r in results] == [alice, bob]
+  assert [r.outcomes for r in results] == [{'created': n}, {'created': n - 1, 'replaced': 1}]
+  assert all(r.ok for r in results)
+  for home in [alice, bob]:
+    for ld in settings.link_data:
+      link = home / ld.link_path.relative_to(df_paths.home_dir)
+      assert link.resolve() == ld.vpath
+
+
+def test_fanout_backs_up_into_each_home(df_paths: FixturePaths, settings: Settings):
+  alice, bob = _make_homes(df_paths, 'alice', 'bob')
+  bob.joinpath('.bashrc').write_text('conflict')
+  settings = attr.evolve(settings, backup_dir=df_paths.home_dir / '.dfi-backups')
+
+  results = fanout.fanout(Plan.build(settings), df_paths.home_dir, [alice, bob], processes=2)
+
+  assert all(r.ok for r in results)
+  assert not alice.joinpath('.dfi-backups').exists()
+  backups = list(bob.joinpath('.dfi-backups').glob('*/.bashrc'))
+  assert [b.read_text() for b in backups] == ['conflict']
+  assert not list(bob.glob('.dfi_*')) and not list(bob.glob('*.dfi_*'))
+
+
+def test_app_fanout(df_paths: FixturePaths, settings: Settings, cli_runner):
+  _make_homes(df_paths, 'alice', 'bob', 'carol')
+  df_paths.tmp.joinpath('users', 'not-a-home').write_text('')
+  summary_path = df_paths.tmp / 'summary.json'
+
+  with chdir(df_paths.base_dir):
+    result: Result = cli_runner.invoke(
+      app.main,
+      args=[
+        f'--dotfile-dir={df_paths.dotfiles_dir}',
+        '--dotfile-excludes', '.*',
+        'fanout', '--homes', str(df_paths.tmp / 'users' / '*'), '-P', '2',
+        '--summary', str(summary_path),
+      ]
+    )
+    if result.exit_code != 0:
+      raise result.exception from None
+
+  assert len(result.output.splitlines()) == 3
+  summary = json.loads(summary_path.read_text())
+  assert [Path(s['home']).name for s in summary] == ['alice', 'bob', 'carol']
+  assert all(s['outcomes'] == {'created': 4} and s['error'] is None for s in summary)
+  assert os.readlink(df_paths.tmp / 'users' / 'alice' / 'bashrc') == '../../home/settings/dotfiles/bashrc'
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root")
+def test_fanout_as_owner(df_paths: FixturePaths, settings: Settings):
+  alice, = _make_homes(df_paths, 'alice')
+  os.chown(alice, 12345, 12345)
+  # the owner has to be able to get to its home
+  for d in [df_paths.tmp / 'users', df_paths.tmp]:
+    d.chmod(0o755)
+
+  results = fanout.fanout(Plan.build(settings), df_paths.home_dir, [alice], processes=1, as_owner=True)
+
+  assert results[0].ok, results[0].error
+  link = alice / '.bashrc'
+  assert (link.lstat().st_uid, link.lstat().st_gid) == (12345, 12345)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root")
+def test_fanout_as_owner_drops_root_groups(df_paths: FixturePaths, settings: Settings):
+  alice, = _make_homes(df_paths, 'alice')
+  os.chown(alice, 12345, 12345)
+  for d in [df_paths.tmp / 'users', df_paths.tmp]:
+    d.chmod(0o755)
+  # only a group of root's can write here, which the owner isn't in
+  bin_dir = alice / '.local' / 'bin'
+  bin_dir.mkdir(parents=True)
+  os.chown(alice / '.local', 12345, 12345)
+  os.chown(bin_dir, 0, 4242)
+  bin_dir.chmod(0o770)
+
+  groups = os.getgroups()
+  # the workers are forked, and have the groups we have
+  os.setgroups([4242])
+  try:
+    results = fanout.fanout(Plan.build(settings), df_paths.home_dir, [alice], processes=1, as_owner=True)
+  finally:
+    os.setgroups(groups)
+
+  assert not results[0].ok
+  assert 'Permission denied' in str(results[0].error)
+
+
+def test_fanout_as_owner_needs_root(df_paths: FixturePaths, settings: Settings, monkeypatch):
+  alice, = _make_homes(df_paths, 'alice')
+  monkeypatch.setattr(os, 'geteuid', lambda: 65534)
+
+  with pytest.raises(NeedsRoot):
+    fanout.fanout(Plan.build(settings), df_paths.home_dir, [alice], processes=1, as_owner=True)
+
+
+@pytest.mark.skipif(os.geteuid() != 0, reason="needs root")
+def test_fanout_as_owner_records_a_failed_switch(df_paths: FixturePaths, settings: Settings, monkeypatch):
+  alice, bob = _make_homes(df_paths, 'alice', 'bob')
+
+  def setgroups(groups):
+    raise PermissionError(errno.EPERM, os.strerror(errno.EPERM))
+  # the workers are forked, and have it too
+  monkeypatch.setattr(os, 'setgroups', setgroups)
+
+  results = fanout.fanout(
+    Plan.build(settings), df_paths.home_dir, [alice, bob], processes=1, as_owner=True
+  )
+
+  assert [r.home for r in results] == [alice, bob]
+  assert all('Operation not permitted' in str(r.error) for r in results)
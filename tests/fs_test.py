@@ -0,0 +1,312 @@
+import os
+from collections import Counter
+from pathlib import Path
+
+import pytest
+
+# mypy: ignore-missing-imports
+from dfi.config import Settings  # type: ignore
+from dfi import fs  # type: ignore
+from dfi.compact import LinkRow  # type: ignore
+from dfi.exceptions import ApplyFailed, FatalConflict, FilesystemConflictError, MissingTargetDirs  # type: ignore
+
+from .conftest import FixturePaths
+
+
+def test_FdLinkDir_is_relative_to_the_open_directory(df_paths: FixturePaths):
+  d = df_paths.home_dir / 'links'
+  d.mkdir()
+
+  with fs.FdLinkDir(str(d)) as ld:
+    moved = df_paths.home_dir / 'moved'
+    d.rename(moved)
+    ld.symlink('target', 'a')
+    assert ld.readlink('a') == 'target'
+    ld.rename('a', 'b')
+    assert ld.lstat('a') is None
+    assert ld.lstat('b') is not None
+
+  assert os.readlink(moved / 'b') == 'target'
+
+
+@pytest.mark.parametrize('dir_fd', [False, True])
+def test_apply_link_data_dir_fd(df_paths: FixturePaths, settings: Settings, dir_fd: bool):
+  if dir_fd and not fs.HAVE_DIR_FD:
+    pytest.skip("no dir_fd support")
+
+  df_paths.home_dir.joinpath('.bashrc').write_text('conflict')
+  df_paths.home_dir.joinpath('.vimrc').symlink_to('elsewhere')
+  fstgy, lstgy = fs._strategies(settings)
+
+  fs.apply_link_data(settings.link_data, True, fstgy, lstgy, dir_fd=dir_fd)
+
+  for ld in settings.link_data:
+    assert os.readlink(ld.link_path) == str(ld.link_data)
+  assert len(list(df_paths.home_dir.glob('.bashrc.dfi_*'))) == 1
+
+
+def test_apply_link_rows_outcomes_and_syscalls(df_paths: FixturePaths, settings: Settings):
+  df_paths.home_dir.joinpath('.bashrc').write_text('conflict')
+  df_paths.home_dir.joinpath('.vimrc').symlink_to('elsewhere')
+  fstgy, lstgy = fs._strategies(settings)
+  n = len(settings.link_data)
+
+  outcomes = fs.apply_link_data(settings.link_data, True, fstgy, lstgy)
+  assert outcomes == {'replaced': 2, 'created': n - 2}
+
+  # once everything is in place, each link costs one lstat and one readlink
+  counter: fs.SyscallCounter = Counter()
+  outcomes = fs.apply_link_data(settings.link_data, True, fstgy, lstgy, counter=counter)
+  assert outcomes == {'unchanged': n}
+  assert counter['readlink'] == counter['lstat'] == n
+  assert counter['symlink'] == counter['unlink'] == counter['rename'] == 0
+
+
+@pytest.mark.parametrize('verify, readlinks, lstats', [('readlink', 1, 1), ('resolve', 1, 2)])
+def test_verify_modes_on_a_rerun(
+  df_paths: FixturePaths, settings: Settings, verify: fs.TVerify, readlinks: int, lstats: int
+):
+  fstgy, lstgy = fs._strategies(settings)
+  n = len(settings.link_data)
+  fs.apply_link_data(settings.link_data, True, fstgy, lstgy)
+
+  counter: fs.SyscallCounter = Counter()
+  outcomes = fs.apply_link_data(settings.link_data, True, fstgy, lstgy, counter=counter, verify=verify)
+  assert outcomes == {'unchanged': n}
+  assert counter['readlink'] == readlinks * n
+  assert counter['lstat'] == lstats * n
+
+
+def test_readlink_verify_falls_back_to_resolving(df_paths: FixturePaths, settings: Settings):
+  fstgy, lstgy = fs._strategies(settings)
+  ld = settings.link_data[0]
+  # points at the right file, but isn't spelled the way we'd write it
+  ld.link_path.parent.mkdir(parents=True, exist_ok=True)
+  ld.link_path.symlink_to(ld.vpath)
+  assert os.readlink(ld.link_path) != str(ld.link_data)
+
+  outcomes = fs.apply_link_data([ld], True, fstgy, lstgy, verify='readlink')
+  assert outcomes == {'unchanged': 1}
+  assert os.readlink(ld.link_path) == str(ld.vpath)
+
+
+def _spread_rows(df_paths: FixturePaths, ndirs: int) -> list:
+  """a row per source file in each of ndirs link dirs"""
+  sources = df_paths.dotfiles + df_paths.bins
+  return [
+    LinkRow(vpath=str(v), link_dir=str(df_paths.home_dir / f"d{n}"), link_name=v.name, link_data=str(v))
+    for n in range(ndirs)
+    for v in sources
+  ]
+
+
+def test_apply_link_rows_concurrently(df_paths: FixturePaths):
+  rows = _spread_rows(df_paths, 8)
+  df_paths.home_dir.joinpath('d3').mkdir()
+  df_paths.home_dir.joinpath('d3', rows[0].link_name).symlink_to('elsewhere')
+
+  outcomes = fs.apply_link_rows(rows, True, fs.fail_strategy, fs.delete_strategy, jobs=4)
+
+  assert outcomes == {'created': len(rows) - 1, 'replaced': 1}
+  for row in rows:
+    assert os.readlink(row.link_path) == row.link_data
+
+
+def test_nested_link_dirs():
+  groups = fs._nested_link_dirs(
+    ['/h/.config/foo', '/h', '/x/y', '/h/.config/bar/', '/x/yz', '/x/y/../y/z']
+  )
+  assert groups == {
+    '/h': ['/h/.config/foo', '/h', '/h/.config/bar/'],
+    '/x/y': ['/x/y', '/x/y/../y/z'],
+    '/x/yz': ['/x/yz'],
+  }
+
+
+def test_apply_link_rows_concurrently_nested_dirs(df_paths: FixturePaths):
+  home = df_paths.home_dir
+  foo = home / '.config' / 'foo'
+  foo.mkdir(parents=True)
+  rows = [
+    LinkRow(vpath=str(v), link_dir=str(foo), link_name=v.name, link_data=str(v))
+    for v in df_paths.bins
+  ]
+  rows.append(LinkRow(
+    vpath=str(df_paths.dotfiles_dir), link_dir=str(home), link_name='.config',
+    link_data=str(df_paths.dotfiles_dir),
+  ))
+
+  def move_aside(p: Path) -> None:
+    p.rename(p.with_name(p.name + '.bak'))
+
+  # the links in ~/.config/foo are all made before ~/.config is moved, as they
+  # would be on one thread
+  outcomes = fs.apply_link_rows(rows, True, move_aside, fs.fail_strategy, jobs=4)
+  assert outcomes == {'created': len(rows) - 1, 'replaced': 1}
+  assert os.readlink(home / '.config') == str(df_paths.dotfiles_dir)
+  for row in rows[:-1]:
+    assert os.readlink(home / '.config.bak' / 'foo' / row.link_name) == row.link_data
+
+
+def test_apply_link_rows_concurrently_aggregates_errors(df_paths: FixturePaths):
+  rows = _spread_rows(df_paths, 4)
+  for n in [1, 2]:
+    df_paths.home_dir.joinpath(f"d{n}").mkdir()
+    os.mkfifo(df_paths.home_dir / f"d{n}" / rows[0].link_name)
+
+  with pytest.raises(ApplyFailed) as exc:
+    fs.apply_link_rows(rows, True, fs.fail_strategy, fs.fail_strategy, jobs=4)
+
+  assert [type(e) for e in exc.value.errors] == [FilesystemConflictError] * 2
+  # the directories without a conflict were still done
+  for row in rows:
+    if row.link_dir.endswith(('d0', 'd3')):
+      assert os.readlink(row.link_path) == row.link_data
+
+
+def test_apply_link_rows_concurrently_fail_stops_everything(df_paths: FixturePaths):
+  rows = _spread_rows(df_paths, 50)
+  df_paths.home_dir.joinpath('d0').mkdir()
+  df_paths.home_dir.joinpath('d0', rows[0].link_name).write_text('conflict')
+
+  with pytest.raises(FatalConflict):
+    fs.apply_link_rows(rows, True, fs.fail_strategy, fs.fail_strategy, jobs=2)
+
+  # d0 is first in line, so at most the directory already underway on the other
+  # thread gets done before the rest see the stop
+  done = [d for d in df_paths.home_dir.glob('d*') if any(d.iterdir())]
+  assert len(done) < 50
+
+
+@pytest.mark.parametrize('dir_fd', [False, True])
+def test_replace_renames_over_the_old_symlink(df_paths: FixturePaths, settings: Settings, dir_fd: bool):
+  if dir_fd and not fs.HAVE_DIR_FD:
+    pytest.skip("no dir_fd support")
+  lds = settings.link_data
+  for ld in lds:
+    ld.link_path.parent.mkdir(parents=True, exist_ok=True)
+    ld.link_path.symlink_to('elsewhere')
+
+  counter: fs.SyscallCounter = Counter()
+  outcomes = fs.apply_link_data(
+    lds, True, fs.fail_strategy, fs.replace_strategy, dir_fd=dir_fd, counter=counter
+  )
+
+  assert outcomes == {'replaced': len(lds)}
+  assert counter['symlink'] == counter['rename'] == len(lds)
+  assert counter['unlink'] == 0
+  for ld in lds:
+    assert os.readlink(ld.link_path) == str(ld.link_data)
+  # no temporary links left lying around
+  assert not [p for p in df_paths.home_dir.rglob('*.dfi-*')]
+
+
+def test_replace_symlink_cleans_up_when_the_rename_fails(df_paths: FixturePaths):
+  d = df_paths.home_dir / 'links'
+  d.joinpath('a').mkdir(parents=True)
+  d.joinpath('a', 'occupied').write_text('')
+
+  with fs.LinkDir(str(d)) as ld:
+    # renaming a symlink over a non-empty directory fails
+    with pytest.raises(OSError):
+      ld.replace_symlink('target', 'a')
+
+  assert sorted(p.name for p in d.iterdir()) == ['a']
+
+
+def test_apply_settings_with_backup_dir(df_paths: FixturePaths, settings: Settings):
+  settings.backup_dir = df_paths.home_dir / '.dfi-backups'
+  df_paths.home_dir.joinpath('.bashrc').write_text('conflict')
+  df_paths.home_dir.joinpath('.local', 'bin').mkdir(parents=True)
+  df_paths.home_dir.joinpath('.local', 'bin', 'pip').write_text('conflict')
+
+  fs.apply_settings(settings)
+
+  roots = list(settings.backup_dir.iterdir())
+  assert len(roots) == 1
+  assert roots[0].joinpath('.bashrc').read_text() == 'conflict'
+  assert roots[0].joinpath('.local', 'bin', 'pip').read_text() == 'conflict'
+  assert not list(df_paths.home_dir.glob('*.dfi_*'))
+
+
+def test_target_dirs_missing_is_minimal_and_parents_first(df_paths: FixturePaths):
+  home = str(df_paths.home_dir)
+  counter: fs.SyscallCounter = Counter()
+  dirs = fs.TargetDirs(counter=counter)
+
+  missing = dirs.missing([f"{home}/a/b/c", f"{home}/a/b/d", f"{home}/a", home, f"{home}/e"])
+
+  assert missing == [f"{home}/a", f"{home}/a/b", f"{home}/a/b/c", f"{home}/a/b/d", f"{home}/e"]
+  # home is only looked at once
+  assert counter['stat'] == 6
+
+
+def test_target_dirs_create(df_paths: FixturePaths):
+  counter: fs.SyscallCounter = Counter()
+  dirs = fs.TargetDirs(mode=0o700, counter=counter)
+  d = df_paths.home_dir / 'a' / 'b'
+
+  dirs.ensure([str(d)])
+  assert d.is_dir() and d.stat().st_mode & 0o777 == 0o700
+  assert counter['mkdir'] == 2
+
+  # known now, so there's nothing to look at
+  counter.clear()
+  dirs.ensure([str(d)])
+  assert counter == {}
+
+
+def test_create_missing_target_dirs_off(df_paths: FixturePaths, settings: Settings):
+  settings.create_missing_target_dirs = False
+  bin_dir = settings.binfiles_file_group.target_dir
+
+  with pytest.raises(MissingTargetDirs) as exc:
+    fs.apply_settings(settings)
+
+  assert exc.value.dirs == [str(bin_dir.parent), str(bin_dir)]
+  # nothing was done, not even in the dirs that did exist
+  assert not [p for p in df_paths.home_dir.iterdir() if p.is_symlink()]
+
+  bin_dir.mkdir(parents=True)
+  fs.apply_settings(settings)
+  assert all(ld.link_path.is_symlink() for ld in settings.link_data)
+
+
+@pytest.mark.parametrize('dir_fd', [True, False] if fs.HAVE_DIR_FD else [False])
+def test_prune_removes_only_stale_links_into_the_repo(
+  df_paths: FixturePaths, settings: Settings, dir_fd: bool
+):
+  home = df_paths.home_dir
+  fs.apply_settings(settings)
+  df_paths.dotfiles_dir.joinpath('vimrc').unlink()
+  home.joinpath('.elsewhere').symlink_to('/usr')
+  home.joinpath('.absolute').symlink_to(df_paths.dotfiles_dir / 'gone')
+  home.joinpath('.local', 'bin', 'pants').unlink()
+  home.joinpath('.local', 'bin', 'pants').symlink_to('/usr/bin/pants')
+
+  counter: Counter = Counter()
+  assert fs.prune(settings, dry_run=True) == [home / '.absolute', home / '.vimrc']
+  assert home.joinpath('.vimrc').is_symlink()
+
+  removed = fs.prune(settings, dir_fd=dir_fd, counter=counter)
+
+  assert removed == [home / '.absolute', home / '.vimrc']
+  assert not os.path.lexists(home / '.vimrc')
+  assert home.joinpath('.elsewhere').is_symlink()
+  assert home.joinpath('.bashrc').is_symlink()
+  # one scandir per target dir, and only the symlinks that aren't planned are read
+  assert counter['scandir'] == 2
+  assert counter['readlink'] == 3
+  assert counter['unlink'] == 2
+  assert fs.prune(settings) == []
+
+
+def test_uninstall_removes_every_link_into_the_repo(df_paths: FixturePaths, settings: Settings):
+  home = df_paths.home_dir
+  fs.apply_settings(settings)
+  home.joinpath('.elsewhere').symlink_to('/usr')
+
+  removed = fs.prune(settings, uninstall=True)
+
+  assert len(removed) == len(settings.link_data)
+  assert not [p for p in home.rglob('*') if p.is_symlink() and p.name != '.elsewhere']
@@ -0,0 +1,146 @@
+import shutil
+import subprocess
+from collections import Counter
+from pathlib import Path
+
+import attr
+import pytest
+
+# mypy: ignore-missing-imports
+from dfi import gitindex  # type: ignore
+from dfi.config import FileGroup  # type: ignore
+from dfi.exceptions import UnreadableIndex  # type: ignore
+
+from .conftest import FixturePaths
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason="needs git")
+
+
+def _git(repo: Path, *args: str) -> str:
+  return subprocess.run(
+    ['git', '-C', str(repo), '-c', 'user.name=dfi', '-c', 'user.email=dfi@example.com', *args],
+    check=True,
+    stdout=subprocess.PIPE,
+  ).stdout.decode()
+
+
+def _ls_files(repo: Path) -> list:
+  return [p for p in _git(repo, 'ls-files', '-z').split('\0') if p]
+
+
+@pytest.fixture()
+def repo(df_paths: FixturePaths) -> Path:
+  base = df_paths.base_dir
+  for f in ['a/b/c.txt', 'a/.hidden/d.txt', 'deep/1/2/e.txt', 'x y/f', 'ünï/g']:
+    base.joinpath(f).parent.mkdir(parents=True, exist_ok=True)
+    base.joinpath(f).write_text(f)
+  base.joinpath('bin', 'link').symlink_to('ctags')
+  base.joinpath('bin', 'broken').symlink_to('nowhere')
+  base.joinpath('.gitignore').write_text('build/\n')
+  _git(base, 'init', '-q')
+  _git(base, 'add', '-A')
+  _git(base, 'commit', '-q', '-m', 'initial')
+
+  # neither of these are tracked
+  base.joinpath('build', 'out').parent.mkdir()
+  base.joinpath('build', 'out').write_text('')
+  base.joinpath('dotfiles', 'untracked').write_text('')
+  return base
+
+
+@pytest.mark.parametrize('version', [2, 3, 4])
+def test_parse_index_same_as_ls_files(repo: Path, version: int):
+  _git(repo, 'update-index', '--index-version', str(version))
+  entries = gitindex.parse_index((repo / '.git' / 'index').read_bytes())
+  assert [p for p, _ in entries] == _ls_files(repo)
+  assert dict(entries)['bin/link'] == 0o120000
+
+
+def test_parse_index_extended_flags(repo: Path):
+  # both of these need version 3 entries
+  repo.joinpath('new').write_text('')
+  _git(repo, 'add', '--intent-to-add', 'new')
+  _git(repo, 'update-index', '--skip-worktree', 'a/b/c.txt')
+
+  data = (repo / '.git' / 'index').read_bytes()
+  entries = gitindex.parse_index(data)
+
+  assert data[4:8] == (3).to_bytes(4, 'big')
+  paths = [p for p, _ in entries]
+  assert 'new' in paths
+  assert 'a/b/c.txt' not in paths
+  assert set(paths) == set(_ls_files(repo)) - {'a/b/c.txt'}
+
+
+def test_parse_index_rejects_bad_data(repo: Path):
+  data = (repo / '.git' / 'index').read_bytes()
+  with pytest.raises(UnreadableIndex):
+    gitindex.parse_index(b'DIRX' + data[4:])
+  with pytest.raises(UnreadableIndex):
+    gitindex.parse_index(data[:100])
+
+
+def test_tracked_is_cached_until_the_index_changes(repo: Path):
+  counter: Counter = Counter()
+  t = gitindex.tracked(repo, counter)
+  assert gitindex.tracked(repo, counter) is t
+  assert counter['read'] == 1
+
+  _git(repo, 'add', 'dotfiles/untracked')
+  assert repo / 'dotfiles' / 'untracked' in gitindex.tracked(repo)
+
+
+GLOBS = ['*', '**', '**/*.txt', 'a/**', 'a/*/*', 'deep/**/e*', 'x y/*', 'ünï/*', 'bin/*', 'missing/*']
+
+
+@pytest.mark.parametrize('glob', GLOBS)
+def test_git_index_source_same_as_filesystem(df_paths: FixturePaths, repo: Path, glob: str):
+  # a clean checkout: the same files as the index
+  shutil.rmtree(repo / 'build')
+  repo.joinpath('dotfiles', 'untracked').unlink()
+
+  def collect(source: str):
+    fg = FileGroup(
+      base_dir=repo,
+      dirs=[Path('dotfiles'), Path('bin')],
+      globs=[glob],
+      excludes=['.git', '*.py', 'a/.hidden'],
+      target_dir=df_paths.home_dir,
+      source=source,
+    )
+    return fg.collect()
+
+  # the index doesn't list the repo itself
+  in_repo = [p for p in collect('filesystem') if '.git' not in p.relative_to(repo).parts]
+  assert collect('git-index') == in_repo
+
+
+def test_git_index_source_leaves_out_untracked_and_ignored(df_paths: FixturePaths, repo: Path):
+  fg = FileGroup(
+    base_dir=repo,
+    dirs=[Path('dotfiles')],
+    globs=['**/out'],
+    excludes=None,
+    target_dir=df_paths.home_dir,
+    source='git-index',
+  )
+  counter: Counter = Counter()
+
+  vpaths = fg.collect(counter)
+
+  assert repo / 'dotfiles' / 'bashrc' in vpaths
+  assert repo / 'dotfiles' / 'untracked' not in vpaths
+  assert repo / 'build' / 'out' not in vpaths
+  assert counter['scandir'] == 0
+
+
+def test_git_index_source_outside_a_checkout(df_paths: FixturePaths):
+  fg = FileGroup(
+    base_dir=df_paths.base_dir,
+    dirs=[Path('dotfiles')],
+    globs=None,
+    excludes=None,
+    target_dir=df_paths.home_dir,
+    source='git-index',
+  )
+  assert fg.collect() == attr.evolve(fg, source='filesystem').collect()
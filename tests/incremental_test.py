@@ -0,0 +1,150 @@
+import json
+import os
+import shutil
+import subprocess
+from pathlib import Path
+
+import pytest
+from click.testing import Result
+
+# mypy: ignore-missing-imports
+from dfi import app, git, incremental  # type: ignore
+from dfi.config import FileGroup, Settings  # type: ignore
+
+from .conftest import FixturePaths, chdir
+
+pytestmark = pytest.mark.skipif(shutil.which('git') is None, reason="needs git")
+
+
+def _git(repo: Path, *args: str) -> None:
+  subprocess.run(
+    ['git', '-C', str(repo), '-c', 'user.name=dfi', '-c', 'user.email=dfi@example.com', *args],
+    check=True,
+    stdout=subprocess.DEVNULL,
+  )
+
+
+@pytest.fixture()
+def repo(df_paths: FixturePaths) -> Path:
+  _git(df_paths.base_dir, 'init', '-q')
+  _git(df_paths.base_dir, 'add', '-A')
+  _git(df_paths.base_dir, 'commit', '-q', '-m', 'initial')
+  return df_paths.base_dir
+
+
+def test_changed_paths(df_paths: FixturePaths, repo: Path):
+  head = git.head(repo)
+  _git(repo, 'mv', 'dotfiles/vimrc', 'dotfiles/nvimrc')
+  _git(repo, 'commit', '-q', '-m', 'rename')
+  repo.joinpath('dotfiles', 'zshrc').write_text('')
+
+  changed = git.changed_paths(git.toplevel(repo), head)
+
+  assert sorted(p.relative_to(repo.resolve()) for p in changed) == [
+    Path('dotfiles/nvimrc'), Path('dotfiles/vimrc'), Path('dotfiles/zshrc')
+  ]
+  assert git.changed_paths(repo, 'f' * 40) is None
+  assert git.toplevel(df_paths.tmp) is None
+
+
+def test_affected_link_paths_and_resolve(df_paths: FixturePaths, settings: Settings):
+  home = df_paths.home_dir
+  base = df_paths.base_dir
+  df_paths.dotfiles_dir.joinpath('vimrc').unlink()
+  changed = [
+    base / 'dotfiles' / 'vimrc',
+    base / 'dotfiles' / 'ssh' / 'config',
+    base / 'dotfile_linux' / 'tux',
+    base / 'bin' / 'pip',
+    base / 'README',
+  ]
+
+  paths = incremental.affected_link_paths(settings, changed)
+
+  assert paths == {
+    home / '.vimrc', home / '.ssh', home / '.tux', home / '.local' / 'bin' / 'pip',
+  }
+  lds, gone = incremental.resolve(settings, paths)
+  assert [ld.vpath for ld in lds] == [base / 'bin' / 'pip', base / 'dotfile_linux' / 'tux']
+  assert gone == [home / '.ssh', home / '.vimrc']
+
+
+def test_resolve_picks_the_same_winner_as_collect(df_paths: FixturePaths):
+  base = df_paths.base_dir
+  base.joinpath('more', 'bash_profile').parent.mkdir()
+  base.joinpath('more', 'bash_profile').write_text('')
+  settings = Settings(
+    base_dir=base,
+    groups=[
+      FileGroup(
+        base_dir=base,
+        dirs=[Path('dotfiles')],
+        globs=['*/bash_profile', 'more/*'],
+        excludes=None,
+        target_dir=df_paths.home_dir,
+      )
+    ],
+  )
+  expected = {str(ld.link_path): ld for ld in settings.link_data}
+
+  lds, gone = incremental.resolve(settings, [Path(p) for p in expected])
+
+  assert {str(ld.link_path): ld for ld in lds} == expected
+  assert gone == []
+
+
+def test_app_incremental(df_paths: FixturePaths, cli_runner, repo: Path):
+  home = df_paths.home_dir
+  state_file = df_paths.tmp / 'state.json'
+  args = [
+    f'--dotfile-dir={df_paths.dotfiles_dir}',
+    '--dotfile-excludes', '.*',
+    '--state-file', str(state_file),
+    '--incremental',
+  ]
+
+  def run() -> Result:
+    with chdir(repo):
+      result: Result = cli_runner.invoke(app.main, args=args)
+    if result.exit_code != 0:
+      raise result.exception from None
+    return result
+
+  # the first run has nothing to go on, so it applies everything
+  run()
+  assert json.loads(state_file.read_text())['commit'] == git.head(repo)
+  for name in ['bashrc', 'vimrc', 'inputrc', 'bash_profile']:
+    assert (home / name).is_symlink()
+
+  _git(repo, 'mv', 'dotfiles/vimrc', 'dotfiles/nvimrc')
+  _git(repo, 'commit', '-q', '-m', 'rename')
+  repo.joinpath('dotfiles', 'zshrc').write_text('')
+
+  run()
+  assert not os.path.lexists(home / 'vimrc')
+  assert (home / 'nvimrc').is_symlink()
+  assert (home / 'zshrc').is_symlink()
+
+  # zshrc was dirty last time, deleting it is seen too
+  repo.joinpath('dotfiles', 'zshrc').unlink()
+  run()
+  assert not os.path.lexists(home / 'zshrc')
+
+  # nothing git can see has changed, but a target dir has, so everything's applied
+  (home / 'bashrc').unlink()
+  run()
+  assert (home / 'bashrc').is_symlink()
+
+  # and so has a source dir, with a file git ignores
+  repo.joinpath('.git', 'info', 'exclude').write_text('ignoredrc\n')
+  repo.joinpath('dotfiles', 'ignoredrc').write_text('')
+  run()
+  assert (home / 'ignoredrc').is_symlink()
+
+  # a commit that can't be found means applying everything
+  saved = json.loads(state_file.read_text())
+  saved['commit'] = 'f' * 40
+  state_file.write_text(json.dumps(saved))
+  repo.joinpath('dotfiles', 'zshrc').write_text('')
+  run()
+  assert (home / 'bashrc').is_symlink()
@@ -0,0 +1,159 @@
+import json
+import os
+from pathlib import Path
+
+import pytest
+from click.testing import Result
+
+# mypy: ignore-missing-imports
+from dfi import app, backup, fs, journal  # type: ignore
+from dfi.config import Settings  # type: ignore
+from dfi.exceptions import FilesystemConflictError, JournalError  # type: ignore
+
+from .conftest import FixturePaths, chdir
+
+
+@pytest.fixture()
+def conflicts(df_paths: FixturePaths, settings: Settings):
+  """a home with a file and a symlink in the way, and no .local/bin"""
+  settings.journal = df_paths.tmp / 'state' / 'journal.jsonl'
+  home = df_paths.home_dir
+  home.joinpath('.bashrc').write_text('mine')
+  home.joinpath('.vimrc').symlink_to('elsewhere')
+  home.joinpath('.inputrc').symlink_to(df_paths.dotfiles_dir / 'inputrc')
+  return home
+
+
+def _links(home: Path):
+  return sorted(str(p.relative_to(home)) for p in home.rglob('*') if p.is_symlink())
+
+
+@pytest.mark.parametrize('jobs', [1, 4])
+def test_rollback(df_paths: FixturePaths, settings: Settings, conflicts: Path, jobs: int):
+  home = conflicts
+  before = _links(home)
+  fs.apply_settings(settings, jobs=jobs)
+  assert (home / '.local' / 'bin' / 'pip').is_symlink()
+
+  outcomes = fs.rollback(settings.journal)
+
+  assert outcomes == {'removed': len(settings.link_data) - 2, 'restored': 2}
+  assert _links(home) == before
+  assert home.joinpath('.bashrc').read_text() == 'mine'
+  assert os.readlink(home / '.vimrc') == 'elsewhere'
+  # a link that was already right is left as it was
+  assert home.joinpath('.inputrc').is_symlink()
+  assert not home.joinpath('.local').exists()
+  assert not list(home.glob('.bashrc.dfi_*'))
+
+  with pytest.raises(JournalError):
+    fs.rollback(settings.journal)
+
+
+def test_rollback_leaves_changed_links(df_paths: FixturePaths, settings: Settings, conflicts: Path):
+  fs.apply_settings(settings)
+  bashrc = conflicts / '.bashrc'
+  bashrc.unlink()
+  bashrc.write_text('new')
+
+  outcomes = fs.rollback(settings.journal)
+
+  assert outcomes['left'] == 1
+  assert bashrc.read_text() == 'new'
+
+
+def test_rollback_restores_its_own_store_backup(
+  df_paths: FixturePaths, settings: Settings, conflicts: Path, monkeypatch
+):
+  stamps = iter(f"202001{n:02}000000" for n in range(1, 99))
+  monkeypatch.setattr(backup, 'timestamp', lambda: next(stamps))
+  settings.backup_store = df_paths.tmp / 'state' / 'store'
+  bashrc = conflicts / '.bashrc'
+  fs.apply_settings(settings)
+
+  run = journal.last_run(settings.journal)
+  stored = backup.ObjectStore(settings.backup_store).lookup(bashrc)
+  assert [d['stored'] for d in run.done.values() if d['stored']] == [stored.time]
+  assert stored.run == run.header.run
+
+  # another run backs up something else at the same path later on
+  link = bashrc.with_name('.bashrc-link')
+  bashrc.rename(link)
+  bashrc.write_text('other')
+  with backup.ObjectStore(settings.backup_store, 'other-run') as store:
+    store.backup(bashrc)
+  link.rename(bashrc)
+
+  fs.rollback(settings.journal)
+  assert bashrc.read_text() == 'mine'
+
+
+def test_resume_then_rollback(df_paths: FixturePaths, settings: Settings, conflicts: Path):
+  # a fifo stops the run part way through, as a kill would
+  fifo = conflicts / '.local' / 'bin' / 'pants'
+  fifo.parent.mkdir(parents=True)
+  os.mkfifo(fifo)
+  with pytest.raises(FilesystemConflictError):
+    fs.apply_settings(settings)
+
+  run = journal.last_run(settings.journal)
+  assert not run.ended
+  fifo.unlink()
+
+  outcomes = fs.resume(settings.journal)
+  assert outcomes['created'] >= 1
+  assert all(ld.link_path.is_symlink() for ld in settings.link_data)
+  assert journal.last_run(settings.journal).ended
+  with pytest.raises(JournalError):
+    fs.resume(settings.journal)
+
+  fs.rollback(settings.journal)
+  assert conflicts.joinpath('.bashrc').read_text() == 'mine'
+  assert os.readlink(conflicts / '.vimrc') == 'elsewhere'
+  restored = {'.inputrc', '.vimrc'}
+  assert not any(ld.link_path.is_symlink() for ld in settings.link_data if ld.link_path.name not in restored)
+
+
+def test_fsync_is_batched(df_paths: FixturePaths, settings: Settings, conflicts: Path, monkeypatch):
+  syncs = []
+  real_fsync = os.fsync
+  monkeypatch.setattr(os, 'fsync', lambda fd: syncs.append(fd) or real_fsync(fd))
+
+  fs.apply_settings(settings)
+
+  # begin, mkdir, a batch for each of the two link dirs, the backup of .bashrc and end
+  assert len(syncs) == 6
+  assert len(settings.link_data) > len(syncs)
+
+
+def test_torn_last_record_is_ignored(df_paths: FixturePaths, settings: Settings, conflicts: Path):
+  fs.apply_settings(settings)
+  with open(settings.journal, 'a') as f:
+    f.write('{"op": "do')
+
+  assert journal.last_run(settings.journal).ended
+
+
+def test_app_rollback(df_paths: FixturePaths, cli_runner):
+  bashrc = df_paths.home_dir / 'bashrc'
+  bashrc.write_text('export EXISTING=1')
+  journal_path = df_paths.tmp / 'journal.jsonl'
+
+  with chdir(df_paths.base_dir):
+    result: Result = cli_runner.invoke(
+      app.main,
+      args=[
+        f'--dotfile-dir={df_paths.dotfiles_dir}',
+        '--dotfile-excludes', '.*',
+        '--journal', str(journal_path),
+      ]
+    )
+    if result.exit_code != 0:
+      raise result.exception from None
+  assert bashrc.is_symlink()
+
+  result = cli_runner.invoke(app.main, args=['rollback', '--journal', str(journal_path)])
+  if result.exit_code != 0:
+    raise result.exception from None
+  assert result.output.strip() == 'removed=4 restored=1'
+  assert bashrc.read_text() == 'export EXISTING=1'
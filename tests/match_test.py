@@ -0,0 +1,118 @@
+import os
+from itertools import product
+from pathlib import Path, PurePosixPath
+
+import pytest
+
+# mypy: ignore-missing-imports
+from dfi.match import Glob, GlobSet, PathMatcher  # type: ignore
+
+PATTERNS = [
+  '.*', 'tux', '*.old', '*.bak', 'adium*', 'backup-*', 'gen*', 'rb*', 'b?sh*', '[!a]*', '[a-c]*',
+  '[]]', '[!]', '[z-a]x', 'foo[', '*/bashrc', 'dotfiles/*', 'settings/*/v*', '/home/*/x',
+  '/*', '**', 'a**b', 'x.y', 'c++', '(paren)', '*.[ch]',
+]
+
+PATHS = [
+  '/', '/x', '/home/foo/x', '/home/foo/settings/dotfiles/bashrc', '/home/foo/.bashrc',
+  'rel/tux', 'bin/adium-thing', 'bin/lein', 'bin/rbenv', 'bin/zsh', 'a/b', 'c', 'foo[',
+  ']', '!', 'xx', 'ax', 'settings/bin/vim', 'dotfiles/x.y', 'c++', 'p/(paren)', 'src/f.c',
+  'src/f.o', 'backup-2020', 'a/bbb', 'abb', 'x.old', 'z.bak.old',
+]
+
+
+@pytest.mark.parametrize('pattern', PATTERNS)
+def test_PathMatcher_single_pattern_same_as_Path_match(pattern):
+  m = PathMatcher.compile([pattern])
+  for p in map(PurePosixPath, PATHS):
+    assert m.match(p) == p.match(pattern), (p, pattern)
+
+
+def test_PathMatcher_combined_same_as_any_Path_match():
+  for a, b in product(PATTERNS, repeat=2):
+    m = PathMatcher.compile([a, b])
+    for p in map(PurePosixPath, PATHS):
+      assert m.match(p) == (p.match(a) or p.match(b)), (p, a, b)
+
+
+def test_PathMatcher_empty():
+  m = PathMatcher.compile([])
+  assert not m
+  assert not m.match(PurePosixPath('/a/b'))
+
+  with pytest.raises(ValueError):
+    PathMatcher.compile([''])
+
+
+GLOB_TREE = [
+  'a/b/c.txt', 'a/b/d.py', 'a/.hidden/e.txt', 'a/x.txt', 'b/c.txt', 'b/a/b/c.txt', 'top.txt',
+  '.dot', 'c++/[x]', 'deep/1/2/3/four.txt',
+]
+
+GLOBS = [
+  '*', '*.txt', 'a/*', 'a/*/*.txt', '**', '**/*.txt', 'a/**', 'a/**/c.txt', '**/b/*',
+  '*/b/c.txt', '.*', 'c++/*', 'c++/[[]x]', 'deep/**/*.txt', '[ab]/*.txt', '?/b', 'missing/*',
+]
+
+
+@pytest.mark.parametrize('pattern', GLOBS)
+def test_Glob_same_as_Path_glob(tmp_path: Path, pattern: str):
+  for f in GLOB_TREE:
+    tmp_path.joinpath(f).parent.mkdir(parents=True, exist_ok=True)
+    tmp_path.joinpath(f).write_text('')
+
+  expected = {p.relative_to(tmp_path).parts for p in tmp_path.glob(pattern)} - {()}
+
+  g = Glob.compile(pattern)
+  found = set()
+  for root, dirs, files in os.walk(tmp_path):
+    rel = Path(root).relative_to(tmp_path).parts
+    found.update(rel + (d,) for d in dirs if g.match_parts(rel + (d,), True))
+    found.update(rel + (f,) for f in files if g.match_parts(rel + (f,), False))
+  assert found == expected
+
+
+@pytest.mark.parametrize('glob, exclude, dir_parts, covered', [
+  ('a/*.txt', '*.txt', ('/', 'b'), True),
+  ('a/*.txt', '*', ('/', 'b'), True),
+  ('a/*.txt', '*.py', ('/', 'b'), False),
+  ('a/*', '*.txt', ('/', 'b'), False),
+  ('a/b', 'b', ('/', 'x'), True),
+  ('a/b', 'a/b', ('/', 'x'), True),
+  ('a/b', 'a/b', ('/', 'a'), True),
+  # the exclude's first part is matched against the dir the walk is in
+  ('a/b', 'x/a/b', ('/', 'x'), True),
+  ('a/b', 'y/a/b', ('/', 'x'), False),
+  ('**/*.txt', '*.txt', ('/', 'x'), True),
+  # the dirs '**' matches could be anything
+  ('**/*.txt', 'a/*.txt', ('/', 'x'), False),
+  ('a/**', '*', ('/', 'x'), False),
+  # excludes match the end of a path, so an excluded dir doesn't cover what's in it
+  ('.git/**/*', '.git', ('/', 'x'), False),
+  ('a/b', '/x/a/b', ('/', 'x'), False),
+])
+def test_GlobSet_covered(glob, exclude, dir_parts, covered):
+  gs = GlobSet.compile([glob], [exclude])
+  assert gs.covered((0, 0), dir_parts) is covered
+
+
+def test_GlobSet_step():
+  gs = GlobSet.compile(['a/*.txt', '**/b', 'a/**'])
+  states = gs.initial()
+  # past the '**'s, which can match nothing
+  assert states == {(0, 0), (1, 0), (1, 1), (2, 0)}
+
+  yields, nxt = gs.step(states, 'a', lambda: True, lambda: True)
+  assert yields == []
+  assert nxt == {(0, 1), (1, 0), (1, 1), (2, 1), (2, 2)}
+  assert gs.is_done((2, 2))
+
+  yields, after = gs.step(nxt, 'b', lambda: False, lambda: False)
+  assert yields == [1] and after == set()
+
+  # '**' doesn't go into a symlinked dir, other parts do
+  _, nxt = gs.step(states, 'a', lambda: True, lambda: False)
+  assert nxt == {(0, 1), (2, 1), (2, 2)}
+  yields, _ = gs.step(nxt, 'b', lambda: False, lambda: False)
+  assert yields == []
+
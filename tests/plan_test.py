@@ -0,0 +1,143 @@
+import json
+import os
+from pathlib import Path
+
+import cattr
+
+# mypy: ignore-missing-imports
+from dfi.config import FileGroup, Settings  # type: ignore
+from dfi.dotfile import LinkData  # type: ignore
+from dfi.fs import apply_plan  # type: ignore
+from dfi.plan import Plan  # type: ignore
+
+from .conftest import FixturePaths
+
+
+def test_Plan_same_as_Settings(df_paths: FixturePaths, settings: Settings):
+  plan = Plan.build(settings)
+
+  assert plan.vpaths == settings.vpaths
+  assert plan.link_data == settings.link_data
+  assert list(plan.link_table.rows()) == list(settings.link_table().rows())
+  assert plan.counter['collect'] == 2
+
+
+def test_Plan_is_cached(df_paths: FixturePaths, settings: Settings):
+  plan = Plan.build(settings)
+  before = plan.counter.copy()
+
+  plan.link_data
+  plan.vpaths
+  assert plan.counter == before
+
+  # nothing changed on disk, so only the stamps are checked
+  assert plan.refresh() == []
+  assert plan.counter['collect'] == before['collect']
+  assert plan.counter['scandir'] == before['scandir']
+
+
+def test_Plan_refresh_rescans_changed_groups(df_paths: FixturePaths, settings: Settings):
+  plan = Plan.build(settings)
+  df_paths.bin_dir.joinpath('newthing').write_text('new')
+
+  assert plan.refresh() == [settings.binfiles_file_group]
+  assert plan.counter['collect'] == 3
+  assert df_paths.bin_dir / 'newthing' in plan.vpaths
+
+  df_paths.dotfile_extras_dir.joinpath('tux').unlink()
+  assert plan.refresh() == [settings.dotfiles_file_group]
+  assert df_paths.dotfile_extras_dir / 'tux' not in plan.vpaths
+
+
+def test_Plan_refresh_sees_new_glob_matches(df_paths: FixturePaths):
+  base = df_paths.base_dir
+  base.joinpath('pkgs', 'a').mkdir(parents=True)
+  base.joinpath('pkgs', 'a', 'rc').write_text('')
+  base.joinpath('pkgs', 'b').mkdir()
+  fg = FileGroup(
+    base_dir=base,
+    dirs=[],
+    globs=['pkgs/*/rc', 'pkgs/*/rc2'],
+    excludes=[],
+    target_dir=df_paths.home_dir,
+    name='pkgs',
+  )
+  plan = Plan.build(Settings(base_dir=base, groups=[fg]))
+
+  # nothing in pkgs/b matched, but both globs walk through it
+  base.joinpath('pkgs', 'b', 'rc2').write_text('')
+  assert plan.refresh() == [fg]
+  assert base / 'pkgs' / 'b' / 'rc2' in plan.vpaths
+
+
+def test_Plan_invalidate(df_paths: FixturePaths, settings: Settings):
+  plan = Plan.build(settings)
+  plan.invalidate(settings.dotfiles_file_group)
+  assert plan.refresh() == [settings.dotfiles_file_group]
+
+  plan.invalidate()
+  plan.link_data
+  assert plan.counter['collect'] == 5
+
+
+def test_apply_plan(df_paths: FixturePaths, settings: Settings):
+  plan = Plan.build(settings)
+  apply_plan(plan)
+
+  for ld in plan.link_data:
+    assert ld.link_path.samefile(ld.vpath)
+
+
+def test_Plan_collisions(df_paths: FixturePaths):
+  os.link(df_paths.bin_dir / 'pip', df_paths.binfile_extras_dir / 'pip3')
+  df_paths.binfile_extras_dir.joinpath('ctags').write_text('other ctags')
+
+  def group(name, d):
+    return FileGroup(
+      base_dir=df_paths.base_dir,
+      target_dir=df_paths.home_dir / 'bin',
+      dirs=[d],
+      globs=None,
+      excludes=['.*'],
+      name=name,
+    )
+
+  s = Settings(
+    base_dir=df_paths.base_dir,
+    groups=[group('bin', df_paths.bin_dir), group('darwin', df_paths.binfile_extras_dir)],
+  )
+  plan = Plan.build(s)
+
+  assert [str(ld.link_path.relative_to(df_paths.home_dir)) for ld in plan.link_data] == [
+    'bin/ctags', 'bin/pants', 'bin/pip', 'bin/launched', 'bin/pbcopy', 'bin/pip3'
+  ]
+  assert plan.link_data[0].vpath == df_paths.bin_dir / 'ctags'
+
+  report = json.loads(plan.collisions.to_json())
+  assert report['link_paths'] == [
+    {
+      'link_path': str(df_paths.home_dir / 'bin' / 'ctags'),
+      'winner': {'group': 'bin', 'link_data': cattr.unstructure(plan.link_data[0])},
+      'losers': [
+        {
+          'group': 'darwin',
+          'link_data': cattr.unstructure(
+            LinkData.for_path(df_paths.binfile_extras_dir / 'ctags', df_paths.home_dir / 'bin')
+          ),
+        }
+      ],
+    }
+  ]
+  assert len(report['aliases']) == 1
+  assert sorted(Path(c['link_data']['vpath']).name for c in report['aliases'][0]['claims']) == [
+    'pip', 'pip3'
+  ]
+
+
+def test_Plan_reports_only_real_collisions(df_paths: FixturePaths, settings: Settings):
+  # bash_profile is in both dotfiles and dotfile_linux, so that's reported
+  report = Plan.build(settings).collisions
+  assert [c.link_path.name for c in report.link_paths] == ['.bash_profile']
+  assert report.aliases == []
+
+  assert not Plan.build(Settings.mk_default(df_paths.base_dir)).collisions
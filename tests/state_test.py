@@ -0,0 +1,71 @@
+from click.testing import Result
+
+# mypy: ignore-missing-imports
+from dfi import app, state  # type: ignore
+from dfi.config import Settings  # type: ignore
+
+from .conftest import FixturePaths, chdir
+
+
+def _check(settings: Settings, path):
+  fp = state.Fingerprint.of(settings)
+  return state.load(path) == fp, fp
+
+
+def test_fingerprint_changes(df_paths: FixturePaths, settings: Settings):
+  path = df_paths.tmp / 'state.json'
+  same, fp = _check(settings, path)
+  assert not same
+
+  state.save(path, settings, fp)
+  assert _check(settings, path)[0]
+
+  # an entry added to a source dir
+  df_paths.dotfiles_dir.joinpath('zshrc').write_text('')
+  same, fp = _check(settings, path)
+  assert not same
+  state.save(path, settings, fp)
+
+  # a link removed from a target dir
+  df_paths.home_dir.joinpath('.bashrc').symlink_to('x')
+  assert not _check(settings, path)[0]
+
+
+def test_state_file_in_a_target_dir(df_paths: FixturePaths, settings: Settings):
+  path = df_paths.home_dir / '.dfi-state.json'
+  _, fp = _check(settings, path)
+  state.save(path, settings, fp)
+  assert _check(settings, path)[0]
+
+
+def test_torn_state_file(df_paths: FixturePaths, settings: Settings):
+  path = df_paths.tmp / 'state.json'
+  path.write_text('{"version": 1, "sett')
+  assert state.load(path) is None
+
+
+def test_app_skips_unchanged_runs(df_paths: FixturePaths, cli_runner):
+  state_file = df_paths.tmp / 'state' / 'dfi.json'
+  args = [
+    f'--dotfile-dir={df_paths.dotfiles_dir}',
+    '--dotfile-excludes', '.*',
+    '--state-file', str(state_file),
+  ]
+
+  def run(*extra: str) -> Result:
+    with chdir(df_paths.base_dir):
+      result: Result = cli_runner.invoke(app.main, args=args + list(extra))
+    if result.exit_code != 0:
+      raise result.exception from None
+    return result
+
+  assert run().output == ''
+  assert (df_paths.home_dir / 'bashrc').is_symlink()
+  assert state_file.exists()
+
+  assert run().output.startswith('nothing has changed since the last run, checked in ')
+  assert run('--force').output == ''
+
+  df_paths.dotfiles_dir.joinpath('zshrc').write_text('')
+  assert run().output == ''
+  assert (df_paths.home_dir / 'zshrc').is_symlink()